@@ -61,6 +61,11 @@ fi
 
 export SSL_CERT_DIR=$SSL_CERT_DIR
 
+# Render the download tuning from config.json (see lua/readconf.lua)
+# if this fails, the defaults shipped in /etc/nginx/generated are used
+luajit /etc/nginx/lua/readconf.lua /etc/nginx/lua/config.json /etc/nginx/generated \
+  || echo "Failed to render the read configuration, using the defaults"
+
 # Start a dns server (just for respecting /etc/hosts)
 # use a non-standard port in case we are not running as root
 # if we are ipv4 only, filter AAAA records
@@ -0,0 +1,188 @@
+local ngx = require("ngx")
+local config = require("config")
+
+-- Index of the files in local_path and when they were last read, kept in the
+-- access_index shared dict for the disk garbage collector and the
+-- pull-through cache (see diskgc and cachestore). It is only maintained when
+-- one of them is enabled.
+--
+-- Keys of the dict:
+--   file:<key>    "<size> <atime> <cached> <generation>" of a file
+--   usage         total size of the indexed files
+--   cached_usage  total size of the files filled by the cache
+--   generation    incremented by every rebuild from the disk, so that the
+--                 files that were not seen can be dropped
+-- Uploads and cache fills add files as they are committed, reads update
+-- their atime in the log phase of /webdav_read, and worker 0 rebuilds the
+-- index from a walk of local_path on startup and every gc_rescan_interval,
+-- which also catches changes made behind the server's back.
+
+local accessindex = {}
+
+-- Extended attribute that marks the files filled by the cache
+accessindex.CACHED_XATTR = "user.nginx-webdav.cached"
+
+---@class IndexEntry
+---@field key string
+---@field size integer
+---@field atime number
+---@field cached boolean Filled by the cache, rather than uploaded here
+
+---@type function
+---@return boolean
+function accessindex.enabled()
+    return config.data.gc_enabled or config.data.cache_enabled
+end
+
+---@type function
+---@param value string
+---@return integer size, number atime, boolean cached, integer generation
+local function decode(value)
+    local size, atime, cached, generation = value:match("^(%d+) ([%d.]+) ([01]) (%d+)$")
+    return tonumber(size), tonumber(atime), cached == "1", tonumber(generation)
+end
+
+---@type function
+---@param key string
+---@param size integer
+---@param atime number
+---@param cached boolean
+---Add or update a file
+function accessindex.add(key, size, atime, cached)
+    if not accessindex.enabled() then
+        return
+    end
+    local dict = ngx.shared.access_index
+    local previous = dict:get("file:" .. key)
+    local generation = dict:get("generation") or 0
+    local ok, err = dict:safe_set(
+        "file:" .. key, string.format("%d %.3f %d %d", size, atime, cached and 1 or 0, generation)
+    )
+    if not ok then
+        ngx.log(ngx.WARN, "Failed to index ", key, ": ", err)
+        return
+    end
+    local delta, cached_delta = size, cached and size or 0
+    if previous then
+        local previous_size, _, previous_cached = decode(previous)
+        delta = delta - previous_size
+        cached_delta = cached_delta - (previous_cached and previous_size or 0)
+    end
+    dict:incr("usage", delta, 0)
+    dict:incr("cached_usage", cached_delta, 0)
+end
+
+---@type function
+---@param key string
+---Drop a file from the index
+function accessindex.remove(key)
+    local dict = ngx.shared.access_index
+    local value = dict:get("file:" .. key)
+    if not value then
+        return
+    end
+    dict:delete("file:" .. key)
+    local size, _, cached = decode(value)
+    dict:incr("usage", -size, 0)
+    if cached then
+        dict:incr("cached_usage", -size, 0)
+    end
+end
+
+---@type function
+---@param key string
+---@return IndexEntry? entry Nil if the file is not indexed
+function accessindex.get(key)
+    local value = ngx.shared.access_index:get("file:" .. key)
+    if not value then
+        return nil
+    end
+    local size, atime, cached = decode(value)
+    return {key = key, size = size, atime = atime, cached = cached}
+end
+
+---@type function
+---@param key string
+---Record a read of the file at key. Can be called in the log phase.
+function accessindex.touch(key)
+    if not accessindex.enabled() then
+        return
+    end
+    local dict = ngx.shared.access_index
+    local value = dict:get("file:" .. key)
+    if value then
+        local size, _, cached, generation = decode(value)
+        dict:set("file:" .. key, string.format("%d %.3f %d %d", size, ngx.now(), cached and 1 or 0, generation))
+    end
+end
+
+---@type function
+---@param cached boolean? Only count the files filled by the cache
+---@return integer usage Total size of the indexed files, in bytes
+function accessindex.usage(cached)
+    return ngx.shared.access_index:get(cached and "cached_usage" or "usage") or 0
+end
+
+---@type function
+---@param cached_only boolean? Only list the files filled by the cache
+---@return IndexEntry[] entries Least recently read first
+function accessindex.lru(cached_only)
+    local dict = ngx.shared.access_index
+    local entries = {}
+    for _, name in ipairs(dict:get_keys(0)) do
+        if name:sub(1, 5) == "file:" then
+            local value = dict:get(name)
+            if value then
+                local size, atime, cached = decode(value)
+                if cached or not cached_only then
+                    table.insert(entries, {key = name:sub(6), size = size, atime = atime, cached = cached})
+                end
+            end
+        end
+    end
+    table.sort(entries, function(a, b) return a.atime < b.atime end)
+    return entries
+end
+
+---@type function
+---@return integer generation
+---Start a rebuild. Files added from now on belong to the new generation.
+function accessindex.begin_rebuild()
+    return ngx.shared.access_index:incr("generation", 1, 0)
+end
+
+---@type function
+---@param key string
+---@param size integer
+---@param atime number From the disk, kept if the index has a later one
+---@param cached boolean
+---Add a file found by the rebuild
+function accessindex.rebuild_add(key, size, atime, cached)
+    local value = ngx.shared.access_index:get("file:" .. key)
+    if value then
+        local _, indexed_atime = decode(value)
+        atime = math.max(atime, indexed_atime)
+    end
+    accessindex.add(key, size, atime, cached)
+end
+
+---@type function
+---@param generation integer
+---@return integer dropped Files that were not seen by the rebuild
+---Finish a rebuild, dropping the files of earlier generations
+function accessindex.end_rebuild(generation)
+    local dict = ngx.shared.access_index
+    local dropped = 0
+    for _, name in ipairs(dict:get_keys(0)) do
+        if name:sub(1, 5) == "file:" then
+            local value = dict:get(name)
+            if value and select(4, decode(value)) < generation then
+                accessindex.remove(name:sub(6))
+                dropped = dropped + 1
+            end
+        end
+    end
+    return dropped
+end
+
+return accessindex
@@ -0,0 +1,122 @@
+local ngx = require("ngx")
+local resty_lock = require("resty.lock")
+local config = require("config")
+local accessindex = require("accessindex")
+local cksumutil = require("cksumutil")
+local fileutil = require("fileutil")
+local nsfilter = require("nsfilter")
+local peerclient = require("peerclient")
+local metrics = require("metrics")
+local metaindex = require("metaindex")
+
+-- Pull-through cache for /redirect (config cache_enabled): a read of a file
+-- that only peers have is redirected to a replica, while a timer copies the
+-- file into local_path, so that later reads at this site are served locally.
+--
+-- Files filled by the cache are marked with an extended attribute
+-- (accessindex.CACHED_XATTR), and kept within config cache_quota by the
+-- diskgc timer, which evicts the least recently read of them. Files uploaded
+-- to this node (origin data) do not count towards the quota and are not
+-- evicted by it.
+
+local cachestore = {}
+
+---@type function
+---@param key string Path of the file relative to the webdav root
+---@param location string URL of a replica of the file on a peer
+---@return string? err
+---Copy the file from a peer into the cache, unless another fill of the same
+---file is in progress
+local function fill(key, location)
+    local path = config.data.local_path .. key
+    local lock, err = resty_lock:new("redirect_locks", {
+        exptime = config.data.cache_fill_lock_ttl,
+        timeout = 0,
+    })
+    if not lock then
+        return "failed to create fill lock: " .. err
+    end
+    local elapsed
+    elapsed, err = lock:lock("fill:" .. key)
+    if not elapsed then
+        if err == "timeout" then
+            return nil
+        end
+        return "failed to lock fill: " .. err
+    end
+    if fileutil.get_metadata(path, false).exists then
+        lock:unlock()
+        return nil
+    end
+
+    local token = ngx.shared.gossip_data:get("bearer_token")
+    local res, httpc
+    res, err, httpc = peerclient.request(location, {
+        method = "GET",
+        headers = {
+            ["Authorization"] = "Bearer " .. (token or ""),
+            ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
+            ["Want-Digest"] = "adler32",
+        },
+    }, {config.data.tpc_connect_timeout, config.data.tpc_send_timeout, config.data.tpc_read_timeout})
+    if not res then
+        lock:unlock()
+        return "request to " .. location .. " failed: " .. err
+    end
+    ---@cast httpc table
+    local size = tonumber(res.headers["Content-Length"])
+    if res.status ~= ngx.HTTP_OK or not size or size > config.data.cache_quota then
+        httpc:close()
+        lock:unlock()
+        return "not caching " .. location .. ": status " .. res.status .. ", size " .. tostring(size)
+    end
+
+    local adler32
+    err, adler32 = fileutil.sink_to_file(path, fileutil.pulled_reader(res.body_reader), false, nil, size)
+    -- There is no log phase to count them in
+    metrics.inc("nginx_webdav_pulled_bytes_total", {operation = "redirect"}, ngx.ctx.pulled_bytes_received or 0)
+    if not err then
+        peerclient.keepalive(httpc)
+        local source_adler32 = (res.headers["Digest"] or ""):lower():match("adler32=(%x+)")
+        if source_adler32 and source_adler32 ~= adler32 then
+            err = "adler32 checksum mismatch: source " .. source_adler32 .. " destination " .. adler32
+            os.remove(path)
+            nsfilter.record_remove(key)
+            accessindex.remove(key)
+            metaindex.remove(path)
+        else
+            cksumutil.setxattr(path, accessindex.CACHED_XATTR, "1")
+            accessindex.add(key, size, ngx.now(), true)
+            metrics.inc("nginx_webdav_cache_filled_bytes_total", nil, size)
+            metrics.set("nginx_webdav_cache_usage_bytes", nil, accessindex.usage(true))
+        end
+    else
+        httpc:close()
+    end
+    lock:unlock()
+    return err
+end
+
+---@type function
+---@param key string Path of the file relative to the webdav root
+---@param location string URL of a replica of the file on a peer
+---@return string? err
+---Start copying the file from a peer into the cache in the background. The
+---request is not held up by the copy, it can be redirected to the replica.
+function cachestore.fill(key, location)
+    local ok, err = ngx.timer.at(0, function(premature)
+        if premature then
+            return
+        end
+        local fill_err = fill(key, location)
+        if fill_err then
+            ngx.log(ngx.WARN, "Failed to cache ", key, ": ", fill_err)
+        end
+    end)
+    if not ok then
+        return "failed to create fill timer: " .. err
+    end
+    return nil
+end
+
+return cachestore
@@ -0,0 +1,294 @@
+local ffi = require("ffi")
+local zlib = require("zlib")
+
+-- The parts of cksumutil that block on disk IO or the CPU.
+-- These functions are run in an nginx thread pool with ngx.run_worker_thread
+-- (see cksumutil), in a separate Lua VM that only has a small subset of the
+-- ngx API. So this module must not depend on config or use ngx.log, and
+-- arguments and return values must be plain values or tables of them.
+
+local cksumthread = {}
+
+-- Use FFI to call system-level set/getxattr calls. The FFI lib doesn't under-
+-- stand void* variables, so I have to call value a const char* and not a void*
+-- FIXME: Not platform-independent. Not sure how much we care
+ffi.cdef[[
+int setxattr(const char *path, const char *name, const char *value, size_t size,
+int flags);
+int getxattr(const char *path, const char *name, char *value, size_t size);
+int removexattr(const char *path, const char *name);
+]]
+
+-- errno when the attribute doesn't exist (Linux)
+local ENODATA = 61
+
+-- Reused by every getxattr of this thread, rather than allocated per call
+local XATTR_BUFFER_SIZE = 1024
+local xattr_buffer = ffi.new("char[?]", XATTR_BUFFER_SIZE)
+
+-- CRC-32C (Castagnoli) lookup table, for the reflected polynomial
+local crc32c_table = {}
+for i = 0, 255 do
+  local crc = i
+  for _ = 1, 8 do
+    if bit.band(crc, 1) == 1 then
+      crc = bit.bxor(bit.rshift(crc, 1), 0x82F63B78)
+    else
+      crc = bit.rshift(crc, 1)
+    end
+  end
+  crc32c_table[i] = crc
+end
+
+---@type function
+---@param path string
+---@param key string
+---@param value string
+---@return string? err
+---Sets an extended attribute on a file
+function cksumthread.setxattr(path, key, value)
+  local ret = ffi.C.setxattr(path, key, value, string.len(value), 0)
+  if ret ~= 0 then
+    ret = ffi.errno()
+    return "Error " .. ret .. " in setxattr"
+  else
+    return nil
+  end
+end
+
+---@type function
+---@param path string
+---@param key string
+---@return string? err, string? value
+---Gets an extended attribute from a file
+function cksumthread.getxattr(path, key)
+  local value = xattr_buffer
+  local ret = ffi.C.getxattr(path, key, value, XATTR_BUFFER_SIZE)
+  -- FIXME: get the C errstr
+  if ret < 0 then
+    ret = ffi.errno()
+    if ret == ENODATA then
+      -- It's not really an error if the attribute isn't there. I think nil
+      -- is disctinct from "" in Lua
+      return nil, nil
+    else
+      return "Error " .. ret .. " in getxattr", nil
+    end
+  else
+    return nil, ffi.string(value, ret)
+  end
+end
+
+---@type function
+---@param path string
+---@param keys string[]
+---@return string? err, string? val
+---Gets the first of the extended attributes that is set on a file
+function cksumthread.getxattrs(path, keys)
+  for i=1,#keys do
+    local err, val = cksumthread.getxattr(path, keys[i])
+    if err then
+      return err, nil
+    elseif val then
+      return nil, val
+    end
+  end
+  return nil, nil
+end
+
+---@type function
+---@param paths string[]
+---@param keys string[]
+---@return string? err, string[] values
+---cksumthread.getxattrs for each of the paths, with "" for the unset ones,
+---so that a batch of files takes a single trip to the thread pool
+function cksumthread.getxattrs_many(paths, keys)
+  local values = {}
+  for i=1,#paths do
+    local _, val = cksumthread.getxattrs(paths[i], keys)
+    values[i] = val or ""
+  end
+  return nil, values
+end
+
+---@type function
+---@param path string
+---@param keys string[]
+---@param value string
+---@return string? err
+---Sets all of the extended attributes on a file to value
+function cksumthread.setxattrs(path, keys, value)
+  local total_err = nil
+  for i=1,#keys do
+    local err = cksumthread.setxattr(path, keys[i], value)
+    if err then
+      total_err = err
+    end
+  end
+  return total_err
+end
+
+---@type function
+---@param path string
+---@param key string
+---@return string? err
+---Removes an extended attribute from a file, if it exists
+function cksumthread.removexattr(path, key)
+  local ret = ffi.C.removexattr(path, key)
+  if ret ~= 0 then
+    ret = ffi.errno()
+    if ret ~= ENODATA then
+      return "Error " .. ret .. " in removexattr"
+    end
+  end
+  return nil
+end
+
+---@type function
+---@param path string
+---@param groups table<string, string[]> Extended attribute names, by digest algorithm
+---@return string? err, table<string, string>? values
+---Gets the digests stored in extended attributes, by algorithm
+function cksumthread.getxattrs_table(path, groups)
+  local values = {}
+  for algorithm, keys in pairs(groups) do
+    local err, val = cksumthread.getxattrs(path, keys)
+    if err then
+      return err, nil
+    end
+    values[algorithm] = val
+  end
+  return nil, values
+end
+
+---@type function
+---@param path string
+---@param groups table<string, string[]> Extended attribute names, by digest algorithm
+---@param values table<string, string> Digests, by algorithm
+---@return string? err
+---Stores the digests in extended attributes, removing those of the
+---algorithms in groups that have no value
+function cksumthread.setxattrs_table(path, groups, values)
+  local total_err = nil
+  for algorithm, keys in pairs(groups) do
+    for i=1,#keys do
+      local err
+      if values[algorithm] then
+        err = cksumthread.setxattr(path, keys[i], values[algorithm])
+      else
+        err = cksumthread.removexattr(path, keys[i])
+      end
+      if err then
+        total_err = err
+      end
+    end
+  end
+  return total_err
+end
+
+---@type function
+---@param state integer CRC-32C register, before the final inversion
+---@param buf string
+---@return string? err, integer? val
+---Increments the crc32c state with buf
+function cksumthread.crc32c_update(state, buf)
+  local bytes = ffi.cast("const uint8_t *", buf)
+  for i = 0, #buf - 1 do
+    state = bit.bxor(bit.rshift(state, 8), crc32c_table[bit.band(bit.bxor(state, bytes[i]), 0xFF)])
+  end
+  return nil, state
+end
+
+---@type function
+---@param path string
+---@param block_size integer
+---@return string? err, integer? val
+---Given a path, compute adler32 of the file
+function cksumthread.compute_adler32(path, block_size)
+  local adler_state = zlib.adler32()
+
+  local fd, err = io.open(path, "rb")
+  if not fd then
+    return "Failed to open " .. path .. ": " .. err, nil
+  end
+
+  repeat
+    local data = fd:read(block_size)
+
+    if data then
+      adler_state(data)
+    end
+  until not data
+
+  local suc, exitcode = fd:close()
+  if not suc then
+    return "Failed to close " .. path .. ": " .. exitcode, nil
+  end
+
+  return nil, adler_state()
+end
+
+---@type function
+---@param path string
+---@param offset integer
+---@param length integer
+---@param block_size integer
+---@return string? err, integer? val
+---Compute the adler32 of length bytes of the file, starting at offset
+function cksumthread.compute_adler32_range(path, offset, length, block_size)
+  local adler_state = zlib.adler32()
+
+  local fd, err = io.open(path, "rb")
+  if not fd then
+    return "Failed to open " .. path .. ": " .. err, nil
+  end
+  local ok, seek_err = fd:seek("set", offset)
+  if not ok then
+    fd:close()
+    return "Failed to seek in " .. path .. ": " .. seek_err, nil
+  end
+
+  local remaining = length
+  while remaining > 0 do
+    local data = fd:read(math.min(block_size, remaining))
+    if not data then
+      fd:close()
+      return "Unexpected end of " .. path .. " at offset " .. (offset + length - remaining), nil
+    end
+    adler_state(data)
+    remaining = remaining - #data
+  end
+
+  local suc, exitcode = fd:close()
+  if not suc then
+    return "Failed to close " .. path .. ": " .. exitcode, nil
+  end
+
+  return nil, adler_state()
+end
+
+---@type function
+---@param path string
+---@param offset integer
+---@param length integer
+---@return string? err, string? data
+---Read up to length bytes of the file, starting at offset (nil data at the end)
+function cksumthread.read_range(path, offset, length)
+  local fd, err = io.open(path, "rb")
+  if not fd then
+    return "Failed to open " .. path .. ": " .. err, nil
+  end
+  local ok, seek_err = fd:seek("set", offset)
+  if not ok then
+    fd:close()
+    return "Failed to seek in " .. path .. ": " .. seek_err, nil
+  end
+  local data, read_err = fd:read(length)
+  fd:close()
+  if read_err then
+    return "Failed to read " .. path .. ": " .. read_err, nil
+  end
+  return nil, data
+end
+
+return cksumthread
@@ -1,6 +1,11 @@
 local ffi = require("ffi")
 local config = require("config")
 local zlib = require("zlib")
+local resty_md5 = require("resty.md5")
+local resty_lock = require("resty.lock")
+local sys_stat = require("posix.sys.stat")
+local metrics = require("metrics")
+local metaindex = require("metaindex")
 
 -- some lua-isms added from https://github.com/user-none/lua-hashings/
 
@@ -10,26 +15,134 @@ local adler_xattr_locations = {
   "user.XrdCks.Human.ADLER32",
   "user.nginx-webdav.adler32"
 }
+cksumutil.ADLER32_XATTRS = adler_xattr_locations
+
+-- Anything that blocks on disk IO or the CPU runs in the checksum thread pool
+-- (see cksumthread), so these functions must be called from a context that
+-- can yield (not in header or body filters)
+
+---@type function
+---@param func string Name of the function in cksumthread
+---@return string? err, any val
+local function run_in_thread(func, ...)
+  local ok, err, val = ngx.run_worker_thread(config.data.checksum_thread_pool, "cksumthread", func, ...)
+  if not ok then
+    return "Failed to run " .. func .. " in thread pool: " .. tostring(err), nil
+  end
+  return err, val
+end
+
+---@class DigestAlgorithm
+---@field xattrs string[] Where the digest is stored
+---@field new fun(): any Makes a blank state
+---@field update fun(state: any, buf: string): any Increments the state with buf, returning the state
+---@field final fun(state: any): string? Exports the state in its Digest header (RFC 3230) encoding
+
+-- Digests that can be computed while streaming, by their (lowercase) name in
+-- the Want-Digest and Digest headers
+---@type table<string, DigestAlgorithm>
+local digest_algorithms = {
+  adler32 = {
+    xattrs = adler_xattr_locations,
+    new = function() return cksumutil.adler32_initialize() end,
+    update = function(state, buf) return cksumutil.adler32_increment(state, buf) end,
+    final = function(state) return cksumutil.adler32_to_string(state) end,
+  },
+  crc32c = {
+    xattrs = {"user.nginx-webdav.crc32c"},
+    -- There is no C implementation at hand, and a Lua one would hold up
+    -- the worker for every buffer, so it runs in the checksum thread pool.
+    -- If that fails, the digest is left out rather than wrong.
+    new = function() return {crc = bit.tobit(0xFFFFFFFF)} end,
+    update = function(state, buf)
+      if state.err then
+        return state
+      end
+      local err, crc = run_in_thread("crc32c_update", state.crc, buf)
+      if err then
+        ngx.log(ngx.ERR, "Failed to compute crc32c: " .. err)
+        state.err = err
+      else
+        state.crc = crc
+      end
+      return state
+    end,
+    final = function(state)
+      if state.err then
+        return nil
+      end
+      return bit.tohex(bit.bnot(state.crc), 8)
+    end,
+  },
+  md5 = {
+    xattrs = {"user.nginx-webdav.md5"},
+    new = function() return resty_md5:new() end,
+    update = function(state, buf)
+      state:update(buf)
+      return state
+    end,
+    -- base64 of the binary digest, as Content-MD5
+    final = function(state) return ngx.encode_base64(state:final()) end,
+  },
+}
 
 ---@type function
 ---@param path string
 ---@return string? err, string? val
 ---Gets the adler32 of a file, calculating it if it doesn't exist
+---Concurrent requests for the same file wait for a single computation
 function cksumutil.get_adler32(path)
   local err, val = cksumutil.check_adler32(path)
-  if err or val == nil then
-    -- We checked and didn't see an adler32, so make one
-    local get_err, get_val = cksumutil.compute_adler32(path)
-    if not get_val then
-      return get_err, nil
+  if val then
+    return nil, val
+  end
+
+  local lock, lock_err = resty_lock:new("checksums", {
+    exptime = config.data.checksum_lock_timeout,
+    timeout = config.data.checksum_lock_timeout,
+  })
+  if lock then
+    local elapsed
+    elapsed, lock_err = lock:lock("lock:" .. path)
+    if not elapsed then
+      lock = nil
+    end
+  end
+  if not lock then
+    ngx.log(ngx.WARN, "Failed to lock checksum computation for " .. path .. ": " .. lock_err)
+  else
+    -- Another request may have computed it while we waited for the lock
+    val = ngx.shared.checksums:get("adler32:" .. path)
+    if val then
+      lock:unlock()
+      return nil, val
     end
+  end
+
+  -- We checked and didn't see an adler32, so make one
+  local get_err, get_val = cksumutil.compute_adler32(path)
+  if get_val then
     local set_err = cksumutil.set_adler32(path, get_val)
     if set_err then
       ngx.log(ngx.ERR, "Failed to set adler32 for " .. path .. " err: " .. set_err)
     end
-    val = get_val
+    -- Hand the result to any waiters, even if we could not store it in the xattrs
+    ngx.shared.checksums:set("adler32:" .. path, get_val, config.data.checksum_result_ttl)
+  end
+  if lock then
+    lock:unlock()
+  end
+  if not get_val then
+    return get_err, nil
   end
-  return nil, val
+  return nil, get_val
+end
+
+---@type function
+---@param path string
+---Forget any checksum of a file computed for waiting requests, after it changed
+function cksumutil.invalidate(path)
+  ngx.shared.checksums:delete("adler32:" .. path)
 end
 
 ---@type function
@@ -38,18 +151,156 @@ end
 ---@return string? err
 ---Sets the adler32 of a file
 function cksumutil.set_adler32(path, value)
-  local total_err = nil
-  for i=1,#adler_xattr_locations do
-    local err = cksumutil.setxattr(path,
-    adler_xattr_locations[i],
-    value)
+  cksumutil.invalidate(path)
+  metaindex.set_adler32(path, value)
+  return run_in_thread("setxattrs", path, adler_xattr_locations, value)
+end
+
+---@type function
+---@return string[] algorithms
+---The configured digest algorithms to compute on upload, always including adler32
+function cksumutil.upload_algorithms()
+  local algorithms = {"adler32"}
+  for _, name in ipairs(config.data.upload_digests) do
+    name = string.lower(name)
+    if name ~= "adler32" and digest_algorithms[name] then
+      table.insert(algorithms, name)
+    end
+  end
+  return algorithms
+end
+
+---@type function
+---@param algorithms string[]
+---@return table<string, any> states
+---Makes blank states for all of the digest algorithms
+function cksumutil.digests_initialize(algorithms)
+  local states = {}
+  for _, name in ipairs(algorithms) do
+    states[name] = digest_algorithms[name].new()
+  end
+  return states
+end
+
+---@type function
+---@param states table<string, any>
+---@param buf string
+---@return table<string, any> states
+---increments all of the digest states with the value in buf
+function cksumutil.digests_increment(states, buf)
+  for name, state in pairs(states) do
+    states[name] = digest_algorithms[name].update(state, buf)
+  end
+  return states
+end
+
+---@type function
+---@param states table<string, any>
+---@return table<string, string> digests
+---Export all of the digest states in their Digest header encoding
+function cksumutil.digests_to_strings(states)
+  local digests = {}
+  for name, state in pairs(states) do
+    digests[name] = digest_algorithms[name].final(state)
+  end
+  return digests
+end
+
+---@type function
+---@param path string
+---@param digests table<string, string>
+---@return string? err
+---Stores the digests of a file, removing any stored digest of the other
+---algorithms as it would be stale (e.g. when the file has been overwritten)
+function cksumutil.set_digests(path, digests)
+  cksumutil.invalidate(path)
+  local groups = {}
+  for name, algorithm in pairs(digest_algorithms) do
+    groups[name] = algorithm.xattrs
+  end
+  return run_in_thread("setxattrs_table", path, groups, digests)
+end
+
+---@type function
+---@param path string
+---@param algorithms string[]
+---@return table<string, string> digests
+---Gets the stored digests of a file for the algorithms.
+---adler32 is calculated if it is missing, the others are only available if
+---they were computed when the file was written.
+function cksumutil.get_digests(path, algorithms)
+  if #algorithms == 1 and algorithms[1] == "adler32" then
+    -- Can come from the metadata index
+    local err, adler32 = cksumutil.get_adler32(path)
     if err then
-      total_err = err
+      ngx.log(ngx.ERR, "Failed to get adler32 for " .. path .. " err: " .. err)
+    end
+    return {adler32 = adler32}
+  end
+  local groups = {}
+  for _, name in ipairs(algorithms) do
+    groups[name] = digest_algorithms[name].xattrs
+  end
+  local err, digests = run_in_thread("getxattrs_table", path, groups)
+  if not digests then
+    ngx.log(ngx.ERR, "Failed to get digests for " .. path .. " err: " .. err)
+    digests = {}
+  end
+  if groups.adler32 and not digests.adler32 then
+    err, digests.adler32 = cksumutil.get_adler32(path)
+    if err then
+      ngx.log(ngx.ERR, "Failed to get adler32 for " .. path .. " err: " .. err)
+    end
+  end
+  return digests
+end
+
+---@type function
+---@param header string?
+---@return string[] algorithms
+---Parse a Want-Digest header (RFC 3230), e.g. "md5;q=0.3, adler32".
+---Returns the supported algorithms in order of preference, without those
+---with q=0
+function cksumutil.parse_want_digest(header)
+  local wanted = {}
+  for item in string.gmatch(header or "", "[^,]+") do
+    local name = string.lower(item:match("^%s*([^;%s]+)") or "")
+    local q = tonumber(item:match(";%s*[qQ]%s*=%s*([%d.]+)") or "1") or 0
+    if digest_algorithms[name] and q > 0 then
+      table.insert(wanted, {name = name, q = q, index = #wanted})
     end
   end
-  return total_err
+  -- table.sort is not stable, so break ties by position
+  table.sort(wanted, function(a, b)
+    if a.q ~= b.q then
+      return a.q > b.q
+    end
+    return a.index < b.index
+  end)
+  local algorithms = {}
+  for i, item in ipairs(wanted) do
+    algorithms[i] = item.name
+  end
+  return algorithms
 end
 
+---@type function
+---@param digests table<string, string>
+---@param algorithms string[]
+---@return string? digest
+---Format the Digest header value for the wanted algorithms that have a digest
+function cksumutil.format_digest(digests, algorithms)
+  local out = {}
+  for _, name in ipairs(algorithms) do
+    if digests[name] then
+      table.insert(out, name .. "=" .. digests[name])
+    end
+  end
+  if #out == 0 then
+    return nil
+  end
+  return table.concat(out, ",")
+end
 
 ---@type function
 ---@return function state
@@ -73,7 +324,34 @@ end
 ---@return string adler32
 ---Export adler32 state as hex string
 function cksumutil.adler32_to_string(state)
-  local digest = state()
+  return cksumutil.adler32_format(state())
+end
+
+-- Largest prime smaller than 65536, the adler32 modulus
+local ADLER_BASE = 65521
+
+---@type function
+---@param adler1 integer adler32 of the first block of data
+---@param adler2 integer adler32 of the second block of data
+---@param len2 integer Length in bytes of the second block
+---@return integer adler32 adler32 of the concatenation of both blocks
+---Combine two adler32 values, as zlib's adler32_combine
+function cksumutil.adler32_combine(adler1, adler2, len2)
+  local rem = len2 % ADLER_BASE
+  local sum1 = adler1 % 65536
+  local sum2 = (rem * sum1) % ADLER_BASE
+  sum1 = sum1 + adler2 % 65536 + ADLER_BASE - 1
+  sum2 = sum2 + math.floor(adler1 / 65536) + math.floor(adler2 / 65536) + ADLER_BASE - rem
+  sum1 = sum1 % ADLER_BASE
+  sum2 = sum2 % ADLER_BASE
+  return sum2 * 65536 + sum1
+end
+
+---@type function
+---@param digest integer
+---@return string adler32
+---Format an adler32 value as hex string
+function cksumutil.adler32_format(digest)
   local bytes = {
     bit.band(bit.rshift(digest,24), 0xFF),
     bit.band(bit.rshift(digest,16), 0xFF),
@@ -92,58 +370,115 @@ end
 ---@return string? err, string? val
 ---Given a path, compute adler32 of the file
 function cksumutil.compute_adler32(path)
-  local adler_state = cksumutil.adler32_initialize()
-
-  local fd, err = io.open(path, "r")
-  if not fd then
-    return "Failed to open " .. path .. ": " .. err, nil
+  ngx.update_time()
+  local tic = ngx.now()
+  local err, val
+  local stat = sys_stat.stat(path)
+  if stat and config.data.checksum_parallel_chunks > 1 and stat.st_size >= config.data.checksum_parallel_min_size then
+    err, val = cksumutil.compute_adler32_parallel(path, stat.st_size, config.data.checksum_parallel_chunks)
+  else
+    err, val = run_in_thread("compute_adler32", path, config.data.checksum_block_size)
   end
+  if not val then
+    return err, nil
+  end
+  ngx.update_time()
+  ngx.log(ngx.NOTICE, "Computed adler32 of ", path, " in ", ngx.now() - tic, " seconds")
+  metrics.observe("nginx_webdav_checksum_duration_seconds", nil, ngx.now() - tic)
+  return nil, cksumutil.adler32_format(val)
+end
 
-  repeat
-    local data = fd:read(config.data.checksum_block_size)
-
-    if data then
-      adler_state = cksumutil.adler32_increment(adler_state, data)
+---@type function
+---@param path string
+---@param size integer
+---@param nchunks integer
+---@return string? err, integer? val
+---Compute the adler32 of a file by checksumming disjoint regions of it
+---concurrently in the thread pool, and combining the partial results
+function cksumutil.compute_adler32_parallel(path, size, nchunks)
+  local chunk_size = math.ceil(size / nchunks)
+  local threads = {}
+  for offset = 0, size - 1, chunk_size do
+    local length = math.min(chunk_size, size - offset)
+    local co, err = ngx.thread.spawn(function()
+      local range_err, range_val = run_in_thread(
+        "compute_adler32_range", path, offset, length, config.data.checksum_block_size
+      )
+      return range_err, range_val, length
+    end)
+    if not co then
+      for _, other in ipairs(threads) do
+        ngx.thread.kill(other)
+      end
+      return "Failed to spawn checksum thread: " .. err, nil
     end
-  until not data
+    table.insert(threads, co)
+  end
 
-  local suc, exitcode = fd:close()
-  if not suc then
-    return "Failed to close " .. path .. ": " .. exitcode, nil
+  -- Regions have to be combined in file order
+  local adler32 = nil
+  local err = nil
+  for _, co in ipairs(threads) do
+    local ok, range_err, range_val, length = ngx.thread.wait(co)
+    if not ok then
+      range_err = tostring(range_err)
+    end
+    if not err and range_err then
+      err = range_err
+    elseif not err then
+      if adler32 then
+        adler32 = cksumutil.adler32_combine(adler32, range_val, length)
+      else
+        adler32 = range_val
+      end
+    end
   end
+  if err then
+    return err, nil
+  end
+  return nil, adler32
+end
 
-  return nil, cksumutil.adler32_to_string(adler_state)
+---@type function
+---@param path string
+---@param offset integer
+---@param length integer
+---@return string? err, integer? val
+---Compute the adler32 (as a number) of length bytes of a file, starting at offset
+function cksumutil.compute_adler32_range(path, offset, length)
+  return run_in_thread("compute_adler32_range", path, offset, length, config.data.checksum_block_size)
 end
 
 ---@type function
 ---@param path string
 ---@return string? err, string? val
----Gets the adler32 of a file from xattrs, NOT calculating if it doesn't exist
+---Gets the adler32 of a file from the metadata index or the xattrs, NOT
+---calculating if it doesn't exist
 function cksumutil.check_adler32(path)
-  -- xattrs to check for existing checksums
-  local adler32 = nil
-  for i=1,#adler_xattr_locations do
-    local err, val = cksumutil.getxattr(path, adler_xattr_locations[i])
-    if not err then
-      return nil, val
-    elseif err then
-      return err, nil
-    end
+  local indexed = metaindex.get(path)
+  if indexed and indexed.adler32 then
+    return nil, indexed.adler32
   end
-  return nil, nil
+  return run_in_thread("getxattrs", path, adler_xattr_locations)
 end
 
--- The parts that actually call the C-level get/setxattr
--- FIXME migrate to ngx.run_worker_thread since this will block
+---@type function
+---@param paths string[]
+---@return string? err, string[]? values
+---cksumutil.check_adler32 for many files at once, with "" for those without one
+function cksumutil.check_adler32_many(paths)
+  return run_in_thread("getxattrs_many", paths, adler_xattr_locations)
+end
 
--- Use FFI to call system-level set/getxattr calls. The FFI lib doesn't under-
--- stand void* variables, so I have to call value a const char* and not a void*
--- FIXME: Not platform-independent. Not sure how much we care
-ffi.cdef[[
-int setxattr(const char *path, const char *name, const char *value, size_t size,
-int flags);
-int getxattr(const char *path, const char *name, char *value, size_t size);
-]]
+---@type function
+---@param path string
+---@param offset integer
+---@param length integer
+---@return string? err, string? data
+---Read up to length bytes of the file, starting at offset (nil data at the end)
+function cksumutil.read_range(path, offset, length)
+  return run_in_thread("read_range", path, offset, length)
+end
 
 ---@type function
 ---@param path string
@@ -152,13 +487,7 @@ int getxattr(const char *path, const char *name, char *value, size_t size);
 ---@return string? err
 ---Sets an extended attribute on a file
 function cksumutil.setxattr(path, key, value)
-  local ret = ffi.C.setxattr(path, key, value, string.len(value), 0)
-  if ret > 0 then
-    ret = ffi.errno()
-    return "Error " .. ret .. " in setxattr"
-  else
-    return nil
-  end
+  return run_in_thread("setxattr", path, key, value)
 end
 
 ---@type function
@@ -167,24 +496,16 @@ end
 ---@return string? err, string? value
 ---Gets an extended attribute from a file
 function cksumutil.getxattr(path, key)
-  local buflen = 1024
-  local value = ffi.new("char[?]", buflen)
-  local ret = ffi.C.getxattr(path, key, value, buflen)
-  -- FIXME: get the C errstr
-  if ret < 0 then
-    ret = ffi.errno()
-    -- the value doesn' exist
-    local ENODATA = 63
-    if ffi.errno() == ENODATA then
-      -- It's not really an error if the attribute isn't there. I think nil
-      -- is disctinct from "" in Lua
-      return nil, nil
-    else
-      return "Error " .. ret .. " in getxattr", nil
-    end
-  else
-    return nil, ffi.string(value, ret)
-  end
+  return run_in_thread("getxattr", path, key)
+end
+
+---@type function
+---@param path string
+---@param key string
+---@return string? err
+---Removes an extended attribute from a file, if it exists
+function cksumutil.removexattr(path, key)
+  return run_in_thread("removexattr", path, key)
 end
 
 return cksumutil
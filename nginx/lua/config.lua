@@ -20,12 +20,106 @@ local Config = {
         gossip_fraction = 0.1, -- fraction of peers to gossip to
         gossip_max_failures = 5, -- max failures before removing a peer
         gossip_timeout = 5000, -- in milliseconds
+        gossip_protocol = "delta", -- "delta" or "full" (send our whole view every time)
+        gossip_compression = true, -- deflate gossip messages for peers that support it
         peer_query_timeout = 5000, -- in milliseconds
+        -- This is used in peerclient
+        peer_pool_size = 16, -- keepalive connections per peer and worker
+        peer_pool_idle_timeout = 60000, -- in milliseconds
+
+        -- Namespace summary (counting Bloom filter) published through gossip
+        -- This is used in nsfilter
+        namespace_filter_bits = 512*1024,
+        namespace_filter_hashes = 4,
+        namespace_filter_interval = 5, -- in seconds
+        namespace_filter_rescan_interval = 3600, -- in seconds
+
+        -- This is used in locationcache and redirect_content
+        redirect_cache_ttl = 60, -- in seconds
+        redirect_cache_negative_ttl = 5, -- in seconds
+        redirect_cache_lru_size = 10000, -- entries per worker
+        redirect_lock_timeout = 10, -- in seconds
+        -- "weighted": once a peer has the file, wait redirect_collect_timeout
+        -- (in milliseconds) for others, and pick one at random, weighted by
+        -- the load they publish through gossip
+        -- "first": redirect to the first peer that has the file
+        redirect_selection = "weighted",
+        redirect_collect_timeout = 50,
+        -- A peer's weight is its fraction of free disk space, halved at
+        -- redirect_load_requests requests in progress, and again at
+        -- redirect_load_throughput bytes per second
+        redirect_load_requests = 100,
+        redirect_load_throughput = 1000*1000*1000,
+        -- Where PUT on /redirect places files (see placement): "none" spreads
+        -- them evenly over the members, "capacity" in proportion to the size
+        -- of their disk, "free" in proportion to their free space
+        placement_weight = "none",
+        -- Ask the owner of a path (see placement) before the other peers
+        redirect_read_owner_first = true,
+        -- How often the throughput published through gossip is measured (in seconds)
+        load_sample_interval = 10,
+
+        -- This is used in cachestore
+        -- Copy files that /redirect finds on peers into local_path, and
+        -- redirect to the local copy (see cachestore)
+        cache_enabled = false,
+        -- Cached files are evicted, least recently read first, to keep their
+        -- total size within the quota (in bytes). Uploaded files do not count.
+        cache_quota = 100*1000*1000*1000,
+        -- Longest a copy can hold off the others of the same file (in seconds)
+        cache_fill_lock_ttl = 3600,
+
+        -- This is used in diskgc and accessindex
+        -- Delete the least recently read files once the disk is more than
+        -- gc_high_watermark full, until it is below gc_low_watermark
+        -- (fractions of the disk size). This deletes uploaded files too.
+        gc_enabled = false,
+        gc_high_watermark = 0.9,
+        gc_low_watermark = 0.8,
+        gc_interval = 60, -- in seconds
+        -- Spaces out deletions, so that they do not compete with serving
+        gc_max_deletions_per_second = 100,
+        -- How often the access index is rebuilt from a walk of local_path (in seconds)
+        gc_rescan_interval = 6*3600,
+        -- Files under these paths (relative to local_path, with a leading
+        -- slash) are never deleted, nor evicted from the cache
+        gc_pinned_prefixes = {},
 
         -- This is used in webdav_write_content and webdav_tpc_content
         receive_buffer_size = 1024*1024,
         -- How often to send a performance marker (in seconds)
         performance_marker_timeout = 5,
+        -- Files are written here and renamed into place once complete, so it
+        -- must be on the same filesystem as local_path. Inside local_path, it
+        -- must be under .upload, which /webdav_read does not serve.
+        staging_path = "/var/www/webdav/.upload/staging",
+        -- Incomplete uploads that have not been resumed for this long are removed (in seconds)
+        staging_max_age = 24*3600,
+        staging_cleanup_interval = 3600, -- in seconds
+        -- Longest a resumable upload request can hold the lock on its staging file (in seconds)
+        staging_lock_ttl = 3600,
+        -- This is used in webdav_write_content
+        -- Chunked uploads are read by nginx into client_body_temp_path before
+        -- being written, so that the connection can be kept alive after them.
+        -- This writes them twice, so set to false to stream them instead and
+        -- close the connection after each one.
+        upload_buffer_chunked = true,
+        -- This is used in filewriter
+        -- What to sync to disk before a written file is moved into place:
+        -- "none", "fdatasync" or "fsync"
+        write_sync = "none",
+        -- Uploads at least this large are written with O_DIRECT, bypassing the
+        -- page cache (0 to never use it)
+        write_direct_min_size = 0,
+        write_direct_alignment = 4096,
+        -- Must be a multiple of write_direct_alignment
+        write_direct_buffer_size = 4*1024*1024,
+        -- Must match a thread_pool in conf.d/default.main ("" to write from the worker)
+        write_thread_pool = "write",
+        -- Chunks of a transfer that can be waiting to be written, which bounds
+        -- its memory to about this many receive_buffer_size (or
+        -- write_direct_buffer_size) buffers
+        write_queue_depth = 2,
 
         -- This is used in webdav_tpc_content
         -- Timeouts are in milliseconds
@@ -33,9 +127,84 @@ local Config = {
         tpc_send_timeout = 1000,
         tpc_read_timeout = 30000,
         tpc_redirect_limit = 5,
+        -- Parallel byte-range streams for a pull, when the source supports ranges
+        -- (clients can ask for more with the X-Number-Of-Streams header)
+        tpc_stripes = 1,
+        tpc_max_stripes = 8,
+        tpc_stripe_min_size = 64*1024*1024, -- in bytes
+        -- Size of the reads from disk for a push
+        tpc_push_buffer_size = 4*1024*1024,
+        -- Limits on the pulls running at once on this node, in total and from
+        -- each source host:port (0 for no limit)
+        tpc_max_active = 32,
+        tpc_max_active_per_host = 8,
+        -- What happens to a pull over the limits: "queue" waits for its turn
+        -- in a FIFO queue, sending perf markers in the queued state, and
+        -- "reject" answers 503 with Retry-After
+        tpc_overload = "queue",
+        tpc_max_queued = 1000,
+        tpc_queue_timeout = 3600, -- in seconds
+        tpc_queue_poll_interval = 0.5, -- in seconds
+        tpc_retry_after = 60, -- in seconds
+        -- A transfer is dropped from the registry if its request has not
+        -- refreshed it for this long (in seconds), e.g. after a worker crash
+        tpc_registry_ttl = 30,
+
+        -- This is used in webdav_propfind_content
+        -- Entries listed per trip to the checksum thread pool and flush to the client
+        propfind_batch_size = 256,
+
+        -- This is used in metaindex
+        -- Keep the size, mtime and adler32 of the files in an SQLite database,
+        -- and look them up there before going to the filesystem
+        metaindex_enabled = false,
+        -- Should be on a local disk, as SQLite locking is unreliable on
+        -- network filesystems, and outside local_path, which is served
+        metaindex_path = "/var/lib/nginx-webdav/metadata.sqlite",
+        -- Must match a thread_pool in conf.d/default.main
+        metaindex_thread_pool = "metadata",
+        -- How often the index is checked against the files on disk (in seconds)
+        metaindex_reconcile_interval = 3600,
+        -- Files checked per write transaction while reconciling
+        metaindex_batch_size = 256,
+
+        -- This is used in readconf, which renders the nginx configuration of
+        -- /webdav_read when the container starts
+        -- "auto": sendfile below read_directio_min_size, above it O_DIRECT
+        --   reads in the read thread pool
+        -- "sendfile": always sendfile
+        -- "buffered": always read into the output buffers in the worker
+        read_mode = "auto",
+        read_directio_min_size = 4*1024*1024,
+        read_directio_alignment = 4096,
+        -- The buffer size must be a multiple of read_directio_alignment
+        read_output_buffers = 2,
+        read_output_buffer_size = 1024*1024,
+        read_thread_pool_threads = 32,
+        read_thread_pool_max_queue = 65536,
 
         -- This is used in cksumutil
         checksum_block_size = 64*1024*1024,
+        -- Must match a thread_pool in conf.d/default.main
+        checksum_thread_pool = "checksum",
+        -- How long a request waits for a computation in progress elsewhere (in seconds)
+        checksum_lock_timeout = 600,
+        -- How long a computed checksum is kept for waiting requests (in seconds)
+        checksum_result_ttl = 10,
+        -- Files at least this large are checksummed in this many regions in parallel
+        checksum_parallel_min_size = 256*1024*1024,
+        checksum_parallel_chunks = 4,
+        -- Digests computed while receiving a file, besides adler32 which is
+        -- always computed (any of "adler32", "crc32c", "md5")
+        upload_digests = {"adler32"},
+
+        -- This is used in tokenauth
+        -- Verified tokens kept per worker, until they expire
+        token_cache_lru_size = 1000,
+        -- Enforce storage.create and storage.modify as in the WLCG token
+        -- profile; when false, storage.read allows all operations under its
+        -- path, and the other storage scopes are ignored
+        wlcg_strict_scopes = false,
 
         -- discovery = "https://cms-auth.cern.ch/.well-known/openid-configuration",
         openidc_iss = "https://cms-auth.cern.ch/",
@@ -0,0 +1,214 @@
+local ngx = require("ngx")
+local statvfs = require("posix.sys.statvfs")
+local resty_lock = require("resty.lock")
+local config = require("config")
+local accessindex = require("accessindex")
+local cksumutil = require("cksumutil")
+local fileutil = require("fileutil")
+local nsfilter = require("nsfilter")
+local metrics = require("metrics")
+local metaindex = require("metaindex")
+
+-- Garbage collection of local_path, run by worker 0 every gc_interval.
+--
+-- With config gc_enabled, once the disk is more than gc_high_watermark full,
+-- the least recently read files (see accessindex) are deleted until it is
+-- back under gc_low_watermark. With cache_enabled, the files filled by the
+-- pull-through cache go first, and are also kept within cache_quota. Files under
+-- gc_pinned_prefixes are never deleted, and deletions are spaced out to at
+-- most gc_max_deletions_per_second so that they do not compete with serving.
+
+local diskgc = {}
+
+-- Only used by worker 0
+local running = false
+local last_rebuild = 0
+
+---@type function
+---@return integer? used, integer? total Disk usage of local_path, in bytes
+---Space reserved for root counts as used, as the server cannot write to it
+function diskgc.disk_usage()
+    local st, err = statvfs.statvfs(config.data.local_path)
+    if not st then
+        ngx.log(ngx.WARN, "Failed to get the disk usage of ", config.data.local_path, ": ", err)
+        return nil, nil
+    end
+    local total = st.f_blocks * st.f_frsize
+    return total - st.f_bavail * st.f_frsize, total
+end
+
+---@type function
+---@param key string
+---@return boolean pinned
+local function is_pinned(key)
+    for _, prefix in ipairs(config.data.gc_pinned_prefixes) do
+        if key:sub(1, #prefix) == prefix then
+            return true
+        end
+    end
+    return false
+end
+
+---@type function
+---@param entry IndexEntry
+---@param cached_only boolean
+---@return integer freed Bytes deleted
+local function delete(entry, cached_only)
+    -- The pass can take a while, so skip the files that were read or
+    -- replaced since it listed them
+    local current = accessindex.get(entry.key)
+    if not current or current.atime ~= entry.atime or current.size ~= entry.size then
+        return 0
+    end
+    local path = config.data.local_path .. entry.key
+    if cached_only then
+        -- A cached file that was overwritten by an upload is not cached anymore
+        local _, mark = cksumutil.getxattr(path, accessindex.CACHED_XATTR)
+        if not mark then
+            accessindex.add(entry.key, entry.size, entry.atime, false)
+            return 0
+        end
+    end
+    local ok, err = os.remove(path)
+    accessindex.remove(entry.key)
+    if not ok then
+        -- Most likely deleted since it was indexed
+        ngx.log(ngx.INFO, "Failed to delete ", entry.key, ": ", err)
+        return 0
+    end
+    cksumutil.invalidate(path)
+    nsfilter.record_remove(entry.key)
+    metaindex.remove(path)
+    ngx.log(ngx.INFO, "Deleted ", entry.key, " (", entry.size, " bytes, last read at ", entry.atime, ")")
+    return entry.size
+end
+
+---@type function
+---@param reason "watermark"|"cache_quota"
+---@param amount integer Bytes to reclaim
+---@param cached_only boolean Only delete files filled by the cache
+---@param rate number? Deletions per second, or nil for no limit
+---@return integer freed Bytes reclaimed
+---Delete the least recently read files until amount bytes are reclaimed
+local function reclaim(reason, amount, cached_only, rate)
+    if amount <= 0 then
+        return 0
+    end
+    local lock, err = resty_lock:new("access_index", {timeout = 0})
+    if not lock then
+        ngx.log(ngx.ERR, "Failed to create garbage collection lock: ", err)
+        return 0
+    end
+    if not lock:lock("lock") then
+        -- Someone else is already deleting
+        return 0
+    end
+
+    local freed, nfiles = 0, 0
+    for _, entry in ipairs(accessindex.lru(cached_only)) do
+        if freed >= amount then
+            break
+        end
+        if not is_pinned(entry.key) then
+            local deleted = delete(entry, cached_only)
+            if deleted > 0 then
+                freed = freed + deleted
+                nfiles = nfiles + 1
+                if rate and rate > 0 then
+                    ngx.sleep(1 / rate)
+                end
+            end
+        end
+    end
+    lock:unlock()
+    metrics.inc("nginx_webdav_gc_reclaimed_bytes_total", {reason = reason}, freed)
+    metrics.inc("nginx_webdav_gc_deleted_files_total", {reason = reason}, nfiles)
+    metrics.set("nginx_webdav_cache_usage_bytes", nil, accessindex.usage(true))
+    if nfiles > 0 then
+        ngx.log(ngx.NOTICE, "Reclaimed ", freed, " bytes in ", nfiles, " files (", reason, ")")
+    end
+    return freed
+end
+
+---@type function
+---@param target integer Bytes the cache may use
+---@return integer freed Bytes reclaimed
+---Delete the least recently read cached files until they fit in target
+function diskgc.evict_cached(target)
+    return reclaim("cache_quota", accessindex.usage(true) - target, true, nil)
+end
+
+---@type function
+---Rebuild the access index from the files on disk
+local function rebuild()
+    local generation = accessindex.begin_rebuild()
+    local nfiles = fileutil.walk(config.data.local_path, function(path, stat)
+        local cached = false
+        if config.data.cache_enabled then
+            local _, mark = cksumutil.getxattr(path, accessindex.CACHED_XATTR)
+            cached = mark ~= nil
+        end
+        accessindex.rebuild_add(nsfilter.key(path), stat.st_size, stat.st_atime, cached)
+    end)
+    local dropped = accessindex.end_rebuild(generation)
+    ngx.log(ngx.NOTICE, "Indexed ", nfiles, " files using ", accessindex.usage(), " bytes, dropped ", dropped)
+end
+
+---@type function
+local function publish_usage()
+    local used, total = diskgc.disk_usage()
+    if used then
+        metrics.set("nginx_webdav_disk_used_bytes", nil, used)
+        metrics.set("nginx_webdav_disk_size_bytes", nil, total)
+    end
+    metrics.set("nginx_webdav_cache_usage_bytes", nil, accessindex.usage(true))
+    return used, total
+end
+
+---@type function
+---@param premature boolean
+local function collect(premature)
+    if premature or running then
+        return
+    end
+    running = true
+    local ok, err = pcall(function()
+        if ngx.now() - last_rebuild >= config.data.gc_rescan_interval then
+            rebuild()
+            last_rebuild = ngx.now()
+        end
+        if config.data.cache_enabled then
+            diskgc.evict_cached(config.data.cache_quota)
+        end
+        local used, total = publish_usage()
+        if config.data.gc_enabled and used and used > config.data.gc_high_watermark * total then
+            local amount = used - config.data.gc_low_watermark * total
+            ngx.log(ngx.NOTICE, "Disk usage ", used, " of ", total, " bytes is over the high watermark, reclaiming ", amount)
+            local rate = config.data.gc_max_deletions_per_second
+            -- Cached copies can be filled again, so they go before uploaded files
+            local freed = 0
+            if config.data.cache_enabled then
+                freed = reclaim("watermark", amount, true, rate)
+            end
+            reclaim("watermark", amount - freed, false, rate)
+            used, total = publish_usage()
+            ngx.log(ngx.NOTICE, "Disk usage is now ", used, " of ", total, " bytes")
+        end
+    end)
+    running = false
+    if not ok then
+        ngx.log(ngx.ERR, "Garbage collection failed: ", err)
+    end
+end
+
+---@type function
+---Start the garbage collection timer, only called by worker 0
+function diskgc.start()
+    ngx.timer.at(0, collect)
+    local ok, err = ngx.timer.every(config.data.gc_interval, collect)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to create garbage collection timer: ", err)
+    end
+end
+
+return diskgc
@@ -0,0 +1,113 @@
+local ffi = require("ffi")
+
+-- The system calls used by filewriter, which can also be run in the write
+-- thread pool with ngx.run_worker_thread (see filewriter). Like cksumthread,
+-- this module is loaded in the thread's own Lua VM, so it must not depend on
+-- config or use ngx.log, and only plain values can be passed in and out.
+
+local filethread = {}
+
+ffi.cdef[[
+int open(const char *pathname, int flags, int mode);
+int close(int fd);
+ssize_t pwrite(int fd, const void *buf, size_t count, int64_t offset);
+int fallocate(int fd, int mode, int64_t offset, int64_t len);
+int ftruncate(int fd, int64_t length);
+int fsync(int fd);
+int fdatasync(int fd);
+int fcntl(int fd, int cmd, ...);
+int posix_memalign(void **memptr, size_t alignment, size_t size);
+void free(void *ptr);
+char *strerror(int errnum);
+]]
+
+local EINTR = 4
+
+-- Aligned buffer for O_DIRECT writes of this VM
+local aligned_buffer = nil
+local aligned_size = 0
+
+---@type function
+---@param what string
+---@return string err
+function filethread.errno_message(what)
+    local errno = ffi.errno()
+    return what .. ": " .. ffi.string(ffi.C.strerror(errno)) .. " (" .. errno .. ")"
+end
+
+---@type function
+---@param alignment integer
+---@param size integer
+---@return ffi.cdata*? buffer
+---Allocate a buffer of size bytes aligned for O_DIRECT, freed when collected
+function filethread.aligned_alloc(alignment, size)
+    local memptr = ffi.new("void *[1]")
+    if ffi.C.posix_memalign(memptr, alignment, size) ~= 0 then
+        return nil
+    end
+    return ffi.gc(ffi.cast("uint8_t *", memptr[0]), ffi.C.free)
+end
+
+---@type function
+---@param fd integer
+---@param ptr ffi.cdata*
+---@param len integer
+---@param offset integer
+---@param path string For error messages
+---@return string? err
+---Write len bytes from ptr at offset, retrying short writes
+function filethread.pwrite_all(fd, ptr, len, offset, path)
+    local written = 0
+    while written < len do
+        local ret = tonumber(ffi.C.pwrite(fd, ptr + written, len - written, offset + written))
+        if ret < 0 then
+            if ffi.errno() ~= EINTR then
+                return filethread.errno_message("failed to write to " .. path)
+            end
+        else
+            written = written + ret
+        end
+    end
+    return nil
+end
+
+---@type function
+---@param fd integer
+---@param data string
+---@param offset integer
+---@param path string For error messages
+---@param alignment integer If not 0, the fd is O_DIRECT and data is copied to an aligned buffer
+---@return string? err
+---Write data at offset
+function filethread.pwrite(fd, data, offset, path, alignment)
+    if alignment == 0 then
+        return filethread.pwrite_all(fd, ffi.cast("const uint8_t *", data), #data, offset, path)
+    end
+    if aligned_size < #data then
+        aligned_buffer = filethread.aligned_alloc(alignment, #data)
+        if not aligned_buffer then
+            aligned_size = 0
+            return "failed to allocate the O_DIRECT buffer"
+        end
+        aligned_size = #data
+    end
+    ffi.copy(aligned_buffer, data, #data)
+    return filethread.pwrite_all(fd, aligned_buffer, #data, offset, path)
+end
+
+---@type function
+---@param fd integer
+---@param how string "none", "fdatasync" or "fsync"
+---@param path string For error messages
+---@return string? err
+---Sync the written data to disk
+function filethread.sync(fd, how, path)
+    if how == "fsync" and ffi.C.fsync(fd) ~= 0 then
+        return filethread.errno_message("failed to fsync " .. path)
+    elseif how == "fdatasync" and ffi.C.fdatasync(fd) ~= 0 then
+        return filethread.errno_message("failed to fdatasync " .. path)
+    end
+    return nil
+end
+
+return filethread
@@ -1,6 +1,12 @@
 local sys_stat = require("posix.sys.stat")
+local resty_lock = require("resty.lock")
+local dirent = require("posix.dirent")
 local config = require("config")
 local cksumutil = require("cksumutil")
+local nsfilter = require("nsfilter")
+local accessindex = require("accessindex")
+local metaindex = require("metaindex")
+local filewriter = require("filewriter")
 
 local fileutil = {}
 
@@ -17,6 +23,23 @@ end
 ---@param want_adler32 boolean
 ---@return {exists:boolean, is_directory:boolean, size:integer, adler32:string}
 function fileutil.get_metadata(file_path, want_adler32)
+    local indexed = metaindex.get(file_path)
+    if indexed then
+        local err, adler32 = nil, indexed.adler32 or nil
+        if want_adler32 and not adler32 then
+            err, adler32 = cksumutil.get_adler32(file_path)
+            if not adler32 then
+                ngx.log(ngx.ERR, "Failed to get adler32 for " .. file_path .. " err: " .. err)
+            end
+        end
+        return {
+            exists = true,
+            is_directory = false,
+            size = indexed.size,
+            adler32 = adler32 or "",
+        }
+    end
+
     local stat = sys_stat.stat(file_path)
 
     if not stat then
@@ -33,13 +56,18 @@ function fileutil.get_metadata(file_path, want_adler32)
 
     local err = nil
     local adler32 = nil
-    if want_adler32 then
+    if want_adler32 and sys_stat.S_ISDIR(stat.st_mode) == 0 then
         err, adler32 = cksumutil.get_adler32(file_path)
         if not adler32 then
             ngx.log(ngx.ERR, "Failed to get adler32 for " .. file_path .. " err: " .. err)
         end
     end
 
+    if sys_stat.S_ISREG(stat.st_mode) ~= 0 then
+        -- So that the next lookup does not have to go to the disk
+        metaindex.add(file_path, stat.st_size, stat.st_mtime, adler32)
+    end
+
     return {
         exists = true,
         is_directory = sys_stat.S_ISDIR(stat.st_mode) ~= 0,
@@ -53,20 +81,22 @@ end
 ---@param start_time number
 ---@param last_transferred number
 ---@param now number
+---@param stripe_index integer?
+---@param stripe_count integer?
 ---@return nil
 ---Write a perf-marker-stream message to the client
-local function write_perfmarker(bytes_written, start_time, last_transferred, now)
+function fileutil.write_perfmarker(bytes_written, start_time, last_transferred, now, stripe_index, stripe_count)
     ngx.say("Perf Marker")
     ngx.say("    Timestamp: ", math.floor(now))
     ngx.say("    State: Running")
     ngx.say("    State description: transfer has started")
-    ngx.say("    Stripe Index: 0")
+    ngx.say("    Stripe Index: ", stripe_index or 0)
     ngx.say("    Stripe Start Time: ", math.floor(start_time))
     ngx.say("    Stripe Last Transferred: ", math.floor(last_transferred))
     ngx.say("    Stripe Transfer Time: ", math.floor(now - start_time))
     ngx.say("    Stripe Bytes Transferred: ", bytes_written)
     ngx.say("    Stripe Status: RUNNING")
-    ngx.say("    Total Stripe Count: 1")
+    ngx.say("    Total Stripe Count: ", stripe_count or 1)
     ngx.say("End")
     -- TODO: RemoteConnections information
     local ok, err = ngx.flush(true)
@@ -75,6 +105,29 @@ local function write_perfmarker(bytes_written, start_time, last_transferred, now
     end
 end
 
+---@type function
+---@param position integer Place of the transfer in the queue
+---@param now number
+---@return boolean ok Whether the marker could be sent to the client
+---Send a perf marker for a transfer that is waiting in the queue (see tpcqueue)
+function fileutil.write_queued_perfmarker(position, now)
+    ngx.say("Perf Marker")
+    ngx.say("    Timestamp: ", math.floor(now))
+    ngx.say("    State: Queued")
+    ngx.say("    State description: transfer is queued at position ", position)
+    ngx.say("    Stripe Index: 0")
+    ngx.say("    Stripe Bytes Transferred: 0")
+    ngx.say("    Stripe Status: QUEUED")
+    ngx.say("    Total Stripe Count: 1")
+    ngx.say("End")
+    local ok, err = ngx.flush(true)
+    if not ok then
+        ngx.log(ngx.ERR, "Failed to flush perf-marker-stream:", err)
+        return false
+    end
+    return true
+end
+
 local EEXIST = 17
 local DIRMODE = tonumber('755', 8)
 
@@ -104,25 +157,241 @@ function fileutil.mkdir(path, recursive)
     return nil, err
 end
 
+-- Extended attribute on a staging file recording how much of it was written
+-- and the adler32 of that, as "<length>:<adler32>", so that the upload can be
+-- resumed without reading the file back
+local STAGING_PROGRESS_XATTR = "user.nginx-webdav.staging"
+
+-- Writes staged by this worker under their own name
+local unique_staging_count = 0
+
+---@type function
+---@param file_path string
+---@param unique boolean? Stage under a name of its own
+---@return string staging_path
+---Where a file is written before being renamed into place at file_path.
+---Resumable uploads share one staging file per path, so that later requests
+---can continue them (see fileutil.lock_staging). Other writes are unique, so
+---that concurrent writers to the same path cannot mix their data.
+function fileutil.staging_path(file_path, unique)
+    local staging_path = config.data.staging_path .. "/" .. ngx.md5(file_path)
+    if unique then
+        unique_staging_count = unique_staging_count + 1
+        staging_path = staging_path .. "." .. ngx.worker.pid() .. "." .. unique_staging_count
+    end
+    return staging_path
+end
+
+---@type function
+---@param file_path string
+---@return table? lock, string? err
+---Lock the shared staging file of file_path, for a resumable upload to hold
+---while it checks and writes the staged data. Fails right away if another
+---request holds it.
+function fileutil.lock_staging(file_path)
+    local lock, err = resty_lock:new("staging_locks", {exptime = config.data.staging_lock_ttl, timeout = 0})
+    if not lock then
+        return nil, err
+    end
+    local ok
+    ok, err = lock:lock(fileutil.staging_path(file_path))
+    if not ok then
+        return nil, err
+    end
+    return lock, nil
+end
+
+---@type function
+---@param file_path string
+---@return integer? size
+---The size of the staged data for file_path, or nil if nothing is staged
+function fileutil.staged_size(file_path)
+    local stat = sys_stat.stat(fileutil.staging_path(file_path))
+    if not stat then
+        return nil
+    end
+    return stat.st_size
+end
+
+---@type function
+---@param file_path string
+---@return boolean removed
+---Remove the staged data for file_path, if any
+function fileutil.discard_staging(file_path)
+    return os.remove(fileutil.staging_path(file_path)) ~= nil
+end
+
+---@type function
+---@param file_path string
+---@param staging_path string
+---@param adler32 string? Of the staged data, for the metadata index
+---@return string? err
+---Atomically rename the staged data into place at file_path
+---The digests should be set on the staging file before, as the extended
+---attributes move with it
+function fileutil.commit_staging(file_path, staging_path, adler32)
+    local directory = file_path:match("(.*)/")
+    if directory then
+        fileutil.mkdir(directory, true)
+    end
+    local existed = sys_stat.stat(file_path) ~= nil
+    local suc, err = os.rename(staging_path, file_path)
+    if not suc then
+        return "failed to move the file into place: " .. err
+    end
+    cksumutil.invalidate(file_path)
+    if not existed then
+        nsfilter.record_add(nsfilter.key(file_path))
+    end
+    if accessindex.enabled() or metaindex.enabled() then
+        local stat = sys_stat.stat(file_path)
+        if stat then
+            accessindex.add(nsfilter.key(file_path), stat.st_size, ngx.now(), false)
+            metaindex.put(file_path, stat.st_size, stat.st_mtime, adler32)
+        end
+    end
+    return nil
+end
+
+---@type function
+---@param staging_path string
+---@param length integer
+---@return string? err, integer? adler32
+---The adler32 (as a number) of the first length bytes of a staging file,
+---from its progress attribute if it is up to date, otherwise read from disk
+local function staged_adler32(staging_path, length)
+    local _, progress = cksumutil.getxattr(staging_path, STAGING_PROGRESS_XATTR)
+    local progress_length, progress_adler32 = (progress or ""):match("^(%d+):(%d+)$")
+    if tonumber(progress_length) == length then
+        return nil, tonumber(progress_adler32)
+    end
+    ngx.log(ngx.NOTICE, "Reading back ", length, " staged bytes of ", staging_path, " to resume its adler32")
+    return cksumutil.compute_adler32_range(staging_path, 0, length)
+end
+
+---@type function
+---@param premature boolean
+---Remove staging files that have not been written to for staging_max_age,
+---i.e. uploads that were abandoned rather than interrupted
+function fileutil.cleanup_staging(premature)
+    if premature then
+        return
+    end
+    local ok, iter, state = pcall(dirent.files, config.data.staging_path)
+    if not ok then
+        return
+    end
+    local cutoff = ngx.time() - config.data.staging_max_age
+    for name in iter, state do
+        local path = config.data.staging_path .. "/" .. name
+        local stat = sys_stat.lstat(path)
+        if stat and sys_stat.S_ISREG(stat.st_mode) ~= 0 and stat.st_mtime < cutoff then
+            ngx.log(ngx.NOTICE, "Removing abandoned staging file ", path)
+            os.remove(path)
+        end
+    end
+end
+
+---@type function
+---@param directory string
+---@param callback fun(path: string, stat: table)
+---@param nfiles integer? Files seen so far, for the recursion
+---@return integer nfiles
+---Call callback with the path and lstat of every regular file under directory,
+---skipping the upload and staging area. Yields to the event loop every 1000
+---files, so it can run from a timer without starving the worker.
+function fileutil.walk(directory, callback, nfiles)
+    nfiles = nfiles or 0
+    local ok, iter, state = pcall(dirent.files, directory)
+    if not ok then
+        ngx.log(ngx.WARN, "Failed to scan ", directory, ": ", iter)
+        return nfiles
+    end
+    for name in iter, state do
+        if name ~= "." and name ~= ".." and not (directory == config.data.local_path and name == ".upload") then
+            local path = directory .. "/" .. name
+            local stat = sys_stat.lstat(path)
+            if stat and sys_stat.S_ISDIR(stat.st_mode) ~= 0 then
+                nfiles = fileutil.walk(path, callback, nfiles)
+            elseif stat and sys_stat.S_ISREG(stat.st_mode) ~= 0 then
+                callback(path, stat)
+                nfiles = nfiles + 1
+                if nfiles % 1000 == 0 then
+                    ngx.sleep(0)
+                end
+            end
+        end
+    end
+    return nfiles
+end
+
+---@type function
+---@param reader fun(max_chunk_size:integer): string?, string
+---@return fun(max_chunk_size:integer): string?, string
+---Wrap a reader of data pulled from another server (third party copies and
+---cache fills), counting it in ngx.ctx.pulled_bytes_received, as nginx only
+---accounts for the data that comes from the client
+function fileutil.pulled_reader(reader)
+    return function(max_chunk_size)
+        local buffer, err = reader(max_chunk_size)
+        if buffer then
+            ngx.ctx.pulled_bytes_received = (ngx.ctx.pulled_bytes_received or 0) + #buffer
+        end
+        return buffer, err
+    end
+end
+
+---@class ContentRange
+---@field first integer
+---@field last integer
+---@field total integer
+
 ---@type function
 ---@param file_path string
 ---@param reader fun(max_chunk_size:integer): string?, string
 ---@param perfmarkers boolean?
----@return string? err, string? adler32
+---@param range ContentRange? Part of the file being written, for resumed uploads
+---@param size integer? Length of the data from the reader, if known, to preallocate it
+---@return string? err, string? adler32, table<string, string>? digests
 ---
----Reads from the reader function and writes to the file_path.
+---Reads from the reader function and writes to the staging file of
+---file_path, which is renamed into place once it is complete.
 ---Returns nil if successful, otherwise an error message
----Also returns the adler32 checksum of the written data
+---Also returns the adler32 checksum of the written data, and all of the
+---digests computed in the same pass (see config upload_digests), once the
+---file is complete. A range that does not complete the file returns nil for
+---both. Only adler32 is computed for a file written in several ranges.
+---Writes with a range go to the shared staging file of file_path, which the
+---caller should hold the lock of (see fileutil.lock_staging), and it is kept
+---if the reader fails, so that the upload can be resumed by writing the rest
+---of it with a range starting at fileutil.staged_size. Other writes are
+---staged under a unique name, which is removed if they fail.
 ---Set perfmarkers to send text/perf-marker-stream messages to the client.
 ---  (if set, this function will call ngx.say to send messages and flush them)
-function fileutil.sink_to_file(file_path, reader, perfmarkers)
-    local directory = file_path:match("(.*)/")
-    if directory then
-        fileutil.mkdir(directory, true)
+function fileutil.sink_to_file(file_path, reader, perfmarkers, range, size)
+    fileutil.mkdir(config.data.staging_path, true)
+    local staging_path = fileutil.staging_path(file_path, range == nil)
+    local offset = range and range.first or 0
+    if range then
+        size = range.last - range.first + 1
+    end
+
+    local err
+    local prefix_adler32 = nil
+    local digest_states
+    if offset > 0 then
+        err, prefix_adler32 = staged_adler32(staging_path, offset)
+        if err then
+            return "failed to resume the adler32 of the staged data: " .. err
+        end
+        digest_states = cksumutil.digests_initialize({"adler32"})
+    else
+        digest_states = cksumutil.digests_initialize(cksumutil.upload_algorithms())
     end
-    local file, err = io.open(file_path, "w+b")
+    local file
+    file, err = filewriter.open(staging_path, {truncate = offset == 0, offset = offset, size = size, direct = true})
     if not file then
-        return "failed to open file: " .. err
+        return err
     end
 
     local buffer = nil
@@ -130,51 +399,166 @@ function fileutil.sink_to_file(file_path, reader, perfmarkers)
     local start_time = ngx.now()
     local last_perfmarker = start_time
     local last_transferred = start_time
-    local adler_state = cksumutil.adler32_initialize()
+    local read_failed = false
     repeat
         buffer, err = reader(config.data.receive_buffer_size)
         if err then
             err = "failed to read from the request socket: " .. err
+            read_failed = true
             goto cleanup
         end
         local now = ngx.now()
         if buffer then
-            file, err = file:write(buffer)
-            bytes_written = bytes_written + #buffer
-            last_transferred = now
-            cksumutil.adler32_increment(adler_state, buffer)
-            if not file then
-                err = "failed to write to the file: " .. err
+            local ok
+            ok, err = file:write(buffer)
+            if not ok then
                 goto cleanup
             end
+            bytes_written = bytes_written + #buffer
+            last_transferred = now
+            cksumutil.digests_increment(digest_states, buffer)
         end
         if perfmarkers and last_perfmarker + config.data.performance_marker_timeout <= now then
-            write_perfmarker(bytes_written, start_time, last_transferred, now)
+            fileutil.write_perfmarker(bytes_written, start_time, last_transferred, now)
             last_perfmarker = now
         end
     until not buffer
+    if range and bytes_written ~= range.last - range.first + 1 then
+        err = "received " .. bytes_written .. " bytes for a range of " .. (range.last - range.first + 1)
+        read_failed = true
+    end
     ::cleanup::
 
-    local suc, exitcode = file:close()
+    local suc, close_err = file:close()
     if not suc then
         -- This is more of an internal error
-        ngx.log(ngx.ERR, "failed to close " .. file_path .. ": " .. exitcode)
-        err = err or ("failed to close file: " .. exitcode)
+        ngx.log(ngx.ERR, close_err)
+        err = err or close_err
+        read_failed = false
     end
 
-    if err then
+    local adler32 = digest_states.adler32()
+    if prefix_adler32 then
+        adler32 = cksumutil.adler32_combine(prefix_adler32, adler32, bytes_written)
+    end
+    local staged = offset + bytes_written
+
+    if err and not (read_failed and range) then
         local rmerr
-        suc, rmerr = os.remove(file_path)
+        suc, rmerr = os.remove(staging_path)
         if not suc then
-            ngx.log(ngx.ERR, "failed to cleanup " .. file_path .. ": " .. rmerr)
+            ngx.log(ngx.ERR, "failed to cleanup " .. staging_path .. ": " .. rmerr)
+        end
+        return err
+    end
+
+    if err or (range and staged < range.total) then
+        -- Keep what we have, so that the client can resume from there
+        local set_err = cksumutil.setxattr(staging_path, STAGING_PROGRESS_XATTR, staged .. ":" .. adler32)
+        if set_err then
+            ngx.log(ngx.WARN, "Failed to record the progress of " .. staging_path .. ": " .. set_err)
         end
+        ngx.log(ngx.NOTICE, staged, " bytes staged for ", file_path)
+        return err
+    end
+
+    local digests = cksumutil.digests_to_strings(digest_states)
+    digests.adler32 = cksumutil.adler32_format(adler32)
+    if offset > 0 then
+        cksumutil.removexattr(staging_path, STAGING_PROGRESS_XATTR)
+    end
+    err = cksumutil.set_digests(staging_path, digests)
+    if err then
+        ngx.log(ngx.ERR, "Failed to set digests for " .. staging_path .. " err: " .. err)
+    end
+    err = fileutil.commit_staging(file_path, staging_path, digests.adler32)
+    if err then
+        os.remove(staging_path)
         return err
     end
+    ngx.log(ngx.NOTICE, staged, " total bytes written to ", file_path, " with adler32 ", digests.adler32)
+    return nil, digests.adler32, digests
+end
 
-    local adler32 = cksumutil.adler32_to_string(adler_state)
-    cksumutil.set_adler32(file_path, adler32)
-    ngx.log(ngx.NOTICE, bytes_written, " total bytes written to ", file_path, " with adler32 ", adler32)
-    return nil, adler32
+---@type function
+---@param file_path string
+---@param size integer
+---@return string? err
+---Create (or truncate) the file at file_path, sized to hold size bytes,
+---so that it can be written out of order with fileutil.sink_range.
+function fileutil.create_sized(file_path, size)
+    local directory = file_path:match("(.*)/")
+    if directory then
+        fileutil.mkdir(directory, true)
+    end
+    local err = filewriter.create_sized(file_path, size)
+    if err then
+        os.remove(file_path)
+        return err
+    end
+    return nil
+end
+
+---@class RangeProgress
+---@field bytes integer Bytes written so far
+---@field start_time number
+---@field last_transferred number
+---@field aborted boolean? Set by another thread to stop the write early
+
+---@type function
+---@param file_path string
+---@param offset integer
+---@param reader fun(max_chunk_size:integer): string?, string
+---@param progress RangeProgress? Updated as data is written, and checked for an abort
+---@return string? err, integer? adler32, integer? length
+---
+---Reads from the reader function and writes to the existing file at
+---file_path, starting at offset.
+---Returns nil if successful, otherwise an error message
+---Also returns the adler32 checksum (as a number) and length of the written data,
+---which can be combined with cksumutil.adler32_combine
+function fileutil.sink_range(file_path, offset, reader, progress)
+    local file, err = filewriter.open(file_path, {offset = offset})
+    if not file then
+        return err
+    end
+    local ok
+
+    local buffer = nil
+    local length = 0
+    local adler_state = cksumutil.adler32_initialize()
+    repeat
+        if progress and progress.aborted then
+            err = "aborted"
+            break
+        end
+        buffer, err = reader(config.data.receive_buffer_size)
+        if err then
+            err = "failed to read from the socket: " .. err
+            break
+        end
+        if buffer then
+            ok, err = file:write(buffer)
+            if not ok then
+                break
+            end
+            length = length + #buffer
+            cksumutil.adler32_increment(adler_state, buffer)
+            if progress then
+                progress.bytes = length
+                progress.last_transferred = ngx.now()
+            end
+        end
+    until not buffer
+
+    local suc, close_err = file:close()
+    if not suc then
+        err = err or close_err
+    end
+    if err then
+        return err
+    end
+    return nil, adler_state(), length
 end
 
 return fileutil
@@ -0,0 +1,339 @@
+local ffi = require("ffi")
+local config = require("config")
+local filethread = require("filethread")
+
+-- Writes files through a raw file descriptor with pwrite, rather than
+-- buffered Lua io. The file can be preallocated with fallocate when its size
+-- is known, to avoid fragmentation and to fail early when the disk is full,
+-- and large files can be written with O_DIRECT to keep them out of the page
+-- cache. What is synced to disk on close is set by config write_sync.
+--
+-- If config write_thread_pool is set, the writes themselves run in that
+-- thread pool (see filethread), so a slow disk does not block the worker.
+-- write returns as soon as a chunk is queued, so the caller can go on reading
+-- the next one, and only blocks when write_queue_depth chunks are in flight.
+
+local filewriter = {}
+
+-- Linux values
+local O_WRONLY = 0x1
+local O_CREAT = 0x40
+local O_TRUNC = 0x200
+local O_CLOEXEC = 0x80000
+local O_DIRECT = ffi.arch == "arm64" and 0x10000 or 0x4000
+local F_GETFL = 3
+local F_SETFL = 4
+local FALLOC_FL_KEEP_SIZE = 0x1
+local EOPNOTSUPP = 95
+local FILEMODE = tonumber('644', 8)
+
+---@class FileWriter
+---@field fd integer
+---@field guard ffi.cdata* Closes fd if the writer is garbage collected without being closed
+---@field path string
+---@field offset integer Where the next write goes
+---@field direct boolean Whether writes go through the aligned buffer with O_DIRECT
+---@field buffer ffi.cdata*? Aligned buffer for O_DIRECT
+---@field buffered integer Bytes in the aligned buffer
+---@field reserved integer End of the space preallocated without growing the file
+---@field pending ngx.thread[] Writes in flight in the thread pool, oldest first
+---@field err string? First error of a write in the thread pool
+local FileWriter = {}
+FileWriter.__index = FileWriter
+
+---@type function
+---@param fd integer
+---@return ffi.cdata* guard
+---The request can be aborted between open and close (timeouts, client
+---aborts, errors), so the fd is closed when the writer is garbage collected
+local function fd_guard(fd)
+    return ffi.gc(ffi.new("int[1]", fd), function(guard)
+        ffi.C.close(guard[0])
+    end)
+end
+
+---@type function
+---@param writer FileWriter
+---@return integer ret Of close(2)
+---Close the fd now, disarming its guard
+local function close_fd(writer)
+    ffi.gc(writer.guard, nil)
+    local ret = ffi.C.close(writer.fd)
+    writer.fd = -1
+    return ret
+end
+
+---@type function
+---@param path string
+---@param options {truncate: boolean?, offset: integer?, size: integer?, direct: boolean?}
+---@return FileWriter? writer, string? err
+---Open path for writing at options.offset (default 0), creating it if needed.
+---If options.size is the number of bytes that will be written, the space is
+---preallocated without changing the file size. options.direct asks for
+---O_DIRECT, which is only used if the offset is aligned and the file is at
+---least config write_direct_min_size.
+function filewriter.open(path, options)
+    local offset = options.offset or 0
+    local alignment = config.data.write_direct_alignment
+    local direct = options.direct and options.size ~= nil
+        and config.data.write_direct_min_size > 0
+        and offset + options.size >= config.data.write_direct_min_size
+        and offset % alignment == 0
+    local flags = bit.bor(O_WRONLY, O_CREAT, O_CLOEXEC)
+    if options.truncate then
+        flags = bit.bor(flags, O_TRUNC)
+    end
+    if direct then
+        flags = bit.bor(flags, O_DIRECT)
+    end
+    local fd = ffi.C.open(path, flags, FILEMODE)
+    if fd < 0 and direct then
+        -- Not all filesystems support O_DIRECT
+        direct = false
+        fd = ffi.C.open(path, bit.band(flags, bit.bnot(O_DIRECT)), FILEMODE)
+    end
+    if fd < 0 then
+        return nil, filethread.errno_message("failed to open " .. path)
+    end
+
+    local writer = setmetatable({
+        fd = fd,
+        guard = fd_guard(fd),
+        path = path,
+        offset = offset,
+        direct = direct,
+        buffer = nil,
+        buffered = 0,
+        reserved = 0,
+        pending = {},
+        err = nil,
+    }, FileWriter)
+
+    if direct then
+        writer.buffer = filethread.aligned_alloc(alignment, config.data.write_direct_buffer_size)
+        if not writer.buffer then
+            close_fd(writer)
+            return nil, "failed to allocate the O_DIRECT buffer"
+        end
+    end
+
+    if options.size and options.size > 0 then
+        if ffi.C.fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, options.size) == 0 then
+            writer.reserved = offset + options.size
+        elseif ffi.errno() ~= EOPNOTSUPP then
+            local err = filethread.errno_message("failed to preallocate " .. options.size .. " bytes for " .. path)
+            close_fd(writer)
+            return nil, err
+        end
+    end
+    return writer
+end
+
+---@type function
+---@param path string
+---@param size integer
+---@return string? err
+---Create (or truncate) the file at path with size bytes allocated
+function filewriter.create_sized(path, size)
+    local writer, err = filewriter.open(path, {truncate = true})
+    if not writer then
+        return err
+    end
+    if size > 0 and ffi.C.fallocate(writer.fd, 0, 0, size) ~= 0 then
+        if ffi.errno() ~= EOPNOTSUPP or ffi.C.ftruncate(writer.fd, size) ~= 0 then
+            err = filethread.errno_message("failed to size " .. path)
+        end
+    end
+    close_fd(writer)
+    return err
+end
+
+---@type function
+---@param fd integer
+---@param data string
+---@param offset integer
+---@param path string
+---@param alignment integer
+---@return string? err
+local function threaded_pwrite(fd, data, offset, path, alignment)
+    local ok, err = ngx.run_worker_thread(
+        config.data.write_thread_pool, "filethread", "pwrite", fd, data, offset, path, alignment
+    )
+    if not ok then
+        return "failed to run write in thread pool: " .. tostring(err)
+    end
+    return err
+end
+
+---@type function
+---@param self FileWriter
+---@return boolean? ok, string? err
+---Wait for the oldest write in flight
+local function wait_oldest(self)
+    local co = table.remove(self.pending, 1)
+    local ok, err = ngx.thread.wait(co)
+    if not ok then
+        err = "write thread failed: " .. tostring(err)
+    end
+    if err and not self.err then
+        self.err = err
+    end
+    if self.err then
+        return nil, self.err
+    end
+    return true
+end
+
+---@type function
+---@param self FileWriter
+---@return boolean? ok, string? err
+---Wait for all of the writes in flight
+local function wait_all(self)
+    while #self.pending > 0 do
+        wait_oldest(self)
+    end
+    if self.err then
+        return nil, self.err
+    end
+    return true
+end
+
+---@type function
+---@param self FileWriter
+---@param ptr ffi.cdata*
+---@param len integer
+---@param data string? ptr as a Lua string, if it is one
+---@return boolean? ok, string? err
+---Write len bytes at the current offset, in the thread pool if configured
+local function submit(self, ptr, len, data)
+    if self.err then
+        return nil, self.err
+    end
+    local offset = self.offset
+    self.offset = self.offset + len
+    if config.data.write_thread_pool == "" then
+        local err = filethread.pwrite_all(self.fd, ptr, len, offset, self.path)
+        if err then
+            return nil, err
+        end
+        return true
+    end
+
+    -- Bound the memory held by this transfer
+    while #self.pending >= config.data.write_queue_depth do
+        local ok, err = wait_oldest(self)
+        if not ok then
+            return nil, err
+        end
+    end
+    local alignment = self.direct and config.data.write_direct_alignment or 0
+    local co, err = ngx.thread.spawn(threaded_pwrite, self.fd, data or ffi.string(ptr, len), offset, self.path, alignment)
+    if not co then
+        self.err = "failed to spawn write thread: " .. err
+        return nil, self.err
+    end
+    table.insert(self.pending, co)
+    return true
+end
+
+---@type function
+---@param self FileWriter
+---@return boolean? ok, string? err
+---Write out the whole blocks in the O_DIRECT buffer
+local function flush_direct(self)
+    local alignment = config.data.write_direct_alignment
+    local len = self.buffered - self.buffered % alignment
+    if len == 0 then
+        return true
+    end
+    local ok, err = submit(self, self.buffer, len)
+    if not ok then
+        return nil, err
+    end
+    ffi.copy(self.buffer, self.buffer + len, self.buffered - len)
+    self.buffered = self.buffered - len
+    return true
+end
+
+---@type function
+---@param buf string
+---@return boolean? ok, string? err
+---Write all of buf at the current offset
+function FileWriter:write(buf)
+    if not self.direct then
+        return submit(self, ffi.cast("const uint8_t *", buf), #buf, buf)
+    end
+    local size = config.data.write_direct_buffer_size
+    local src = ffi.cast("const uint8_t *", buf)
+    local remaining = #buf
+    while remaining > 0 do
+        local len = math.min(remaining, size - self.buffered)
+        ffi.copy(self.buffer + self.buffered, src, len)
+        self.buffered = self.buffered + len
+        src = src + len
+        remaining = remaining - len
+        if self.buffered == size then
+            local ok, err = flush_direct(self)
+            if not ok then
+                return nil, err
+            end
+        end
+    end
+    return true
+end
+
+---@type function
+---@return boolean? ok, string? err
+---Write out anything buffered, wait for the writes in flight, release
+---preallocated space that was not written, sync according to config
+---write_sync, and close the file
+function FileWriter:close()
+    local ok, err = true, nil
+    if self.direct then
+        ok, err = flush_direct(self)
+        if ok then
+            ok, err = wait_all(self)
+        end
+        if ok and self.buffered > 0 then
+            -- The tail is not a whole block, so write it without O_DIRECT
+            local flags = ffi.C.fcntl(self.fd, F_GETFL)
+            ffi.C.fcntl(self.fd, F_SETFL, ffi.new("int", bit.band(flags, bit.bnot(O_DIRECT))))
+            self.direct = false
+            ok, err = submit(self, self.buffer, self.buffered)
+            self.buffered = 0
+        end
+    end
+    -- The fd must stay open until every write is done, even after an error
+    local wait_ok, wait_err = wait_all(self)
+    if ok and not wait_ok then
+        ok, err = nil, wait_err
+    end
+    self.buffer = nil
+    if self.reserved > self.offset then
+        -- An incomplete file should not keep its blocks past the end
+        ffi.C.ftruncate(self.fd, self.offset)
+    end
+    if ok and config.data.write_sync ~= "none" then
+        local sync_err
+        if config.data.write_thread_pool == "" then
+            sync_err = filethread.sync(self.fd, config.data.write_sync, self.path)
+        else
+            local thread_ok
+            thread_ok, sync_err = ngx.run_worker_thread(
+                config.data.write_thread_pool, "filethread", "sync", self.fd, config.data.write_sync, self.path
+            )
+            if not thread_ok then
+                sync_err = "failed to run sync in thread pool: " .. tostring(sync_err)
+            end
+        end
+        if sync_err then
+            ok, err = nil, sync_err
+        end
+    end
+    if close_fd(self) ~= 0 and ok then
+        ok, err = nil, filethread.errno_message("failed to close " .. self.path)
+    end
+    return ok, err
+end
+
+return filewriter
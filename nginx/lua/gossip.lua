@@ -1,35 +1,135 @@
 local ngx = require("ngx")
 local cjson = require("cjson")
+local resty_lock = require("resty.lock")
+local statvfs = require("posix.sys.statvfs")
 local config = require("config")
+local metrics = require("metrics")
+local nsfilter = require("nsfilter")
+local locationcache = require("locationcache")
 
 local Gossip = {
 }
 
+-- Per-worker cache of decoded peer namespace summaries
+---@type table<string, DecodedSummary>
+local peer_filters = {}
+
 ---@class PeerData
 ---@field epoch integer Monotonic increasing number that is incremented by the peer
 ---@field status string Current server status (TODO: enum?)
 ---@field timestamp integer UNIX time of the last update
 ---@field server_version string Version of the server
 ---@field failures integer Number of failures to exchange gossip with this peer (from us or any other peer)
+---@field summary NamespaceSummary? Bloom filter of the files held by the peer
+---@field load PeerLoad? How busy the peer is, used to choose between replicas
+
+---@class PeerLoad
+---@field disk_free integer Bytes available to the server on its data disk
+---@field disk_total integer Size of its data disk in bytes
+---@field requests integer WebDAV requests in progress
+---@field throughput number Bytes per second sent and received, recently
+
+
+-- Membership is stored in the gossip_data shared dict as:
+--   peers: JSON array of peer names, rewritten under the gossip_locks lock
+--   peer:<name>: set for each member, for O(1) membership checks
+--   peers_generation: incremented on every change of the list
+-- Each worker keeps a decoded copy of the list, rebuilt only when the
+-- generation changes.
+---@type {generation: integer?, peers: table<string, boolean>}
+local peer_cache = {generation = nil, peers = {}}
 
+---@type function
+---@param fn function
+---@return any result
+---Run fn while holding the lock on the peer list
+local function with_peers_lock(fn)
+    local lock, err = resty_lock:new("gossip_locks")
+    if not lock then
+        ngx.log(ngx.ERR, "Failed to create peer list lock: ", err)
+        return nil
+    end
+    local elapsed
+    elapsed, err = lock:lock("peers")
+    if not elapsed then
+        ngx.log(ngx.ERR, "Failed to lock peer list: ", err)
+        return nil
+    end
+    local ok, result = pcall(fn)
+    lock:unlock()
+    if not ok then
+        ngx.log(ngx.ERR, "Error while updating peer list: ", result)
+        return nil
+    end
+    return result
+end
+
+---@type function
+---@return string[]? peerlist
+local function load_peerlist()
+    local peerlist = ngx.shared.gossip_data:get("peers")
+    if not peerlist then
+        return nil
+    end
+    ---@cast peerlist string
+    return cjson.decode(peerlist)
+end
+
+---@type function
+---@param peerlist string[]
+---Store the peer list, must be called with the peer list lock held
+local function store_peerlist(peerlist)
+    ngx.shared.gossip_data:set("peers", cjson.encode(peerlist))
+    ngx.shared.gossip_data:incr("peers_generation", 1, 0)
+end
+
+---@type function
+---@return string[] peerlist
+---Initialize the peer list from the seed peers, must be called with the lock held
+local function seed_peerlist()
+    local peerlist = {}
+    local seen = {}
+    for peer in string.gmatch(config.data.seed_peers, "[^,]+") do
+        if not seen[peer] then
+            seen[peer] = true
+            ngx.shared.gossip_data:set("peer:" .. peer, true)
+            table.insert(peerlist, peer)
+        end
+    end
+    store_peerlist(peerlist)
+    return peerlist
+end
 
 ---@type function
 ---@return table<string, boolean> peers, boolean starting
 ---Return a list of the current peers, and a boolean
 ---indicating if this is the first time this worker is started
+---The returned table is shared and must not be modified
 function Gossip.peers()
-    local peerstr = ngx.shared.gossip_data:get("peers")
+    -- Read the generation before the list, so a concurrent update at worst
+    -- causes one extra reload
+    local generation = ngx.shared.gossip_data:get("peers_generation")
+    if generation ~= nil and generation == peer_cache.generation then
+        return peer_cache.peers, false
+    end
     local starting = false
-    if not peerstr then
-        peerstr = config.data.seed_peers .. ","
-        ngx.shared.gossip_data:set("peers", peerstr)
-        starting = true
+    local peerlist = load_peerlist()
+    if not peerlist then
+        peerlist = with_peers_lock(function()
+            local current = load_peerlist()
+            if current then
+                return current
+            end
+            starting = true
+            return seed_peerlist()
+        end) or {}
+        generation = ngx.shared.gossip_data:get("peers_generation")
     end
     local peers = {}
-    ---@cast peerstr string
-    for peer in string.gmatch(peerstr, "[^,]+") do
+    for _, peer in ipairs(peerlist) do
         peers[peer] = true
     end
+    peer_cache = {generation = generation, peers = peers}
     return peers, starting
 end
 
@@ -38,35 +138,52 @@ end
 ---Add a peer to the list of peers
 ---No op if the peer is already in the list
 function Gossip.add_peer(peer)
-    local peerstr = ngx.shared.gossip_data:get("peers")
-    ---@cast peerstr string
-    if peerstr:find(peer, 1, true) == nil then
-        ngx.shared.gossip_data:set("peers", peerstr .. peer .. ",")
+    if ngx.shared.gossip_data:get("peer:" .. peer) then
+        return
     end
+    with_peers_lock(function()
+        local peerlist = load_peerlist() or seed_peerlist()
+        if ngx.shared.gossip_data:get("peer:" .. peer) then
+            return
+        end
+        ngx.shared.gossip_data:set("peer:" .. peer, true)
+        table.insert(peerlist, peer)
+        store_peerlist(peerlist)
+    end)
 end
 
 ---@type function
 ---@param peer string
 ---Remove a peer from the list of peers
 function Gossip.remove_peer(peer)
-    -- Flush any timestamp
+    -- Flush any timestamp and namespace summary
     ngx.shared.gossip_data:set("timestamp:" .. peer, nil)
-    local peerstr = ngx.shared.gossip_data:get("peers")
-    ---@cast peerstr string
-    local pos, endpos = peerstr:find(peer, 1, true)
-    if not pos then
-        ngx.log(ngx.WARN, "Logic error: peer " .. peer .. " not found in peerstr: " .. peerstr)
+    ngx.shared.gossip_data:set("summary:" .. peer, nil)
+    ngx.shared.gossip_data:set("summary_version:" .. peer, nil)
+    ngx.shared.gossip_data:set("load:" .. peer, nil)
+    locationcache.invalidate_peer(peer)
+    if not ngx.shared.gossip_data:get("peer:" .. peer) then
+        -- Another request already removed it
+        ngx.log(ngx.INFO, "Peer " .. peer .. " is not in the peer list")
         return
     end
-    -- Account for trailing comma
-    endpos = endpos + 1
-    local new_peerstr = peerstr:sub(1, pos - 1) .. peerstr:sub(endpos + 1)
-    if new_peerstr == "" then
-        -- the next call to peers() will reinitialize from the seed_peers
-        ngx.shared.gossip_data:set("peers", nil)
-    else
-        ngx.shared.gossip_data:set("peers", new_peerstr)
-    end
+    with_peers_lock(function()
+        local peerlist = load_peerlist() or {}
+        local remaining = {}
+        for _, name in ipairs(peerlist) do
+            if name ~= peer then
+                table.insert(remaining, name)
+            end
+        end
+        ngx.shared.gossip_data:delete("peer:" .. peer)
+        if #remaining == 0 then
+            -- the next call to peers() will reinitialize from the seed_peers
+            ngx.shared.gossip_data:delete("peers")
+            ngx.shared.gossip_data:incr("peers_generation", 1, 0)
+        else
+            store_peerlist(remaining)
+        end
+    end)
 end
 
 ---@type function
@@ -81,7 +198,25 @@ function Gossip.get_peerdata(peer)
     local timestamp = ngx.shared.gossip_data:get("timestamp:" .. peer)
     local server_version = ngx.shared.gossip_data:get("server_version:" .. peer)
     local failures = ngx.shared.gossip_data:get("failures:" .. peer)
-    return {epoch = epoch, status = status, timestamp = timestamp, server_version = server_version, failures = failures}
+    local summary = ngx.shared.gossip_data:get("summary:" .. peer)
+    if summary then
+        ---@cast summary string
+        summary = cjson.decode(summary)
+    end
+    local load = ngx.shared.gossip_data:get("load:" .. peer)
+    if load then
+        ---@cast load string
+        load = cjson.decode(load)
+    end
+    return {
+        epoch = epoch,
+        status = status,
+        timestamp = timestamp,
+        server_version = server_version,
+        failures = failures,
+        summary = summary,
+        load = load,
+    }
 end
 
 ---@type function
@@ -93,6 +228,17 @@ function Gossip.set_peerdata(peer, peerdata)
     ngx.shared.gossip_data:set("timestamp:" .. peer, peerdata.timestamp)
     ngx.shared.gossip_data:set("server_version:" .. peer, peerdata.server_version)
     ngx.shared.gossip_data:set("failures:" .. peer, peerdata.failures)
+    if type(peerdata.load) == "table" then
+        ngx.shared.gossip_data:set("load:" .. peer, cjson.encode(peerdata.load))
+    end
+    if type(peerdata.summary) == "table" then
+        -- Only replace the summary when it is newer, to spare the decoding in /redirect
+        local version = ngx.shared.gossip_data:get("summary_version:" .. peer)
+        if not version or version < peerdata.summary.version then
+            ngx.shared.gossip_data:set("summary:" .. peer, cjson.encode(peerdata.summary))
+            ngx.shared.gossip_data:set("summary_version:" .. peer, peerdata.summary.version)
+        end
+    end
 end
 
 ---@type function
@@ -123,6 +269,94 @@ function Gossip.update_peerdata(peer, peerdata)
 end
 
 
+---@type function
+---@return PeerLoad load
+---Measure our own load. The throughput is averaged over at least
+---config load_sample_interval, between calls.
+local function local_load()
+    local dict = ngx.shared.gossip_data
+    local now = ngx.now()
+    local bytes = metrics.sum("nginx_webdav_sent_bytes_total") + metrics.sum("nginx_webdav_received_bytes_total")
+        + metrics.sum("nginx_webdav_pulled_bytes_total")
+    local sample_time = dict:get("load_sample_time")
+    if not sample_time or now - sample_time >= config.data.load_sample_interval then
+        if sample_time and now > sample_time then
+            dict:set("load_throughput", (bytes - dict:get("load_sample_bytes")) / (now - sample_time))
+        end
+        dict:set("load_sample_bytes", bytes)
+        dict:set("load_sample_time", now)
+    end
+
+    local load = {
+        disk_free = 0,
+        disk_total = 0,
+        requests = metrics.sum("nginx_webdav_requests_in_progress"),
+        throughput = dict:get("load_throughput") or 0,
+    }
+    local st, err = statvfs.statvfs(config.data.local_path)
+    if st then
+        load.disk_free = st.f_bavail * st.f_frsize
+        load.disk_total = st.f_blocks * st.f_frsize
+    else
+        ngx.log(ngx.WARN, "Failed to get the disk usage of ", config.data.local_path, ": ", err)
+    end
+    return load
+end
+
+---@type function
+---@param peer string
+---@return PeerLoad? load The load last published by the peer
+function Gossip.get_load(peer)
+    local load = ngx.shared.gossip_data:get("load:" .. peer)
+    if not load then
+        return nil
+    end
+    ---@cast load string
+    return cjson.decode(load)
+end
+
+---@type function
+---@param peer string
+---@return boolean alive True if the last we heard of the peer is that it is alive
+function Gossip.is_alive(peer)
+    return ngx.shared.gossip_data:get("status:" .. peer) == "alive"
+end
+
+---@type function
+---@param peer string
+---@return number weight How much traffic the peer should get relative to others
+---See config redirect_load_requests. Peers that do not publish their load get
+---the weight of a half full, idle peer.
+function Gossip.peer_weight(peer)
+    local load = Gossip.get_load(peer)
+    if not load then
+        return 0.5
+    end
+    local free = 0.5
+    if load.disk_total > 0 then
+        free = load.disk_free / load.disk_total
+    end
+    return free
+        / (1 + load.requests / config.data.redirect_load_requests)
+        / (1 + load.throughput / config.data.redirect_load_throughput)
+end
+
+---@type function
+---@return PeerData selfdata
+---Update our own data, incrementing our epoch
+function Gossip.update_self()
+    local selfdata = Gossip.get_peerdata(config.data.server_address)
+    selfdata.epoch = selfdata.epoch + 1
+    selfdata.status = "alive"
+    selfdata.timestamp = ngx.now()
+    selfdata.server_version = config.data.server_version
+    selfdata.failures = 0
+    selfdata.summary = nsfilter.local_summary()
+    selfdata.load = local_load()
+    Gossip.set_peerdata(config.data.server_address, selfdata)
+    return selfdata
+end
+
 ---@type function
 ---@return string message
 ---Prepare a message to send to peers representing our current view of the network
@@ -139,13 +373,7 @@ function Gossip.prepare_message()
     end
 
     -- Update our own data
-    local selfdata = Gossip.get_peerdata(config.data.server_address)
-    selfdata.epoch = selfdata.epoch + 1
-    selfdata.status = "alive"
-    selfdata.timestamp = ngx.now()
-    selfdata.server_version = config.data.server_version
-    selfdata.failures = 0
-    Gossip.set_peerdata(config.data.server_address, selfdata)
+    local selfdata = Gossip.update_self()
     table.insert(message, {
         name = config.data.server_address,
         data = selfdata,
@@ -154,19 +382,100 @@ function Gossip.prepare_message()
     return cjson.encode(message)
 end
 
+---@alias GossipDigest table<string, number[]> peer name -> {timestamp, summary version}
+
+---@class DeltaMessage
+---@field format "delta"
+---@field digest GossipDigest Our view of the network
+---@field updates {name: string, data: PeerData}[] Entries the recipient is missing or has stale
+
+---@type function
+---@param remote_digest GossipDigest? The recipient's view of the network, if known
+---@return DeltaMessage message
+---Prepare a delta message containing a digest of our view of the network,
+---and only the entries that are newer than what the recipient is known to have.
+---Does not update our own data, call Gossip.update_self first.
+function Gossip.prepare_delta(remote_digest)
+    local peers, _ = Gossip.peers()
+    local names = {config.data.server_address}
+    for peer, _ in pairs(peers) do
+        if peer ~= config.data.server_address then
+            table.insert(names, peer)
+        end
+    end
+
+    local digest = {}
+    local updates = {}
+    for _, peer in ipairs(names) do
+        local peerdata = Gossip.get_peerdata(peer)
+        local summary_version = peerdata.summary and peerdata.summary.version or 0
+        digest[peer] = {peerdata.timestamp, summary_version}
+        local known = remote_digest and remote_digest[peer]
+        if not known or known[1] < peerdata.timestamp then
+            if known and known[2] == summary_version then
+                -- The summary is by far the largest field, only send it when it changed
+                peerdata.summary = nil
+            end
+            table.insert(updates, {name = peer, data = peerdata})
+        end
+    end
+    return {format = "delta", digest = digest, updates = updates}
+end
+
 ---@type function
 ---@param message string
+---@return DeltaMessage? delta
 ---Handle a message received from a peer
+---If it is a delta message it is returned, so that a reply can be prepared
+---with Gossip.prepare_delta using its digest.
 function Gossip.handle_message(message)
     local peerdata = cjson.decode(message)
-    if type(peerdata) == "table" then
-        for _, peerinfo in ipairs(peerdata) do
-            -- Ignore our own data
-            if peerinfo.name ~= config.data.server_address then
-                Gossip.update_peerdata(peerinfo.name, peerinfo.data)
-            end
+    if type(peerdata) ~= "table" then
+        return nil
+    end
+    local entries = peerdata
+    local delta = nil
+    if peerdata.format == "delta" then
+        entries = peerdata.updates or {}
+        delta = peerdata
+    end
+    for _, peerinfo in ipairs(entries) do
+        -- Ignore our own data
+        if peerinfo.name ~= config.data.server_address then
+            Gossip.update_peerdata(peerinfo.name, peerinfo.data)
+        end
+    end
+    return delta
+end
+
+---@type function
+---@param peer string
+---@param key string Path of the file relative to the webdav root
+---@return boolean maybe
+---False if the namespace summary published by the peer rules out the file
+---Peers that do not publish a summary may have any file
+function Gossip.may_have_file(peer, key)
+    local version = ngx.shared.gossip_data:get("summary_version:" .. peer)
+    if not version then
+        return true
+    end
+    local decoded = peer_filters[peer]
+    if not decoded or decoded.version ~= version then
+        local summary = ngx.shared.gossip_data:get("summary:" .. peer)
+        if not summary then
+            return true
+        end
+        ---@cast summary string
+        local err
+        decoded, err = nsfilter.decode(cjson.decode(summary))
+        if not decoded then
+            ngx.log(ngx.WARN, "Invalid namespace summary from peer ", peer, ": ", err)
+            peer_filters[peer] = nil
+            return true
         end
+        peer_filters[peer] = decoded
     end
+    return nsfilter.contains(decoded, key)
 end
 
 ---@type function
@@ -180,6 +489,7 @@ function Gossip.handle_peer_error(peer, err)
     -- failures at the same time, but this just undercounts the failures
     ngx.shared.gossip_data:set("timestamp:" .. peer, ngx.now())
     ngx.shared.gossip_data:set("status:" .. peer, "failed: " .. err)
+    locationcache.invalidate_peer(peer)
     if failures and failures >= config.data.gossip_max_failures then
         ngx.log(ngx.NOTICE, "Peer " .. peer .. " failed " .. failures .. " times, removing from list")
         Gossip.remove_peer(peer)
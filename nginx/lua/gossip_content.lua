@@ -1,17 +1,43 @@
+local cjson = require("cjson")
+local zlib = require("zlib")
+local config = require("config")
 local gossip = require("gossip")
 
 -- If the request method is a POST, then it is a peer
 -- contacting us with its gossip update and we need to handle it
+local delta = nil
 if ngx.var.request_method == "POST" then
     ngx.req.read_body()
     local data = ngx.req.get_body_data()
+    if data and ngx.var.http_content_encoding == "deflate" then
+        local ok, inflated = pcall(function() return zlib.inflate()(data) end)
+        if not ok then
+            ngx.status = ngx.HTTP_BAD_REQUEST
+            ngx.say("failed to inflate request body")
+            return ngx.exit(ngx.OK)
+        end
+        data = inflated
+    end
     if data then
-        gossip.handle_message(data)
+        delta = gossip.handle_message(data)
     end
 end
 
 -- Prepare gossip message
-local message = gossip.prepare_message()
+local message
+if delta or ngx.var.http_x_gossip_protocol == "delta" then
+    -- Reply with only what the sender is missing, or everything if the
+    -- sender sent its full view but can take a delta in reply
+    gossip.update_self()
+    message = cjson.encode(gossip.prepare_delta(delta and delta.digest))
+else
+    message = gossip.prepare_message()
+end
+
+if config.data.gossip_compression and (ngx.var.http_accept_encoding or ""):find("deflate", 1, true) then
+    message = zlib.deflate()(message, "finish")
+    ngx.header["Content-Encoding"] = "deflate"
+end
 
 -- Send the message
 ngx.status = ngx.HTTP_OK
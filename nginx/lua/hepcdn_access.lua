@@ -1,6 +1,5 @@
 local ngx = require("ngx")
-local openidc = require("resty.openidc")
-local config = require("config")
+local tokenauth = require("tokenauth")
 
 if not ngx.var.http_authorization then
     ngx.status = ngx.HTTP_UNAUTHORIZED
@@ -9,32 +8,26 @@ if not ngx.var.http_authorization then
     return ngx.exit(ngx.OK)
 end
 
-local opts = {
-    public_key = config.data.openidc_pubkey,
-    token_signing_alg_values_expected = { "RS256" }
-}
--- call bearer_jwt_verify for OAuth 2.0 JWT validation
-local res, err = openidc.bearer_jwt_verify(opts)
-
-if err or not res then
+local token, err = tokenauth.verify()
+if not token then
     ngx.status = ngx.HTTP_UNAUTHORIZED
-    ngx.say(err and err or "no access token provided")
+    ngx.say(err)
     return ngx.exit(ngx.OK)
 end
 
 -- Set the oidc_user, for use in access log
-ngx.var.oidc_user = res.sub
+ngx.var.oidc_user = token.sub
 
 local is_read = ngx.var.request_method == "GET" or ngx.var.request_method == "HEAD"
-if is_read and string.find(res.scope, "hepcdn.view") == nil and string.find(res.scope, "hepcdn.access") == nil then
+if is_read and not token.capabilities.hepcdn_view then
     ngx.status = ngx.HTTP_FORBIDDEN
     ngx.say("no permission to read this resource")
     return ngx.exit(ngx.OK)
 end
 
 local is_post = ngx.var.request_method == "POST"
-if is_post and string.find(res.scope, "hepcdn.access") == nil then
+if is_post and not token.capabilities.hepcdn_access then
     ngx.status = ngx.HTTP_FORBIDDEN
     ngx.say("no permission to modify this resource")
     return ngx.exit(ngx.OK)
-end
\ No newline at end of file
+end
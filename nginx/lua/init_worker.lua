@@ -3,6 +3,14 @@ local resty_http = require("resty.http")
 local jwt = require("resty.jwt")
 local cjson = require("cjson")
 local gossip = require("gossip")
+local nsfilter = require("nsfilter")
+local fileutil = require("fileutil")
+local peerclient = require("peerclient")
+local zlib = require("zlib")
+local metrics = require("metrics")
+local accessindex = require("accessindex")
+local diskgc = require("diskgc")
+local metaindex = require("metaindex")
 
 -- if file does not exist, we take the default values
 config.load("/etc/nginx/lua/config.json")
@@ -12,52 +20,124 @@ if ngx.worker.id() ~= 0 then
     return
 end
 
+-- The namespace summary is maintained even when we are not part of a cluster
+nsfilter.start()
+
+local ok, err = ngx.timer.every(config.data.staging_cleanup_interval, fileutil.cleanup_staging)
+if not ok then
+    ngx.log(ngx.ERR, "failed to create staging cleanup timer: ", err)
+end
+
+if accessindex.enabled() then
+    diskgc.start()
+end
+
+if metaindex.enabled() then
+    metaindex.start()
+end
+
 if config.data.openidc_client_id == "" or config.data.openidc_client_secret == "" then
     ngx.log(ngx.ERR, "Missing openidc_client_id or openidc_client_secret from config.json, will not start cluster gossip")
     return
 end
 local token_userpass = config.data.openidc_client_id .. ":" .. config.data.openidc_client_secret
 
+-- In delta mode, the digest each peer last replied with, so that we only
+-- send it the entries it is missing
+---@type table<string, GossipDigest>
+local peer_digests = {}
+-- In delta mode, the peers that have replied with a delta message, and so
+-- understand them. The others (e.g. running an older version) are sent our
+-- full view, with an offer to reply with a delta.
+---@type table<string, boolean>
+local peer_delta = {}
+-- Peers that have replied with a deflate compressed body, and so accept one
+---@type table<string, boolean>
+local peer_deflate = {}
+
 -- This function is called by the gossip timer
 ---@type function
 ---@param peer string
----@param message string
+---@param message string? Full message, or nil in delta mode
 ---@param token string
+---@return integer sent, integer received Message sizes in bytes
 local function peer_exchange_gossip(peer, message, token)
-    local httpc = resty_http.new()
-    -- timeouts (connect, send, read) are in milliseconds
-    httpc:set_timeouts(config.data.gossip_timeout, config.data.gossip_timeout, config.data.gossip_timeout)
+    local headers = {
+        ["Content-Type"] = "application/json",
+        ["Authorization"] = "Bearer " .. token,
+        ["Accept"] = "application/json",
+        ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
+    }
+    if not message then
+        if peer_delta[peer] then
+            message = cjson.encode(gossip.prepare_delta(peer_digests[peer]))
+        else
+            message = gossip.prepare_message()
+            headers["X-Gossip-Protocol"] = "delta"
+        end
+    end
+    if config.data.gossip_compression then
+        headers["Accept-Encoding"] = "deflate"
+        if peer_deflate[peer] then
+            message = zlib.deflate()(message, "finish")
+            headers["Content-Encoding"] = "deflate"
+        end
+    end
+    headers["Content-Length"] = #message
     ngx.log(ngx.INFO, "Sending gossip message to ", peer)
-    local res, err = httpc:request_uri(peer .. "gossip", {
+    metrics.inc("nginx_webdav_gossip_exchanges_total", {peer = peer})
+    ngx.update_time()
+    local tic = ngx.now()
+    -- timeout (connect, send, read) is in milliseconds
+    local res, err = peerclient.request_uri(peer .. "gossip", {
         method = "POST",
         body = message,
-        headers = {
-            ["Content-Type"] = "application/json",
-            ["Content-Length"] = #message,
-            ["Authorization"] = "Bearer " .. token,
-            ["Accept"] = "application/json",
-            ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
-        },
-    })
+        headers = headers,
+    }, config.data.gossip_timeout)
+    ngx.update_time()
+    if res and res.status == 200 then
+        metrics.set("nginx_webdav_gossip_rtt_seconds", {peer = peer}, ngx.now() - tic)
+    else
+        metrics.inc("nginx_webdav_gossip_failures_total", {peer = peer})
+    end
+    -- Start over from a full exchange after any failure
+    peer_digests[peer] = nil
     if not res then
         local errmsg = "Failed to send gossip message to " .. peer .. ": " .. err
         ngx.log(ngx.WARN, errmsg)
         gossip.handle_peer_error(peer, err)
-        return
+        return #message, 0
     end
     if res.status ~= 200 then
         local errmsg = "Failed to send gossip message to " .. peer .. ": " .. res.status
         ngx.log(ngx.WARN, errmsg)
         gossip.handle_peer_error(peer, "Response status " .. res.status)
-        return
+        return #message, 0
     end
     if res.body == "" then
         local errmsg = "Empty response from " .. peer
         ngx.log(ngx.WARN, errmsg)
         gossip.handle_peer_error(peer, "Empty response")
-        return
+        return #message, 0
     end
-    gossip.handle_message(res.body)
+    local body = res.body
+    if res.headers["Content-Encoding"] == "deflate" then
+        peer_deflate[peer] = true
+        local ok, inflated = pcall(function() return zlib.inflate()(body) end)
+        if not ok then
+            ngx.log(ngx.WARN, "Failed to inflate gossip response from ", peer, ": ", inflated)
+            gossip.handle_peer_error(peer, "Invalid compressed response")
+            return #message, #res.body
+        end
+        body = inflated
+    end
+    local delta = gossip.handle_message(body)
+    -- A full reply means the peer does not understand deltas (anymore)
+    peer_delta[peer] = delta ~= nil
+    if delta then
+        peer_digests[peer] = delta.digest
+    end
+    return #message, #res.body
 end
 
 
@@ -109,7 +189,13 @@ local function worker_gossip(premature)
     local peers, starting = gossip.peers()
 
     -- Prepare gossip message
-    local message = gossip.prepare_message()
+    -- In delta mode, each peer gets its own message, prepared in its thread
+    local message = nil
+    if config.data.gossip_protocol == "delta" then
+        gossip.update_self()
+    else
+        message = gossip.prepare_message()
+    end
 
     -- Send message to random subset of peers
     local threads = {}
@@ -124,20 +210,24 @@ local function worker_gossip(premature)
     end
 
     -- Wait for all threads to finish
+    local bytes_sent, bytes_received = 0, 0
     for _, co in ipairs(threads) do
-        local ok, err = ngx.thread.wait(co)
+        local ok, sent, received = ngx.thread.wait(co)
         if not ok then
-            ngx.log(ngx.ERR, err)
+            ngx.log(ngx.ERR, sent)
+        else
+            bytes_sent = bytes_sent + (sent or 0)
+            bytes_received = bytes_received + (received or 0)
         end
     end
 
     local toc = ngx.now()
-    ngx.log(ngx.NOTICE, "Gossip took ", toc - tic, " seconds")
+    ngx.log(ngx.NOTICE, "Gossip took ", toc - tic, " seconds, sent ", bytes_sent, " bytes, received ", bytes_received, " bytes")
 end
 
 
 -- Start the gossip timer
-local ok, err = ngx.timer.every(config.data.gossip_delay, worker_gossip)
+ok, err = ngx.timer.every(config.data.gossip_delay, worker_gossip)
 if not ok then
     ngx.log(ngx.ERR, "failed to create worker timer: ", err)
     return
@@ -0,0 +1,146 @@
+local ngx = require("ngx")
+local lrucache = require("resty.lrucache")
+local config = require("config")
+
+-- Cache of /redirect answers, keyed by the path relative to the webdav root.
+-- A per-worker LRU sits in front of the redirect_cache shared dict, which
+-- itself evicts the least recently used entries when it runs out of memory.
+--
+-- Positive entries remember every peer that has the file, each with the peer
+-- generation at the time they were stored. Bumping the generation of a peer
+-- (when it fails or is dropped) invalidates its replicas without having to
+-- find them.
+
+local locationcache = {}
+
+---@class Replica
+---@field peer string
+---@field location string
+
+---@class CachedReplica: Replica
+---@field generation integer
+
+---@class CachedLocation
+---@field replicas CachedReplica[]? nil for a negative entry
+
+local lru = nil
+
+---@type function
+---@return table lru
+local function worker_lru()
+    if not lru then
+        local err
+        lru, err = lrucache.new(config.data.redirect_cache_lru_size)
+        if not lru then
+            error("failed to create the redirect lru cache: " .. (err or "unknown"))
+        end
+    end
+    return lru
+end
+
+---@type function
+---@param peer string
+---@return integer generation
+local function peer_generation(peer)
+    return ngx.shared.redirect_cache:get("generation:" .. peer) or 0
+end
+
+---@type function
+---@param replicas CachedReplica[]
+---@return Replica[] valid The replicas whose peer was not invalidated since
+local function valid_replicas(replicas)
+    local valid = {}
+    for _, replica in ipairs(replicas) do
+        if replica.generation == peer_generation(replica.peer) then
+            table.insert(valid, {peer = replica.peer, location = replica.location})
+        end
+    end
+    return valid
+end
+
+---@type function
+---@param path string
+---@return Replica[]|false|nil replicas
+---Look up a path in the cache.
+---Returns the peers known to have the file, false if it is cached that no
+---peer has the file, or nil if there is no valid cache entry.
+function locationcache.get(path)
+    local cache = worker_lru()
+    ---@type CachedLocation?
+    local entry = cache:get(path)
+    if not entry then
+        local value = ngx.shared.redirect_cache:get("location:" .. path)
+        if value == nil then
+            return nil
+        end
+        ---@cast value string
+        if value == "" then
+            entry = {}
+        else
+            entry = {replicas = {}}
+            for peer, generation, location in value:gmatch("([^\t\n]*)\t(%d+)\t([^\n]*)") do
+                table.insert(entry.replicas, {peer = peer, generation = tonumber(generation), location = location})
+            end
+            if #entry.replicas == 0 then
+                return nil
+            end
+        end
+        local ttl = ngx.shared.redirect_cache:ttl("location:" .. path)
+        if ttl and ttl > 0 then
+            cache:set(path, entry, ttl)
+        end
+    end
+    if not entry.replicas then
+        return false
+    end
+    local replicas = valid_replicas(entry.replicas)
+    if #replicas == 0 then
+        cache:delete(path)
+        ngx.shared.redirect_cache:delete("location:" .. path)
+        return nil
+    end
+    return replicas
+end
+
+---@type function
+---@param path string
+---@param replicas Replica[]
+---Cache that the file at path can be found at each replica location
+function locationcache.set(path, replicas)
+    local ttl = config.data.redirect_cache_ttl
+    local cached, lines = {}, {}
+    for i, replica in ipairs(replicas) do
+        local generation = peer_generation(replica.peer)
+        cached[i] = {peer = replica.peer, generation = generation, location = replica.location}
+        lines[i] = replica.peer .. "\t" .. generation .. "\t" .. replica.location
+    end
+    worker_lru():set(path, {replicas = cached}, ttl)
+    local ok, err = ngx.shared.redirect_cache:set("location:" .. path, table.concat(lines, "\n"), ttl)
+    if not ok then
+        ngx.log(ngx.WARN, "Failed to cache location of ", path, ": ", err)
+    end
+end
+
+---@type function
+---@param path string
+---Cache that no peer has the file at path
+function locationcache.set_missing(path)
+    local ttl = config.data.redirect_cache_negative_ttl
+    worker_lru():set(path, {}, ttl)
+    local ok, err = ngx.shared.redirect_cache:set("location:" .. path, "", ttl)
+    if not ok then
+        ngx.log(ngx.WARN, "Failed to cache missing ", path, ": ", err)
+    end
+end
+
+---@type function
+---@param peer string
+---Invalidate all cached locations pointing to a peer
+function locationcache.invalidate_peer(peer)
+    local _, err = ngx.shared.redirect_cache:incr("generation:" .. peer, 1, 0)
+    if err then
+        ngx.log(ngx.ERR, "Failed to invalidate cached locations for ", peer, ": ", err)
+    end
+end
+
+return locationcache
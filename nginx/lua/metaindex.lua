@@ -0,0 +1,159 @@
+local ngx = require("ngx")
+local config = require("config")
+local nsfilter = require("nsfilter")
+
+-- Persistent index of the size, mtime and adler32 of the files in local_path,
+-- in an SQLite database at config metaindex_path (see metaindexthread), so
+-- that metadata lookups do not have to go to the filesystem, which is slow on
+-- network filesystems.
+--
+-- Files are added when they are committed (fileutil.commit_staging), or when
+-- a lookup missed the index and went to the disk (without replacing what a
+-- commit may have indexed meanwhile), and removed when deleted
+-- through the server. Worker 0 reconciles the index with the disk on startup
+-- and every metaindex_reconcile_interval, which catches changes made behind
+-- the server's back; until the first reconciliation is done, lookups go to
+-- the disk.
+
+local metaindex = {}
+
+---@class IndexedMetadata
+---@field size integer
+---@field mtime integer
+---@field adler32 string|false
+
+---@type function
+---@param func string Name of the function in metaindexthread
+---@return string? err, any val
+local function run_in_thread(func, ...)
+    local ok, err, val = ngx.run_worker_thread(
+        config.data.metaindex_thread_pool, "metaindexthread", func, config.data.metaindex_path, ...
+    )
+    if not ok then
+        return "Failed to run " .. func .. " in thread pool: " .. tostring(err), nil
+    end
+    return err, val
+end
+
+---@type function
+---@return boolean
+function metaindex.enabled()
+    return config.data.metaindex_enabled
+end
+
+---@type function
+---@param path string
+---@return IndexedMetadata? entry Nil if not indexed, or the index is not usable yet
+function metaindex.get(path)
+    if not config.data.metaindex_enabled or not ngx.shared.namespace_data:get("metaindex_ready") then
+        return nil
+    end
+    local err, entry = run_in_thread("get", nsfilter.key(path))
+    if err then
+        ngx.log(ngx.WARN, "Failed to look up ", path, " in the metadata index: ", err)
+    end
+    return entry
+end
+
+---@type function
+---@param path string
+---@param size integer
+---@param mtime integer
+---@param adler32 string? Kept from the index if nil and the file did not change
+function metaindex.put(path, size, mtime, adler32)
+    if not config.data.metaindex_enabled then
+        return
+    end
+    local err = run_in_thread("put", nsfilter.key(path), size, mtime, adler32)
+    if err then
+        ngx.log(ngx.WARN, "Failed to index ", path, ": ", err)
+    end
+end
+
+---@type function
+---@param path string
+---@param size integer
+---@param mtime integer
+---@param adler32 string?
+---Index a file that is not indexed yet. Unlike put, this never replaces an
+---entry, which may have been written by a commit since the file was looked at.
+function metaindex.add(path, size, mtime, adler32)
+    if not config.data.metaindex_enabled then
+        return
+    end
+    local err = run_in_thread("add", nsfilter.key(path), size, mtime, adler32)
+    if err then
+        ngx.log(ngx.WARN, "Failed to index ", path, ": ", err)
+    end
+end
+
+---@type function
+---@param path string
+---@param adler32 string
+function metaindex.set_adler32(path, adler32)
+    if not config.data.metaindex_enabled then
+        return
+    end
+    local err = run_in_thread("set_adler32", nsfilter.key(path), adler32)
+    if err then
+        ngx.log(ngx.WARN, "Failed to index the adler32 of ", path, ": ", err)
+    end
+end
+
+---@type function
+---@param path string
+function metaindex.remove(path)
+    if not config.data.metaindex_enabled then
+        return
+    end
+    local err = run_in_thread("remove", nsfilter.key(path))
+    if err then
+        ngx.log(ngx.WARN, "Failed to remove ", path, " from the metadata index: ", err)
+    end
+end
+
+-- Only used by worker 0
+local reconciling = false
+
+---@type function
+---@param premature boolean
+local function reconcile(premature)
+    if premature or reconciling then
+        return
+    end
+    reconciling = true
+    -- Required here, as cksumutil requires this module
+    local cksumutil = require("cksumutil")
+    local tic = ngx.now()
+    local err, counts = run_in_thread(
+        "reconcile", config.data.local_path, cksumutil.ADLER32_XATTRS, config.data.metaindex_batch_size
+    )
+    reconciling = false
+    ngx.update_time()
+    if err then
+        ngx.log(ngx.ERR, "Failed to reconcile the metadata index: ", err)
+        return
+    end
+    ---@cast counts table
+    ngx.shared.namespace_data:set("metaindex_ready", true)
+    ngx.log(ngx.NOTICE, "Reconciled the metadata index in ", ngx.now() - tic, " seconds: ", counts.files,
+        " files, ", counts.updated, " updated, ", counts.removed, " removed")
+end
+
+---@type function
+---Reconcile the index now and periodically, only called by worker 0
+function metaindex.start()
+    local directory = config.data.metaindex_path:match("(.*)/")
+    if directory then
+        require("fileutil").mkdir(directory, true)
+    end
+    -- Stays unusable until reconciled, in case files changed while we were down
+    ngx.shared.namespace_data:delete("metaindex_ready")
+    ngx.timer.at(0, reconcile)
+    local ok, err = ngx.timer.every(config.data.metaindex_reconcile_interval, reconcile)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to create metadata index timer: ", err)
+    end
+end
+
+return metaindex
@@ -0,0 +1,304 @@
+local ffi = require("ffi")
+local dirent = require("posix.dirent")
+local sys_stat = require("posix.sys.stat")
+local cksumthread = require("cksumthread")
+
+-- The SQLite side of metaindex, run in an nginx thread pool with
+-- ngx.run_worker_thread. As for cksumthread, this module must not depend on
+-- config or use ngx.log, and arguments and return values must be plain
+-- values or tables of them. Each thread keeps its own connection open.
+
+local metaindexthread = {}
+
+ffi.cdef[[
+typedef struct sqlite3 sqlite3;
+typedef struct sqlite3_stmt sqlite3_stmt;
+int sqlite3_open_v2(const char *filename, sqlite3 **db, int flags, const char *vfs);
+int sqlite3_busy_timeout(sqlite3 *db, int ms);
+int sqlite3_exec(sqlite3 *db, const char *sql, void *callback, void *arg, char **errmsg);
+const char *sqlite3_errmsg(sqlite3 *db);
+int sqlite3_prepare_v2(sqlite3 *db, const char *sql, int nbyte, sqlite3_stmt **stmt, const char **tail);
+int sqlite3_bind_text(sqlite3_stmt *stmt, int index, const char *value, int nbyte, intptr_t destructor);
+int sqlite3_bind_int64(sqlite3_stmt *stmt, int index, int64_t value);
+int sqlite3_bind_null(sqlite3_stmt *stmt, int index);
+int sqlite3_step(sqlite3_stmt *stmt);
+int sqlite3_reset(sqlite3_stmt *stmt);
+int sqlite3_column_count(sqlite3_stmt *stmt);
+int sqlite3_column_type(sqlite3_stmt *stmt, int column);
+int64_t sqlite3_column_int64(sqlite3_stmt *stmt, int column);
+const unsigned char *sqlite3_column_text(sqlite3_stmt *stmt, int column);
+int sqlite3_changes(sqlite3 *db);
+]]
+
+local sqlite = ffi.load("libsqlite3.so.0")
+
+local SQLITE_OK = 0
+local SQLITE_ROW = 100
+local SQLITE_DONE = 101
+local SQLITE_TEXT = 3
+local SQLITE_NULL = 5
+local SQLITE_OPEN_READWRITE = 0x2
+local SQLITE_OPEN_CREATE = 0x4
+local SQLITE_OPEN_NOMUTEX = 0x8000
+-- Have SQLite copy the bound strings
+local SQLITE_TRANSIENT = -1
+
+local SCHEMA = [[
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime INTEGER NOT NULL,
+  adler32 TEXT,
+  generation INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+]]
+
+local STATEMENTS = {
+  get = "SELECT size, mtime, adler32 FROM files WHERE path = ?",
+  -- A known adler32 is kept if the file did not change
+  put = [[
+    INSERT INTO files VALUES (?, ?, ?, ?, (SELECT value FROM meta WHERE key = 'generation'))
+    ON CONFLICT (path) DO UPDATE SET
+      adler32 = CASE
+        WHEN excluded.adler32 IS NOT NULL THEN excluded.adler32
+        WHEN size = excluded.size AND mtime = excluded.mtime THEN adler32
+      END,
+      size = excluded.size,
+      mtime = excluded.mtime,
+      generation = excluded.generation
+  ]],
+  -- Leaves an existing entry alone, as it may be newer than what was seen
+  add = [[
+    INSERT INTO files VALUES (?, ?, ?, ?, (SELECT value FROM meta WHERE key = 'generation'))
+    ON CONFLICT (path) DO NOTHING
+  ]],
+  set_adler32 = "UPDATE files SET adler32 = ? WHERE path = ?",
+  remove = "DELETE FROM files WHERE path = ?",
+  begin = "BEGIN IMMEDIATE",
+  commit = "COMMIT",
+  next_generation = "UPDATE meta SET value = value + 1 WHERE key = 'generation'",
+  generation = "SELECT value FROM meta WHERE key = 'generation'",
+  keep = "UPDATE files SET generation = ? WHERE path = ?",
+  drop_stale = "DELETE FROM files WHERE generation < ?",
+}
+
+-- Connection of this thread, and its prepared statements
+local db = nil
+local db_path = nil
+local statements = {}
+
+---@type function
+---@param path string
+---@return string? err
+local function open(path)
+  if db and db_path == path then
+    return nil
+  end
+  local handle = ffi.new("sqlite3*[1]")
+  local flags = bit.bor(SQLITE_OPEN_READWRITE, SQLITE_OPEN_CREATE, SQLITE_OPEN_NOMUTEX)
+  if sqlite.sqlite3_open_v2(path, handle, flags, nil) ~= SQLITE_OK then
+    return "Failed to open " .. path .. ": " .. ffi.string(sqlite.sqlite3_errmsg(handle[0]))
+  end
+  sqlite.sqlite3_busy_timeout(handle[0], 5000)
+  local errmsg = ffi.new("char*[1]")
+  if sqlite.sqlite3_exec(handle[0], SCHEMA, nil, nil, errmsg) ~= SQLITE_OK then
+    return "Failed to create the schema of " .. path .. ": " .. ffi.string(errmsg[0])
+  end
+  statements = {}
+  for name, sql in pairs(STATEMENTS) do
+    local stmt = ffi.new("sqlite3_stmt*[1]")
+    if sqlite.sqlite3_prepare_v2(handle[0], sql, #sql, stmt, nil) ~= SQLITE_OK then
+      return "Failed to prepare " .. name .. ": " .. ffi.string(sqlite.sqlite3_errmsg(handle[0]))
+    end
+    statements[name] = stmt[0]
+  end
+  db, db_path = handle[0], path
+  return nil
+end
+
+---@type function
+---@param name string
+---@param ... string|integer|nil Parameters of the statement
+---@return string? err, table? row First row of the result, as a list of values
+local function run(name, ...)
+  local stmt = statements[name]
+  local params = {...}
+  for i = 1, select("#", ...) do
+    local value = params[i]
+    if value == nil then
+      sqlite.sqlite3_bind_null(stmt, i)
+    elseif type(value) == "number" then
+      sqlite.sqlite3_bind_int64(stmt, i, value)
+    else
+      sqlite.sqlite3_bind_text(stmt, i, value, #value, SQLITE_TRANSIENT)
+    end
+  end
+  local ret = sqlite.sqlite3_step(stmt)
+  local row = nil
+  if ret == SQLITE_ROW then
+    row = {}
+    for i = 0, sqlite.sqlite3_column_count(stmt) - 1 do
+      local ctype = sqlite.sqlite3_column_type(stmt, i)
+      if ctype == SQLITE_NULL then
+        row[i + 1] = false
+      elseif ctype == SQLITE_TEXT then
+        row[i + 1] = ffi.string(sqlite.sqlite3_column_text(stmt, i))
+      else
+        row[i + 1] = tonumber(sqlite.sqlite3_column_int64(stmt, i))
+      end
+    end
+  end
+  sqlite.sqlite3_reset(stmt)
+  if ret ~= SQLITE_ROW and ret ~= SQLITE_DONE then
+    return "Error " .. ret .. " in " .. name .. ": " .. ffi.string(sqlite.sqlite3_errmsg(db)), nil
+  end
+  return nil, row
+end
+
+---@type function
+---@param path string Database
+---@param key string
+---@return string? err, table? entry {size, mtime, adler32 (or false)}
+function metaindexthread.get(path, key)
+  local err = open(path)
+  if err then
+    return err, nil
+  end
+  local row
+  err, row = run("get", key)
+  if not row then
+    return err, nil
+  end
+  return nil, {size = row[1], mtime = row[2], adler32 = row[3]}
+end
+
+---@type function
+---@param path string Database
+---@param key string
+---@param size integer
+---@param mtime integer
+---@param adler32 string?
+---@return string? err
+function metaindexthread.put(path, key, size, mtime, adler32)
+  local err = open(path)
+  if err then
+    return err
+  end
+  return (run("put", key, size, mtime, adler32))
+end
+
+---@type function
+---@param path string Database
+---@param key string
+---@param size integer
+---@param mtime integer
+---@param adler32 string?
+---@return string? err
+function metaindexthread.add(path, key, size, mtime, adler32)
+  local err = open(path)
+  if err then
+    return err
+  end
+  return (run("add", key, size, mtime, adler32))
+end
+
+---@type function
+---@param path string Database
+---@param key string
+---@param adler32 string
+---@return string? err
+function metaindexthread.set_adler32(path, key, adler32)
+  local err = open(path)
+  if err then
+    return err
+  end
+  return (run("set_adler32", adler32, key))
+end
+
+---@type function
+---@param path string Database
+---@param key string
+---@return string? err
+function metaindexthread.remove(path, key)
+  local err = open(path)
+  if err then
+    return err
+  end
+  return (run("remove", key))
+end
+
+---@type function
+---@param path string Database
+---@param root string Directory to index
+---@param adler32_xattrs string[] Where the adler32 checksums are stored
+---@param batch_size integer Files per transaction
+---@return string? err, table? counts {files, updated, removed}
+---Bring the index in line with the files under root: add or update the files
+---that changed (by size or mtime), and drop the ones that are gone. Writes
+---are committed every batch_size files, so that the requests updating the
+---index are not held up for long.
+function metaindexthread.reconcile(path, root, adler32_xattrs, batch_size)
+  local err = open(path)
+  if err then
+    return err, nil
+  end
+  err = run("next_generation")
+  local row
+  if not err then
+    err, row = run("generation")
+  end
+  if err then
+    return err, nil
+  end
+  ---@cast row table
+  local generation = row[1]
+  local counts = {files = 0, updated = 0, removed = 0}
+  run("begin")
+
+  local function visit(directory)
+    local ok, iter, state = pcall(dirent.files, directory)
+    if not ok then
+      return
+    end
+    for name in iter, state do
+      if name ~= "." and name ~= ".." and not (directory == root and name == ".upload") then
+        local file = directory .. "/" .. name
+        local stat = sys_stat.lstat(file)
+        if stat and sys_stat.S_ISDIR(stat.st_mode) ~= 0 then
+          visit(file)
+        elseif stat and sys_stat.S_ISREG(stat.st_mode) ~= 0 then
+          local key = file:sub(#root + 1)
+          local _, indexed = run("get", key)
+          if indexed and indexed[1] == stat.st_size and indexed[2] == stat.st_mtime then
+            run("keep", generation, key)
+          else
+            local _, adler32 = cksumthread.getxattrs(file, adler32_xattrs)
+            run("put", key, stat.st_size, stat.st_mtime, adler32)
+            counts.updated = counts.updated + 1
+          end
+          counts.files = counts.files + 1
+          if counts.files % batch_size == 0 then
+            run("commit")
+            run("begin")
+          end
+        end
+      end
+    end
+  end
+  visit(root)
+
+  -- Files that were not seen are gone, unless added since by a request
+  run("drop_stale", generation)
+  counts.removed = sqlite.sqlite3_changes(db)
+  err = run("commit")
+  return err, counts
+end
+
+return metaindexthread
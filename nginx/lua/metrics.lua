@@ -0,0 +1,354 @@
+local ngx = require("ngx")
+
+-- Counters, gauges and histograms kept in the metrics shared dict, so that
+-- they are shared by all workers, and rendered in the Prometheus text format
+-- by metrics_content.lua
+--
+-- Histogram buckets are stored as plain (not cumulative) counts, so that an
+-- observation is a single increment; they are accumulated when rendering.
+
+local metrics = {}
+
+local LATENCY_BUCKETS = {0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300}
+local CHECKSUM_BUCKETS = {0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800}
+local FANOUT_BUCKETS = {0, 1, 2, 4, 8, 16, 32, 64}
+
+---@class MetricFamily
+---@field type "counter"|"gauge"|"histogram"
+---@field help string
+---@field buckets number[]?
+
+---@type table<string, MetricFamily>
+local families = {
+    nginx_webdav_request_duration_seconds = {
+        type = "histogram", help = "Request latency by operation", buckets = LATENCY_BUCKETS,
+    },
+    nginx_webdav_requests_total = {
+        type = "counter", help = "Requests by operation and status",
+    },
+    nginx_webdav_received_bytes_total = {
+        type = "counter", help = "Bytes received from clients by operation",
+    },
+    nginx_webdav_sent_bytes_total = {
+        type = "counter", help = "Bytes sent to clients by operation",
+    },
+    nginx_webdav_pulled_bytes_total = {
+        type = "counter", help = "Bytes pulled from other servers by operation",
+    },
+    nginx_webdav_requests_in_progress = {
+        type = "gauge", help = "Requests in progress by operation",
+    },
+    nginx_webdav_transfers_in_progress = {
+        type = "gauge", help = "Uploads and TPC transfers in progress",
+    },
+    nginx_webdav_tpc_queued = {
+        type = "gauge", help = "Third party pulls waiting in the transfer queue",
+    },
+    nginx_webdav_tpc_rejected_total = {
+        type = "counter", help = "Third party pulls rejected by the transfer limits",
+    },
+    nginx_webdav_cache_usage_bytes = {
+        type = "gauge", help = "Total size of the files in the pull-through cache",
+    },
+    nginx_webdav_cache_filled_bytes_total = {
+        type = "counter", help = "Bytes copied from peers into the pull-through cache",
+    },
+    nginx_webdav_gc_reclaimed_bytes_total = {
+        type = "counter", help = "Bytes deleted by the garbage collector, by reason",
+    },
+    nginx_webdav_gc_deleted_files_total = {
+        type = "counter", help = "Files deleted by the garbage collector, by reason",
+    },
+    nginx_webdav_disk_used_bytes = {
+        type = "gauge", help = "Used space on the data disk, including space reserved for root",
+    },
+    nginx_webdav_disk_size_bytes = {
+        type = "gauge", help = "Size of the data disk",
+    },
+    nginx_webdav_checksum_duration_seconds = {
+        type = "histogram", help = "Time to compute the checksum of a file from disk", buckets = CHECKSUM_BUCKETS,
+    },
+    nginx_webdav_redirect_lookups_total = {
+        type = "counter", help = "Redirect lookups by how they were answered",
+    },
+    nginx_webdav_redirect_fanout_peers = {
+        type = "histogram", help = "Peers queried by a redirect lookup", buckets = FANOUT_BUCKETS,
+    },
+    nginx_webdav_gossip_rtt_seconds = {
+        type = "gauge", help = "Round trip time of the last gossip exchange with a peer",
+    },
+    nginx_webdav_gossip_exchanges_total = {
+        type = "counter", help = "Gossip exchanges initiated with a peer",
+    },
+    nginx_webdav_gossip_failures_total = {
+        type = "counter", help = "Failed gossip exchanges with a peer",
+    },
+    nginx_webdav_peer_connect_seconds = {
+        type = "gauge", help = "Moving average of the time to connect to a peer",
+    },
+    nginx_webdav_peer_first_byte_seconds = {
+        type = "gauge", help = "Moving average of the time to the first response byte from a peer",
+    },
+    nginx_webdav_peer_connections_total = {
+        type = "counter", help = "New connections made to a peer",
+    },
+    nginx_webdav_peer_reused_total = {
+        type = "counter", help = "Requests to a peer over a pooled connection",
+    },
+}
+
+---@type function
+---@param labels table<string, string|number>?
+---@return string labels Formatted as {name="value",...}, sorted by name
+local function format_labels(labels)
+    if not labels or next(labels) == nil then
+        return ""
+    end
+    local names = {}
+    for name, _ in pairs(labels) do
+        table.insert(names, name)
+    end
+    table.sort(names)
+    local out = {}
+    for i, name in ipairs(names) do
+        local value = tostring(labels[name]):gsub("\\", "\\\\"):gsub("\n", "\\n"):gsub('"', '\\"')
+        out[i] = name .. '="' .. value .. '"'
+    end
+    return "{" .. table.concat(out, ",") .. "}"
+end
+
+---@type function
+---@param key string
+---@param value number
+local function incr(key, value)
+    local _, err, forcible = ngx.shared.metrics:incr(key, value, 0)
+    if err then
+        ngx.log(ngx.WARN, "Failed to update metric ", key, ": ", err)
+    elseif forcible then
+        ngx.log(ngx.WARN, "The metrics shared dict is full, metrics were evicted")
+    end
+end
+
+---@type function
+---@param name string
+---@param labels table<string, string|number>?
+---@param value number? Defaults to 1
+---Increment a counter (or a gauge, with a negative value to decrement it)
+function metrics.inc(name, labels, value)
+    incr(name .. format_labels(labels), value or 1)
+end
+
+---@type function
+---@param name string
+---@param labels table<string, string|number>?
+---@param value number
+---Set a gauge
+function metrics.set(name, labels, value)
+    ngx.shared.metrics:set(name .. format_labels(labels), value)
+end
+
+---@type function
+---@param name string
+---@param labels table<string, string|number>?
+---@param value number
+---Record an observation in a histogram
+function metrics.observe(name, labels, value)
+    local buckets = families[name].buckets
+    local index = #buckets + 1
+    for i, le in ipairs(buckets) do
+        if value <= le then
+            index = i
+            break
+        end
+    end
+    local formatted = format_labels(labels)
+    incr(name .. formatted .. "|" .. index, 1)
+    incr(name .. "_sum" .. formatted, value)
+    incr(name .. "_count" .. formatted, 1)
+end
+
+---@type function
+---@param name string
+---@return number total Sum of a counter or gauge over all of its labels
+function metrics.sum(name)
+    local dict = ngx.shared.metrics
+    local total = 0
+    for _, key in ipairs(dict:get_keys(0)) do
+        if key == name or (key:sub(1, #name + 1) == name .. "{" and not key:find("|", 1, true)) then
+            total = total + (dict:get(key) or 0)
+        end
+    end
+    return total
+end
+
+---@type function
+---@param formatted string Formatted labels
+---@param le string
+---@return string labels The labels with le added
+local function add_le(formatted, le)
+    if formatted == "" then
+        return '{le="' .. le .. '"}'
+    end
+    return formatted:sub(1, -2) .. ',le="' .. le .. '"}'
+end
+
+---@type function
+---@param out string[]
+---Add the latency statistics of peerclient as metrics
+local function peer_stats_lines(out)
+    local stats = ngx.shared.peer_stats
+    local by_family = {
+        connect = {"nginx_webdav_peer_connect_seconds", 0.001},
+        first_byte = {"nginx_webdav_peer_first_byte_seconds", 0.001},
+        connections = {"nginx_webdav_peer_connections_total", 1},
+        reused = {"nginx_webdav_peer_reused_total", 1},
+    }
+    local lines = {}
+    for _, key in ipairs(stats:get_keys(0)) do
+        local stat, origin = key:match("^([%w_]+):(.*)$")
+        local family = by_family[stat]
+        local value = stats:get(key)
+        if family and value then
+            lines[family[1]] = lines[family[1]] or {}
+            table.insert(lines[family[1]], family[1] .. format_labels({peer = origin}) .. " " .. value * family[2])
+        end
+    end
+    for name, family_lines in pairs(lines) do
+        table.insert(out, "# HELP " .. name .. " " .. families[name].help)
+        table.insert(out, "# TYPE " .. name .. " " .. families[name].type)
+        table.sort(family_lines)
+        for _, line in ipairs(family_lines) do
+            table.insert(out, line)
+        end
+    end
+end
+
+---@type function
+---@return string text All metrics in the Prometheus text exposition format
+function metrics.render()
+    local dict = ngx.shared.metrics
+    -- Samples by family name
+    ---@type table<string, string[]>
+    local samples = {}
+    -- Bucket counts by histogram series name..labels
+    ---@type table<string, table<integer, number>>
+    local histograms = {}
+    for _, key in ipairs(dict:get_keys(0)) do
+        local value = dict:get(key)
+        if value then
+            local series, index = key:match("^(.*)|(%d+)$")
+            if series then
+                histograms[series] = histograms[series] or {}
+                histograms[series][tonumber(index)] = value
+            else
+                local name = key:match("^[%w_]+")
+                local family = name:gsub("_sum$", ""):gsub("_count$", "")
+                if not families[family] then
+                    family = name
+                end
+                samples[family] = samples[family] or {}
+                table.insert(samples[family], key .. " " .. value)
+            end
+        end
+    end
+    for series, counts in pairs(histograms) do
+        local name = series:match("^[%w_]+")
+        local formatted = series:sub(#name + 1)
+        local buckets = families[name].buckets
+        local cumulative = 0
+        samples[name] = samples[name] or {}
+        for i = 1, #buckets + 1 do
+            cumulative = cumulative + (counts[i] or 0)
+            local le = buckets[i] and tostring(buckets[i]) or "+Inf"
+            table.insert(samples[name], name .. "_bucket" .. add_le(formatted, le) .. " " .. cumulative)
+        end
+    end
+
+    local names = {}
+    for name, _ in pairs(samples) do
+        table.insert(names, name)
+    end
+    table.sort(names)
+    local out = {}
+    for _, name in ipairs(names) do
+        if families[name] then
+            table.insert(out, "# HELP " .. name .. " " .. families[name].help)
+            table.insert(out, "# TYPE " .. name .. " " .. families[name].type)
+        end
+        -- Buckets were added in order after the other samples of the histogram
+        for _, line in ipairs(samples[name]) do
+            table.insert(out, line)
+        end
+    end
+    peer_stats_lines(out)
+    return table.concat(out, "\n") .. "\n"
+end
+
+-- The operation of each internal location, for the request metrics
+local operations = {
+    webdav_read = "read",
+    webdav_write = "write",
+    webdav_tpc = "tpc",
+    webdav_propfind = "propfind",
+    redirect = "redirect",
+    gossip = "gossip",
+}
+
+---@type function
+---@return string? operation The operation of the current request, if it is one we measure
+function metrics.operation()
+    return operations[ngx.var.uri:match("^/([^/]*)")]
+end
+
+---@type function
+---Count the current request as in progress until it ends (see metrics_log.lua)
+function metrics.request_started()
+    local operation = metrics.operation()
+    if not operation or ngx.ctx.metrics_request then
+        return
+    end
+    ngx.ctx.metrics_request = operation
+    metrics.inc("nginx_webdav_requests_in_progress", {operation = operation}, 1)
+end
+
+---@type function
+---@param operation string
+---Count a transfer in progress until the request ends (see metrics_log.lua)
+function metrics.transfer_started(operation)
+    if ngx.ctx.metrics_transfer then
+        return
+    end
+    ngx.ctx.metrics_transfer = operation
+    metrics.inc("nginx_webdav_transfers_in_progress", {operation = operation}, 1)
+end
+
+---@type function
+---Record the metrics of the current request, in the log phase
+function metrics.log()
+    if ngx.ctx.metrics_request then
+        metrics.inc("nginx_webdav_requests_in_progress", {operation = ngx.ctx.metrics_request}, -1)
+    end
+    if ngx.ctx.metrics_transfer then
+        metrics.inc("nginx_webdav_transfers_in_progress", {operation = ngx.ctx.metrics_transfer}, -1)
+    end
+
+    local operation = metrics.operation()
+    if not operation then
+        return
+    end
+
+    local labels = {operation = operation}
+    metrics.observe("nginx_webdav_request_duration_seconds", labels, tonumber(ngx.var.request_time) or 0)
+    -- Handlers that answer over the raw socket cannot set ngx.status
+    metrics.inc("nginx_webdav_requests_total", {operation = operation, status = ngx.ctx.response_status or ngx.status})
+    -- request_length includes the uploaded body, however the handler read it
+    metrics.inc("nginx_webdav_received_bytes_total", labels, tonumber(ngx.var.request_length) or 0)
+    -- Pushes and pulls (TPC, cache fills) do not go through nginx's accounting
+    metrics.inc("nginx_webdav_sent_bytes_total", labels,
+        (tonumber(ngx.var.bytes_sent) or 0) + (ngx.ctx.body_bytes_sent or 0))
+    if ngx.ctx.pulled_bytes_received then
+        metrics.inc("nginx_webdav_pulled_bytes_total", labels, ngx.ctx.pulled_bytes_received)
+    end
+end
+
+return metrics
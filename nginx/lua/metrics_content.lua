@@ -0,0 +1,11 @@
+local ngx = require("ngx")
+local metrics = require("metrics")
+
+-- Prometheus scrape endpoint
+local body = metrics.render()
+ngx.status = ngx.HTTP_OK
+ngx.header["Content-Type"] = "text/plain; version=0.0.4"
+ngx.header["Content-Length"] = #body
+ngx.print(body)
+
+return ngx.exit(ngx.HTTP_OK)
@@ -0,0 +1,5 @@
+local metrics = require("metrics")
+
+-- Request metrics, recorded in the log phase of every location
+-- (see conf.d/include/locations.conf)
+metrics.log()
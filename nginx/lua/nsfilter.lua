@@ -0,0 +1,295 @@
+local ngx = require("ngx")
+local ffi = require("ffi")
+local zlib = require("zlib")
+local cjson = require("cjson")
+local dirent = require("posix.dirent")
+local sys_stat = require("posix.sys.stat")
+local config = require("config")
+
+-- A summary of the local namespace, published to peers through gossip so that
+-- /redirect only has to query the peers that may hold a given file.
+--
+-- Any worker can record additions and removals, which are queued in the
+-- namespace_data shared dict. Worker 0 owns a counting Bloom filter built from
+-- a scan of local_path, applies the queued events to it, and publishes the
+-- plain Bloom filter (one bit per counter) as the local summary.
+
+local nsfilter = {}
+
+---@class NamespaceSummary
+---@field version number Time at which the filter was last changed
+---@field bits integer Number of bits in the filter
+---@field hashes integer Number of hash functions
+---@field filter string base64 encoded, zlib compressed bitmap
+
+---@class DecodedSummary
+---@field version number
+---@field bits integer
+---@field hashes integer
+---@field bitmap string
+
+-- Counting filter state, only used by worker 0
+local counters = nil
+local nbits = 0
+local nhashes = 0
+local last_scan = 0
+local dirty = false
+
+local COUNTER_MAX = 255
+
+---@type function
+---@param file_path string
+---@return string key
+---Convert a local file path into the key used in the filter
+function nsfilter.key(file_path)
+    return file_path:sub(#config.data.local_path + 1)
+end
+
+---@type function
+---@param key string
+---@param bits integer
+---@param hashes integer
+---@return integer[] positions
+---The (0-based) bit positions of a key, using double hashing on an md5 digest
+local function positions(key, bits, hashes)
+    local digest = ngx.md5_bin(key)
+    local a1, a2, a3, a4, b1, b2, b3, b4 = digest:byte(1, 8)
+    local h1 = ((a1 * 256 + a2) * 256 + a3) * 256 + a4
+    local h2 = ((b1 * 256 + b2) * 256 + b3) * 256 + b4
+    local out = {}
+    for i = 0, hashes - 1 do
+        out[i + 1] = (h1 + i * h2) % bits
+    end
+    return out
+end
+
+---@type function
+---@param key string
+---Record that a file was added to the local namespace
+function nsfilter.record_add(key)
+    local len, err = ngx.shared.namespace_data:rpush("events", "+" .. key)
+    if not len then
+        ngx.log(ngx.WARN, "Failed to queue namespace event, will rescan: ", err)
+        ngx.shared.namespace_data:set("overflow", true)
+    end
+end
+
+---@type function
+---@param key string
+---Record that a file was removed from the local namespace
+function nsfilter.record_remove(key)
+    local len, err = ngx.shared.namespace_data:rpush("events", "-" .. key)
+    if not len then
+        ngx.log(ngx.WARN, "Failed to queue namespace event, will rescan: ", err)
+        ngx.shared.namespace_data:set("overflow", true)
+    end
+end
+
+---@type function
+---@param key string
+local function counters_add(key)
+    for _, pos in ipairs(positions(key, nbits, nhashes)) do
+        if counters[pos] < COUNTER_MAX then
+            counters[pos] = counters[pos] + 1
+        end
+    end
+    dirty = true
+end
+
+---@type function
+---@param key string
+local function counters_remove(key)
+    local pos = positions(key, nbits, nhashes)
+    -- A key that was never added must not decrement counters shared with others
+    for _, p in ipairs(pos) do
+        if counters[p] == 0 then
+            return
+        end
+    end
+    for _, p in ipairs(pos) do
+        -- Saturated counters have lost their count, so leave them set
+        if counters[p] < COUNTER_MAX then
+            counters[p] = counters[p] - 1
+        end
+    end
+    dirty = true
+end
+
+---@type function
+---@param directory string
+---@param nfiles integer
+---@return integer nfiles
+---Recursively add all files below directory to the counting filter
+local function scan_directory(directory, nfiles)
+    local ok, iter, state = pcall(dirent.files, directory)
+    if not ok then
+        ngx.log(ngx.WARN, "Failed to scan ", directory, ": ", iter)
+        return nfiles
+    end
+    for name in iter, state do
+        -- .upload holds the client body temp files
+        if name ~= "." and name ~= ".." and not (directory == config.data.local_path and name == ".upload") then
+            local path = directory .. "/" .. name
+            local stat = sys_stat.lstat(path)
+            if stat and sys_stat.S_ISDIR(stat.st_mode) ~= 0 then
+                nfiles = scan_directory(path, nfiles)
+            elseif stat and sys_stat.S_ISREG(stat.st_mode) ~= 0 then
+                counters_add(nsfilter.key(path))
+                nfiles = nfiles + 1
+                if nfiles % 1000 == 0 then
+                    -- yield so that the scan does not starve this worker
+                    ngx.sleep(0)
+                end
+            end
+        end
+    end
+    return nfiles
+end
+
+---@type function
+---Rebuild the counting filter from a full scan of the local namespace
+local function rescan()
+    local tic = ngx.now()
+    nbits = math.ceil(config.data.namespace_filter_bits / 8) * 8
+    nhashes = config.data.namespace_filter_hashes
+    counters = ffi.new("uint8_t[?]", nbits)
+    ngx.shared.namespace_data:delete("overflow")
+    local nfiles = scan_directory(config.data.local_path, 0)
+    -- Events queued during the scan may or may not be reflected in it.
+    -- Re-applying an addition only costs a stale bit, while applying a removal
+    -- the scan already accounted for could produce false negatives.
+    local pending = ngx.shared.namespace_data:llen("events") or 0
+    for _ = 1, pending do
+        local event = ngx.shared.namespace_data:lpop("events")
+        if event and event:sub(1, 1) == "+" then
+            counters_add(event:sub(2))
+        end
+    end
+    last_scan = ngx.now()
+    dirty = true
+    ngx.log(ngx.NOTICE, "Namespace scan found ", nfiles, " files in ", last_scan - tic, " seconds")
+end
+
+---@type function
+---Encode the counting filter as a summary and store it in the shared dict
+local function publish()
+    local nbytes = nbits / 8
+    local bitmap = ffi.new("uint8_t[?]", nbytes)
+    for i = 0, nbytes - 1 do
+        local byte = 0
+        for j = 0, 7 do
+            if counters[i * 8 + j] > 0 then
+                byte = bit.bor(byte, bit.lshift(1, j))
+            end
+        end
+        bitmap[i] = byte
+    end
+    local compressed = zlib.deflate()(ffi.string(bitmap, nbytes), "finish")
+    local summary = {
+        version = ngx.now(),
+        bits = nbits,
+        hashes = nhashes,
+        filter = ngx.encode_base64(compressed),
+    }
+    local ok, err = ngx.shared.namespace_data:set("summary", cjson.encode(summary))
+    if not ok then
+        ngx.log(ngx.ERR, "Failed to store namespace summary: ", err)
+        return
+    end
+    dirty = false
+end
+
+---@type function
+---@param premature boolean
+---Apply queued events to the counting filter and publish it if it changed
+local function update(premature)
+    if premature then
+        return
+    end
+    local overflow = ngx.shared.namespace_data:get("overflow")
+    if not counters or overflow or ngx.now() - last_scan > config.data.namespace_filter_rescan_interval then
+        rescan()
+    end
+    while true do
+        local event = ngx.shared.namespace_data:lpop("events")
+        if not event then
+            break
+        end
+        if event:sub(1, 1) == "+" then
+            counters_add(event:sub(2))
+        else
+            counters_remove(event:sub(2))
+        end
+    end
+    if dirty then
+        publish()
+    end
+end
+
+---@type function
+---Start maintaining the local summary (to be called from worker 0 only)
+function nsfilter.start()
+    local ok, err = ngx.timer.at(0, update)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to create namespace filter timer: ", err)
+        return
+    end
+    ok, err = ngx.timer.every(config.data.namespace_filter_interval, update)
+    if not ok then
+        ngx.log(ngx.ERR, "failed to create namespace filter timer: ", err)
+    end
+end
+
+---@type function
+---@return NamespaceSummary? summary
+---The most recently published summary of the local namespace
+function nsfilter.local_summary()
+    local summary = ngx.shared.namespace_data:get("summary")
+    if not summary then
+        return nil
+    end
+    ---@cast summary string
+    return cjson.decode(summary)
+end
+
+---@type function
+---@param summary NamespaceSummary
+---@return DecodedSummary? decoded, string? err
+---Decompress a summary received from a peer so it can be queried
+function nsfilter.decode(summary)
+    local compressed = ngx.decode_base64(summary.filter or "")
+    if not compressed then
+        return nil, "invalid base64 in summary"
+    end
+    local ok, bitmap = pcall(function() return zlib.inflate()(compressed) end)
+    if not ok then
+        return nil, "failed to inflate summary: " .. bitmap
+    end
+    if #bitmap * 8 ~= summary.bits then
+        return nil, "summary has " .. #bitmap * 8 .. " bits, expected " .. summary.bits
+    end
+    return {
+        version = summary.version,
+        bits = summary.bits,
+        hashes = summary.hashes,
+        bitmap = bitmap,
+    }
+end
+
+---@type function
+---@param decoded DecodedSummary
+---@param key string
+---@return boolean maybe
+---False if the key is definitely absent from the summarised namespace
+function nsfilter.contains(decoded, key)
+    local bitmap = decoded.bitmap
+    for _, pos in ipairs(positions(key, decoded.bits, decoded.hashes)) do
+        local byte = bitmap:byte(math.floor(pos / 8) + 1)
+        if bit.band(byte, bit.lshift(1, pos % 8)) == 0 then
+            return false
+        end
+    end
+    return true
+end
+
+return nsfilter
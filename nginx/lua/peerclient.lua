@@ -0,0 +1,169 @@
+local ngx = require("ngx")
+local resty_http = require("resty.http")
+local config = require("config")
+
+-- HTTP client for requests to peers (and other remote servers)
+-- Connections are returned to a per-origin keepalive pool after each request,
+-- and TLS sessions are remembered per origin so that new connections can skip
+-- the full handshake. Connect and first-byte latencies are tracked per origin
+-- in the peer_stats shared dict.
+
+local peerclient = {}
+
+---@class PeerLatency
+---@field connect number? Moving average of the time to establish a new connection (ms)
+---@field first_byte number? Moving average of the time to first response byte (ms)
+---@field connections integer Number of new connections made
+---@field reused integer Number of requests served over a pooled connection
+
+-- Weight of a new sample in the latency moving averages
+local EWMA_WEIGHT = 0.2
+
+-- Per-worker TLS sessions, by origin
+---@type table<string, userdata>
+local ssl_sessions = {}
+
+---@type function
+---@param scheme string
+---@param host string
+---@param port integer
+---@return string origin
+local function make_origin(scheme, host, port)
+    return scheme .. "://" .. host .. ":" .. port
+end
+
+---@type function
+---@param key string
+---@param sample number
+local function record_latency(key, sample)
+    local stats = ngx.shared.peer_stats
+    local current = stats:get(key)
+    if current then
+        sample = current + EWMA_WEIGHT * (sample - current)
+    end
+    stats:set(key, sample)
+end
+
+---@type function
+---@param uri string
+---@param params table Request parameters, as for resty.http request_uri
+---@param timeout integer|integer[] Timeout, or {connect, send, read} timeouts (in milliseconds)
+---@return table? res, string? err, table? httpc
+---Make a request, leaving the response body to be read with res.body_reader.
+---The connection (httpc) must then be handed to peerclient.keepalive once the
+---body is read, or closed.
+function peerclient.request(uri, params, timeout)
+    local httpc = resty_http.new()
+    if type(timeout) == "table" then
+        httpc:set_timeouts(timeout[1], timeout[2], timeout[3])
+    else
+        httpc:set_timeouts(timeout, timeout, timeout)
+    end
+
+    local parsed_uri, err = httpc:parse_uri(uri)
+    if not parsed_uri then
+        return nil, err
+    end
+    local scheme, host, port, path, query = unpack(parsed_uri)
+    local origin = make_origin(scheme, host, port)
+
+    ngx.update_time()
+    local tic = ngx.now()
+    local ok, ssl_session
+    ok, err, ssl_session = httpc:connect({
+        scheme = scheme,
+        host = host,
+        port = port,
+        ssl_server_name = host,
+        ssl_verify = true,
+        ssl_reused_session = ssl_sessions[origin],
+        pool = origin,
+        pool_size = config.data.peer_pool_size,
+    })
+    if not ok then
+        return nil, err
+    end
+    if ssl_session then
+        ssl_sessions[origin] = ssl_session
+    end
+
+    local reused = httpc.sock:getreusedtimes()
+    ngx.update_time()
+    local connected = ngx.now()
+    if reused == 0 then
+        record_latency("connect:" .. origin, (connected - tic) * 1000)
+        ngx.shared.peer_stats:incr("connections:" .. origin, 1, 0)
+    else
+        ngx.shared.peer_stats:incr("reused:" .. origin, 1, 0)
+    end
+
+    params.path = path
+    params.query = params.query or query
+    local res
+    res, err = httpc:request(params)
+    if not res then
+        httpc:close()
+        return nil, err
+    end
+    ngx.update_time()
+    record_latency("first_byte:" .. origin, (ngx.now() - connected) * 1000)
+    return res, nil, httpc
+end
+
+---@type function
+---@param httpc table
+---Return a connection whose response was read to the pool
+function peerclient.keepalive(httpc)
+    local ok, err = httpc:set_keepalive(config.data.peer_pool_idle_timeout, config.data.peer_pool_size)
+    if not ok then
+        ngx.log(ngx.INFO, "Not keeping peer connection alive: ", err)
+    end
+end
+
+---@type function
+---@param uri string
+---@param params table Request parameters, as for resty.http request_uri
+---@param timeout integer|integer[] Timeout, or {connect, send, read} timeouts (in milliseconds)
+---@return table? res, string? err
+---Make a request, reading the whole response body into res.body
+---params.body may be a function returning chunks of the body, for streaming
+function peerclient.request_uri(uri, params, timeout)
+    local res, err, httpc = peerclient.request(uri, params, timeout)
+    if not res then
+        return nil, err
+    end
+    ---@cast httpc table
+    if res.has_body then
+        local body
+        body, err = res:read_body()
+        if not body then
+            httpc:close()
+            return nil, err
+        end
+        res.body = body
+    end
+    peerclient.keepalive(httpc)
+    return res
+end
+
+---@type function
+---@param uri string Any URI on the peer
+---@return PeerLatency? latency
+---Latency statistics for the origin of a URI
+function peerclient.latency(uri)
+    local parsed_uri = resty_http.new():parse_uri(uri)
+    if not parsed_uri then
+        return nil
+    end
+    local scheme, host, port = unpack(parsed_uri)
+    local origin = make_origin(scheme, host, port)
+    local stats = ngx.shared.peer_stats
+    return {
+        connect = stats:get("connect:" .. origin),
+        first_byte = stats:get("first_byte:" .. origin),
+        connections = stats:get("connections:" .. origin) or 0,
+        reused = stats:get("reused:" .. origin) or 0,
+    }
+end
+
+return peerclient
@@ -0,0 +1,79 @@
+local ngx = require("ngx")
+local config = require("config")
+local gossip = require("gossip")
+
+-- Placement of files on the cluster by weighted rendezvous hashing: each
+-- member scores a path by hashing the two together, and the member with the
+-- highest score owns it. Every node computes the same owner from the gossip
+-- membership alone, and when a member joins or leaves only the paths it wins
+-- or owned move.
+--
+-- With config placement_weight, a member's chance of owning a path is
+-- proportional to the size ("capacity") or the free space ("free") of its
+-- disk, as published in its gossip load. Weighting by free space moves
+-- paths whenever the free space changes, so it trades some stability of the
+-- placement for evening out the disks.
+
+local placement = {}
+
+---@type function
+---@param peer string
+---@return number weight
+local function member_weight(peer)
+    if config.data.placement_weight == "none" then
+        return 1
+    end
+    local load = gossip.get_load(peer)
+    if not load then
+        return 1
+    end
+    local bytes = config.data.placement_weight == "free" and load.disk_free or load.disk_total
+    -- In units of GB, so that weights are of order one
+    return math.max(bytes / 1e9, 1e-3)
+end
+
+---@type function
+---@param peer string
+---@param path string
+---@param weight number
+---@return number score
+local function score(peer, path, weight)
+    local digest = ngx.md5_bin(peer .. "\n" .. path)
+    local b1, b2, b3, b4 = digest:byte(1, 4)
+    -- Uniform in (0, 1)
+    local h = (((b1 * 256 + b2) * 256 + b3) * 256 + b4 + 0.5) / 4294967296
+    return -weight / math.log(h)
+end
+
+---@type function
+---@return string[] members This node and its alive peers, sorted
+---Peers that failed or have not been heard from yet own no paths, so that
+---uploads are not sent to them until they gossip again
+function placement.members()
+    local peers, _ = gossip.peers()
+    local members = {config.data.server_address}
+    for peer, _ in pairs(peers) do
+        if peer ~= config.data.server_address and gossip.is_alive(peer) then
+            table.insert(members, peer)
+        end
+    end
+    table.sort(members)
+    return members
+end
+
+---@type function
+---@param path string Path of the file relative to the webdav root
+---@return string owner Address of the member that owns path
+function placement.owner(path)
+    local best, best_score = nil, -1
+    for _, member in ipairs(placement.members()) do
+        local s = score(member, path, member_weight(member))
+        if s > best_score then
+            best, best_score = member, s
+        end
+    end
+    ---@cast best string
+    return best
+end
+
+return placement
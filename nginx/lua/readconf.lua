@@ -0,0 +1,71 @@
+-- Renders the nginx directives that tune /webdav_read from config.lua and
+-- config.json, as nginx only reads its own configuration at startup.
+-- docker-entrypoint.sh runs this with luajit before starting nginx:
+--   luajit readconf.lua <config.json> <output directory>
+-- which writes <output>/read.main and <output>/read.conf. The output is
+-- /etc/nginx/generated, outside of conf.d, which may be a bind mount of the
+-- source tree.
+--
+-- In the "auto" read mode, nginx picks the strategy by file size: files
+-- smaller than read_directio_min_size are sent with sendfile, and larger ones
+-- are read with O_DIRECT into aligned buffers by the read thread pool, so that
+-- big reads do not block the workers on disk.
+
+local script_dir = arg[0]:match("(.*/)") or "./"
+package.path = script_dir .. "?.lua;" .. package.path
+-- config.lua requires ngx, which only exists inside nginx
+package.loaded["ngx"] = package.loaded["ngx"] or {}
+
+local config = require("config")
+
+local readconf = {}
+
+---@type function
+---@return string directives For the main context
+function readconf.main_directives()
+    return string.format(
+        "thread_pool read threads=%d max_queue=%d;\n",
+        config.data.read_thread_pool_threads, config.data.read_thread_pool_max_queue
+    )
+end
+
+---@type function
+---@return string directives For the /webdav_read location
+function readconf.location_directives()
+    local mode = config.data.read_mode
+    local lines = {}
+    if mode == "auto" then
+        table.insert(lines, "sendfile on;")
+        table.insert(lines, "aio threads=read;")
+        table.insert(lines, string.format("directio %d;", config.data.read_directio_min_size))
+        table.insert(lines, string.format("directio_alignment %d;", config.data.read_directio_alignment))
+    elseif mode == "sendfile" then
+        table.insert(lines, "sendfile on;")
+    elseif mode == "buffered" then
+        table.insert(lines, "sendfile off;")
+    else
+        error("unknown read_mode " .. tostring(mode))
+    end
+    table.insert(lines, string.format(
+        "output_buffers %d %d;", config.data.read_output_buffers, config.data.read_output_buffer_size
+    ))
+    return table.concat(lines, "\n") .. "\n"
+end
+
+---@type function
+---@param path string
+---@param content string
+local function write_file(path, content)
+    local f = assert(io.open(path, "w"))
+    f:write("# Generated from config.json by nginx/lua/readconf.lua\n", content)
+    f:close()
+end
+
+local config_path, outdir = ...
+if config_path and outdir then
+    config.load(config_path)
+    write_file(outdir .. "/read.main", readconf.main_directives())
+    write_file(outdir .. "/read.conf", readconf.location_directives())
+end
+
+return readconf
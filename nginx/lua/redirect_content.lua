@@ -1,15 +1,30 @@
 local ngx = require("ngx")
-local resty_http = require("resty.http")
+local peerclient = require("peerclient")
 local fileutil = require("fileutil")
 local config = require("config")
 local gossip = require("gossip")
+local locationcache = require("locationcache")
+local resty_lock = require("resty.lock")
+local metrics = require("metrics")
+local placement = require("placement")
+local cachestore = require("cachestore")
 
 
 -- TODO: always "redirect"?
 local path = ngx.var.request_uri:sub(#"/redirect" + 1)
 local webdav_uri = config.data.uriprefix .. path
+
+-- Uploads go to the node that owns the path (see placement), without asking anyone
+if ngx.var.request_method == "PUT" then
+    metrics.inc("nginx_webdav_redirect_lookups_total", {result = "placed"})
+    ngx.status = ngx.HTTP_TEMPORARY_REDIRECT
+    ngx.header["Location"] = placement.owner(path) .. webdav_uri:sub(2)
+    return ngx.exit(ngx.OK)
+end
+
 local stat = fileutil.get_metadata(config.data.local_path .. path, false)
 if stat.exists then
+    metrics.inc("nginx_webdav_redirect_lookups_total", {result = "local"})
     ngx.status = ngx.HTTP_TEMPORARY_REDIRECT
     -- TODO: do we want to use the full url (config.data.server_address)
     ngx.header["Location"] = webdav_uri
@@ -22,18 +37,16 @@ end
 ---@param token string Bearer token for authentication
 ---@return {peer: string, location: string?} res Response from peer
 local function peer_query_file(peer, uri, token)
-    local httpc = resty_http.new()
-    httpc:set_timeouts(config.data.peer_query_timeout, config.data.peer_query_timeout, config.data.peer_query_timeout)
     -- peer has trailing slash, uri has leading slash
     local location = peer .. uri:sub(2)
     ngx.log(ngx.NOTICE, "Querying location: ", location)
-    local res, err = httpc:request_uri(location, {
+    local res, err = peerclient.request_uri(location, {
         method = "HEAD",
         headers = {
             ["Authorization"] = "Bearer " .. token,
             ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
         },
-    })
+    }, config.data.peer_query_timeout)
     if not res then
         ngx.log(ngx.ERR, "Failed to send file query to " .. peer .. ": " .. err)
         gossip.handle_peer_error(peer, err)
@@ -47,8 +60,171 @@ local function peer_query_file(peer, uri, token)
     return {peer = peer, location = nil}
 end
 
--- Ask our peers if they have the file
+---@type function
+---@param candidates string[] Peers to query
+---@param token string Bearer token for authentication
+---@return Replica[]? replicas, string? err
+---Ask the candidates if they have the file, returning those that have it.
+---With config redirect_selection "weighted", the answers that arrive within
+---redirect_collect_timeout of the first positive one are included, otherwise
+---only the first.
+local function query_peers(candidates, token)
+    ---@type table<string, ngx.thread>
+    local threads = {}
+    for _, peer in ipairs(candidates) do
+        local co, err = ngx.thread.spawn(peer_query_file, peer, webdav_uri, token)
+        if not co then
+            ngx.log(ngx.ERR, "Failed to spawn thread: ", err)
+        else
+            threads[peer] = co
+        end
+    end
+
+    ---@type Replica[]
+    local replicas = {}
+    -- Ends the collection of answers, once started
+    local timer = nil
+    while next(threads) ~= nil do
+        local lthreads = {}
+        for _, thread in pairs(threads) do
+            table.insert(lthreads, thread)
+        end
+        if timer then
+            table.insert(lthreads, timer)
+        end
+        local ok, res = ngx.thread.wait(unpack(lthreads))
+        if not ok then
+            return nil, "Thread error: " .. tostring(res)
+        end
+        if res == nil then
+            -- The timer finished
+            timer = nil
+            break
+        end
+        threads[res.peer] = nil
+        if res.location then
+            table.insert(replicas, {peer = res.peer, location = res.location})
+            if config.data.redirect_selection ~= "weighted" then
+                break
+            end
+            if not timer then
+                timer = ngx.thread.spawn(function()
+                    ngx.sleep(config.data.redirect_collect_timeout / 1000)
+                end)
+            end
+        end
+    end
+    -- Remaining queries are aborted when the request finishes
+    if timer then
+        ngx.thread.kill(timer)
+    end
+    return replicas
+end
+
+---@type function
+---@param token string Bearer token for authentication
+---@return Replica[]? replicas, string? err
+---Ask our peers if they have the file, returning the peers that have it.
+---The peers whose namespace summary rules out the file are only asked if
+---none of the others has it, as their summary may predate the file.
+local function find_replicas(token)
+    local peers, _ = gossip.peers()
+    local npeers = 0
+
+    -- Files uploaded through /redirect are on the owner of their path
+    local owner = nil
+    if config.data.redirect_read_owner_first then
+        owner = placement.owner(path)
+        if owner ~= config.data.server_address and peers[owner] and gossip.may_have_file(owner, path) then
+            local res = peer_query_file(owner, webdav_uri, token)
+            if res.location then
+                metrics.observe("nginx_webdav_redirect_fanout_peers", nil, 1)
+                return {{peer = owner, location = res.location}}
+            end
+        else
+            owner = nil
+        end
+    end
+
+    local candidates, excluded = {}, {}
+    for peer, _ in pairs(peers) do
+        npeers = npeers + 1
+        if peer ~= config.data.server_address and peer ~= owner then
+            if gossip.may_have_file(peer, path) then
+                table.insert(candidates, peer)
+            else
+                table.insert(excluded, peer)
+            end
+        end
+    end
+    local nqueried = #candidates + (owner and 1 or 0)
+    ngx.log(ngx.INFO, "Querying ", nqueried, " of ", npeers, " peers for ", path)
+    local replicas, err = query_peers(candidates, token)
+    if replicas and #replicas == 0 and #excluded > 0 then
+        ngx.log(ngx.INFO, "Not found on the peers that may have ", path, ", querying the other ", #excluded)
+        nqueried = nqueried + #excluded
+        replicas, err = query_peers(excluded, token)
+    end
+    metrics.observe("nginx_webdav_redirect_fanout_peers", nil, nqueried)
+    return replicas, err
+end
+
+---@type function
+---@param replicas Replica[]
+---@return string location
+---Pick one of the replicas at random, weighted by the load of their peers
+local function choose(replicas)
+    if #replicas == 1 then
+        return replicas[1].location
+    end
+    local weights, total = {}, 0
+    for i, replica in ipairs(replicas) do
+        weights[i] = gossip.peer_weight(replica.peer)
+        total = total + weights[i]
+    end
+    if total <= 0 then
+        return replicas[math.random(#replicas)].location
+    end
+    local r = math.random() * total
+    for i, replica in ipairs(replicas) do
+        r = r - weights[i]
+        if r <= 0 then
+            return replica.location
+        end
+    end
+    return replicas[#replicas].location
+end
+
+---@type function
+---@param replicas Replica[]|false
+local function respond(replicas)
+    if replicas then
+        local location = choose(replicas)
+        -- Copy the file here in the background, so that the next reads are local
+        if config.data.cache_enabled and ngx.var.request_method == "GET" then
+            local err = cachestore.fill(path, location)
+            if err then
+                ngx.log(ngx.WARN, "Not caching ", path, ": ", err)
+            else
+                metrics.inc("nginx_webdav_redirect_lookups_total", {result = "filling"})
+            end
+        end
+        ngx.status = ngx.HTTP_TEMPORARY_REDIRECT
+        ngx.header["Location"] = location
+    else
+        -- No peers have the file, return 404
+        ngx.status = ngx.HTTP_NOT_FOUND
+    end
+    ngx.exit(ngx.OK)
+end
+
 local tic = ngx.now()
+local cached = locationcache.get(path)
+if cached ~= nil then
+    metrics.inc("nginx_webdav_redirect_lookups_total", {result = "cached"})
+    respond(cached)
+end
+
 -- TODO: we could use the token that the client gives us, is that better?
 local token = ngx.shared.gossip_data:get("bearer_token")
 if not token then
@@ -56,42 +232,51 @@ if not token then
     ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
     ngx.exit(ngx.OK)
 end
-local peers, _ = gossip.peers()
----@type table<string, ngx.thread>
-local threads = {}
-for peer, _ in pairs(peers) do
-    local co, err = ngx.thread.spawn(peer_query_file, peer, webdav_uri, token)
-    if not co then
-        ngx.log(ngx.ERR, "Failed to spawn thread: ", err)
-    else
-        threads[peer] = co
-    end
-end
 
--- Wait for first thread to finish
-while next(threads) ~= nil do
-    local lthreads = {}
-    for _, thread in pairs(threads) do
-        table.insert(lthreads, thread)
-    end
-    local ok, res = ngx.thread.wait(unpack(lthreads))
-    if not ok then
-        ngx.log(ngx.ERR, "Thread error: ", res)
-        ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
-        ngx.exit(ngx.OK)
-    else
-        threads[res.peer] = nil
-        if res.location then
-            ngx.status = ngx.HTTP_TEMPORARY_REDIRECT
-            ngx.header["Location"] = res.location
-            ngx.exit(ngx.OK)
+-- Only one request per path queries the peers, the others wait for its answer
+local lock, err = resty_lock:new("redirect_locks", {timeout = config.data.redirect_lock_timeout})
+if not lock then
+    ngx.log(ngx.ERR, "Failed to create redirect lock: ", err)
+else
+    local elapsed
+    elapsed, err = lock:lock(path)
+    if not elapsed then
+        ngx.log(ngx.WARN, "Failed to acquire redirect lock for ", path, ": ", err)
+        lock = nil
+    end
+    cached = locationcache.get(path)
+    if cached ~= nil then
+        if lock then
+            lock:unlock()
         end
+        -- Answered by the request that held the lock
+        metrics.inc("nginx_webdav_redirect_lookups_total", {result = "cached"})
+        respond(cached)
     end
 end
 
--- No peers have the file, return 404
-ngx.status = ngx.HTTP_NOT_FOUND
+local replicas
+replicas, err = find_replicas(token)
+if err then
+    if lock then
+        lock:unlock()
+    end
+    ngx.log(ngx.ERR, err)
+    ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
+    ngx.exit(ngx.OK)
+end
+---@cast replicas Replica[]
+if #replicas > 0 then
+    locationcache.set(path, replicas)
+    metrics.inc("nginx_webdav_redirect_lookups_total", {result = "found"})
+else
+    locationcache.set_missing(path)
+    metrics.inc("nginx_webdav_redirect_lookups_total", {result = "not_found"})
+end
+if lock then
+    lock:unlock()
+end
 
 local toc = ngx.now()
 ngx.log(ngx.NOTICE, "Redirect took ", toc - tic, " seconds")
-ngx.exit(ngx.OK)
\ No newline at end of file
+respond(#replicas > 0 and replicas)
@@ -0,0 +1,134 @@
+local ngx = require("ngx")
+local lrucache = require("resty.lrucache")
+local openidc = require("resty.openidc")
+local config = require("config")
+
+-- Bearer token verification and WLCG capability checks for the access phase.
+--
+-- A per-worker LRU, keyed by the md5 of the token, sits in front of
+-- openidc.bearer_jwt_verify (itself cached in the jwt_verification shared
+-- dict) until the token expires. The scopes of a token are compiled once
+-- into the path prefixes of each capability, so that authorizing a request
+-- is a prefix check against its path.
+--
+-- See https://github.com/WLCG-AuthZ-WG/common-jwt-profile/blob/master/profile.md#capability-based-authorization-scope
+-- With config wlcg_strict_scopes, storage.create and storage.modify are
+-- enforced as in the profile. Otherwise storage.read gates every operation
+-- on its paths, and storage.create and storage.modify grant nothing.
+
+local tokenauth = {}
+
+---@class Capabilities
+---@field read string[] Path prefixes, ending with "/"
+---@field create string[]
+---@field modify string[]
+---@field hepcdn_view boolean
+---@field hepcdn_access boolean
+
+---@class VerifiedToken
+---@field sub string
+---@field capabilities Capabilities
+
+local lru = nil
+
+---@type function
+---@return table lru
+local function worker_lru()
+    if not lru then
+        local err
+        lru, err = lrucache.new(config.data.token_cache_lru_size)
+        if not lru then
+            error("failed to create the token lru cache: " .. (err or "unknown"))
+        end
+    end
+    return lru
+end
+
+---@type function
+---@param list string[]
+---@param other string[] List to add to list
+local function extend(list, other)
+    for _, prefix in ipairs(other) do
+        table.insert(list, prefix)
+    end
+end
+
+---@type function
+---@param scope string Space separated scopes of the token
+---@return Capabilities
+local function compile(scope)
+    local caps = {read = {}, create = {}, modify = {}, hepcdn_view = false, hepcdn_access = false}
+    for item in scope:gmatch("%S+") do
+        local name, path = item:match("^storage%.(%a+):(/.*)$")
+        if name then
+            path = path:gsub("/*$", "") .. "/"
+            -- storage.stage: Read the data, potentially causing data to be staged
+            -- from a nearline resource. This is a superset of storage.read.
+            if name == "stage" then
+                name = "read"
+            end
+            if caps[name] then
+                table.insert(caps[name], path)
+            end
+        elseif item == "hepcdn.view" then
+            caps.hepcdn_view = true
+        elseif item == "hepcdn.access" then
+            caps.hepcdn_view = true
+            caps.hepcdn_access = true
+        end
+    end
+    if config.data.wlcg_strict_scopes then
+        -- storage.modify is a strict superset of storage.create
+        extend(caps.create, caps.modify)
+    else
+        caps.create, caps.modify = caps.read, caps.read
+    end
+    return caps
+end
+
+---@type function
+---@return VerifiedToken? token, string? err
+---Verify the bearer token of the request
+function tokenauth.verify()
+    local token = ngx.var.http_authorization:match("^[Bb]earer%s+(%S+)%s*$")
+    local key = token and ngx.md5(token)
+    local cache = worker_lru()
+    if key then
+        local cached = cache:get(key)
+        if cached then
+            return cached, nil
+        end
+    end
+
+    local res, err = openidc.bearer_jwt_verify({
+        public_key = config.data.openidc_pubkey,
+        token_signing_alg_values_expected = { "RS256" }
+    })
+    if err or not res then
+        return nil, err or "no access token provided"
+    end
+    ---@type VerifiedToken
+    local verified = {sub = res.sub, capabilities = compile(res.scope or "")}
+    -- Tokens without an expiry are verified every time
+    local ttl = key and tonumber(res.exp) and res.exp - ngx.now()
+    if ttl and ttl > 0 then
+        cache:set(key, verified, ttl)
+    end
+    return verified, nil
+end
+
+---@type function
+---@param capabilities Capabilities
+---@param capability "read"|"create"|"modify"
+---@param path string Request path, relative to the webdav root
+---@return boolean allowed
+function tokenauth.allows(capabilities, capability, path)
+    for _, prefix in ipairs(capabilities[capability]) do
+        if path:sub(1, #prefix) == prefix or path .. "/" == prefix then
+            return true
+        end
+    end
+    return false
+end
+
+return tokenauth
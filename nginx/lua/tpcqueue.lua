@@ -0,0 +1,363 @@
+local ngx = require("ngx")
+local cjson = require("cjson")
+local resty_lock = require("resty.lock")
+local config = require("config")
+local metrics = require("metrics")
+
+-- Node-wide registry of third party copies, kept in the tpc_transfers shared
+-- dict so that the limits hold across workers.
+--
+-- A pull only starts when fewer than config tpc_max_active pulls are running,
+-- and fewer than tpc_max_active_per_host from its source host. Otherwise it
+-- waits its turn in a FIFO queue, or is rejected if config tpc_overload is
+-- "reject". A queued pull is passed over by later ones only while its own
+-- source host is at its limit.
+--
+-- Keys of the dict:
+--   active:<id>   JSON of a running transfer (see TransferInfo)
+--   pulls         number of running pulls
+--   pulls:<host>  number of running pulls from host
+--   ticket:<n>    source host of the n-th queued pull
+--   head, tail    range of queue tickets that may still be waiting
+--   queued        number of queued pulls
+--   recounted     when the counters were last rebuilt from the entries
+--   lock          taken to admit a pull
+-- Transfers and tickets expire unless the request that owns them refreshes
+-- them, so that a crashed worker does not hold a slot forever. The counters
+-- cannot expire with them, so they are rebuilt from the entries every
+-- tpc_registry_ttl.
+
+local tpcqueue = {}
+
+---@class TransferInfo
+---@field kind "pull"|"push"
+---@field host string Host:port of the remote end
+---@field source string
+---@field destination string
+---@field start number
+---@field bytes integer Bytes transferred so far
+---@field rate number Bytes per second since the previous update
+
+---@class Transfer
+---@field id string
+---@field info TransferInfo
+---@field ticket integer? Queue ticket, while queued
+---@field heartbeat ngx.thread?
+---@field updated number Time of the previous update of info
+
+---@type function
+---@param uri string
+---@return string host Host and port of uri, lowercased
+local function uri_host(uri)
+    local authority = uri:match("^%a[%w+.-]*://([^/?#]+)") or uri
+    -- Drop any credentials
+    return (authority:gsub("^.*@", "")):lower()
+end
+
+---@type function
+---Rebuild the counters from the entries, if they are due. Must hold the lock.
+local function recount()
+    local dict = ngx.shared.tpc_transfers
+    local now = ngx.now()
+    if now - (dict:get("recounted") or 0) < config.data.tpc_registry_ttl then
+        return
+    end
+    local total, by_host, queued = 0, {}, 0
+    for _, key in ipairs(dict:get_keys(0)) do
+        if key:sub(1, 7) == "active:" then
+            local value = dict:get(key)
+            if value then
+                local info = cjson.decode(value)
+                if info.kind == "pull" then
+                    total = total + 1
+                    by_host[info.host] = (by_host[info.host] or 0) + 1
+                end
+            end
+        elseif key:sub(1, 6) == "pulls:" then
+            dict:delete(key)
+        elseif key:sub(1, 7) == "ticket:" then
+            queued = queued + 1
+        end
+    end
+    dict:set("pulls", total)
+    for host, count in pairs(by_host) do
+        dict:set("pulls:" .. host, count)
+    end
+    dict:set("queued", queued)
+    dict:set("recounted", now)
+end
+
+---@type function
+---@param host string
+---@return integer active Running pulls from host
+local function active_from(host)
+    return ngx.shared.tpc_transfers:get("pulls:" .. host) or 0
+end
+
+---@type function
+---@param active integer
+---@param limit integer
+---@return boolean
+local function below(active, limit)
+    return limit <= 0 or active < limit
+end
+
+---@type function
+---@param host string
+---@param ticket integer? Our queue ticket, if queued
+---@return boolean admissible
+---Whether a pull from host can start now. Must hold the lock.
+local function admissible(host, ticket)
+    local dict = ngx.shared.tpc_transfers
+    recount()
+    local per_host = config.data.tpc_max_active_per_host
+    if not below(dict:get("pulls") or 0, config.data.tpc_max_active) or not below(active_from(host), per_host) then
+        return false
+    end
+    -- Earlier queued pulls that could start go first
+    local head = dict:get("head") or 1
+    local last = ticket and ticket - 1 or (dict:get("tail") or 0)
+    for n = head, last do
+        local queued_host = dict:get("ticket:" .. n)
+        if queued_host == nil and n == head then
+            -- Admitted or expired
+            head = head + 1
+            dict:set("head", head)
+        elseif queued_host and below(active_from(queued_host), per_host) then
+            return false
+        end
+    end
+    return true
+end
+
+---@type function
+---@param transfer Transfer
+local function save(transfer)
+    local ok, err = ngx.shared.tpc_transfers:set(
+        "active:" .. transfer.id, cjson.encode(transfer.info), config.data.tpc_registry_ttl
+    )
+    if not ok then
+        ngx.log(ngx.ERR, "Failed to register transfer ", transfer.id, ": ", err)
+    end
+end
+
+---@type function
+---@param transfer Transfer
+---Refresh the registry entry of a running transfer, until killed
+local function heartbeat(transfer)
+    local interval = config.data.tpc_registry_ttl / 3
+    while true do
+        ngx.sleep(interval)
+        ngx.update_time()
+        local now = ngx.now()
+        local bytes = (ngx.ctx.pulled_bytes_received or 0) + (ngx.ctx.body_bytes_sent or 0)
+        if now > transfer.updated then
+            transfer.info.rate = (bytes - transfer.info.bytes) / (now - transfer.updated)
+        end
+        transfer.info.bytes = bytes
+        transfer.updated = now
+        save(transfer)
+    end
+end
+
+---@type function
+---@param transfer Transfer
+---Add the transfer to the running ones. Pulls must hold the lock.
+local function register(transfer)
+    ngx.update_time()
+    transfer.info.start = ngx.now()
+    transfer.updated = transfer.info.start
+    save(transfer)
+    if transfer.info.kind == "pull" then
+        local dict = ngx.shared.tpc_transfers
+        dict:incr("pulls", 1, 0)
+        dict:incr("pulls:" .. transfer.info.host, 1, 0)
+    end
+end
+
+---@type function
+---@param transfer Transfer
+local function start_heartbeat(transfer)
+    local co, err = ngx.thread.spawn(heartbeat, transfer)
+    if not co then
+        ngx.log(ngx.ERR, "Failed to spawn transfer heartbeat: ", err)
+    end
+    transfer.heartbeat = co
+end
+
+---@type function
+---@param lock table
+---@param ok boolean
+---@return any ...
+local function unlock(lock, ok, ...)
+    lock:unlock()
+    if not ok then
+        return nil, ...
+    end
+    return ...
+end
+
+---@type function
+---@param callback function
+---@return any ... What callback returns, or nil and an error if the lock failed
+local function locked(callback, ...)
+    local lock, err = resty_lock:new("tpc_transfers", {timeout = config.data.tpc_queue_poll_interval * 10})
+    if not lock then
+        return nil, "failed to create lock: " .. err
+    end
+    local elapsed
+    elapsed, err = lock:lock("lock")
+    if not elapsed then
+        return nil, "failed to lock the transfer queue: " .. err
+    end
+    return unlock(lock, pcall(callback, ...))
+end
+
+---@type function
+---@param kind "pull"|"push"
+---@param source string
+---@param destination string
+---@return "active"|"queued"|nil state, string? err
+---Register a transfer of the current request. A push always starts; a pull
+---starts if it is within the limits, else it is queued (see tpcqueue.wait),
+---or nil is returned if it has to be rejected. tpcqueue.finish must be called
+---once the request is over, whatever the outcome.
+function tpcqueue.enter(kind, source, destination)
+    ---@type Transfer
+    local transfer = {
+        id = ngx.var.request_id,
+        info = {
+            kind = kind,
+            host = uri_host(kind == "pull" and source or destination),
+            source = source,
+            destination = destination,
+            start = 0,
+            bytes = 0,
+            rate = 0,
+        },
+        updated = 0,
+    }
+    if kind == "push" then
+        ngx.ctx.tpc_transfer = transfer
+        register(transfer)
+        start_heartbeat(transfer)
+        return "active"
+    end
+
+    local state, err = locked(function()
+        if admissible(transfer.info.host) then
+            register(transfer)
+            return "active"
+        end
+        if config.data.tpc_overload == "reject" then
+            return nil, "too many transfers"
+        end
+        local dict = ngx.shared.tpc_transfers
+        if (dict:get("queued") or 0) >= config.data.tpc_max_queued then
+            return nil, "transfer queue is full"
+        end
+        dict:incr("queued", 1, 0)
+        transfer.ticket = dict:incr("tail", 1, 0)
+        dict:set("ticket:" .. transfer.ticket, transfer.info.host, config.data.tpc_registry_ttl)
+        return "queued"
+    end)
+    if not state then
+        metrics.inc("nginx_webdav_tpc_rejected_total")
+        return nil, err
+    end
+    if state == "queued" then
+        metrics.inc("nginx_webdav_tpc_queued", nil, 1)
+    end
+    ngx.ctx.tpc_transfer = transfer
+    if state == "active" then
+        start_heartbeat(transfer)
+    end
+    return state
+end
+
+---@type function
+---@param on_poll fun(position: integer): boolean? Called every poll, return false to give up
+---@return boolean? ok, string? err
+---Wait until the queued pull of the current request can start
+function tpcqueue.wait(on_poll)
+    local transfer = ngx.ctx.tpc_transfer
+    local dict = ngx.shared.tpc_transfers
+    local deadline = ngx.now() + config.data.tpc_queue_timeout
+    while true do
+        ngx.sleep(config.data.tpc_queue_poll_interval)
+        local admitted, err = locked(function()
+            if admissible(transfer.info.host, transfer.ticket) then
+                dict:delete("ticket:" .. transfer.ticket)
+                dict:incr("queued", -1, 0)
+                transfer.ticket = nil
+                register(transfer)
+                return true
+            end
+            -- Refresh our place in the queue
+            dict:set("ticket:" .. transfer.ticket, transfer.info.host, config.data.tpc_registry_ttl)
+            return false
+        end)
+        if admitted then
+            metrics.inc("nginx_webdav_tpc_queued", nil, -1)
+            start_heartbeat(transfer)
+            return true
+        elseif err then
+            ngx.log(ngx.WARN, err)
+        end
+        if ngx.now() >= deadline then
+            return nil, "timed out waiting in the transfer queue"
+        end
+        local position = transfer.ticket - (dict:get("head") or 1) + 1
+        if on_poll(position) == false then
+            return nil, "gave up waiting in the transfer queue"
+        end
+    end
+end
+
+---@type function
+---Remove the transfer of the current request from the registry or the queue
+function tpcqueue.finish()
+    local transfer = ngx.ctx.tpc_transfer
+    if not transfer then
+        return
+    end
+    ngx.ctx.tpc_transfer = nil
+    local dict = ngx.shared.tpc_transfers
+    -- In the log phase the request's threads are already gone
+    if transfer.heartbeat and ngx.get_phase() == "content" then
+        ngx.thread.kill(transfer.heartbeat)
+    end
+    if transfer.ticket then
+        metrics.inc("nginx_webdav_tpc_queued", nil, -1)
+        dict:delete("ticket:" .. transfer.ticket)
+        dict:incr("queued", -1, 0)
+    else
+        dict:delete("active:" .. transfer.id)
+        if transfer.info.kind == "pull" then
+            dict:incr("pulls", -1, 0)
+            dict:incr("pulls:" .. transfer.info.host, -1, 0)
+        end
+    end
+end
+
+---@type function
+---@return TransferInfo[] transfers Running transfers, oldest first
+---@return integer queued Pulls waiting in the queue
+function tpcqueue.list()
+    local dict = ngx.shared.tpc_transfers
+    local transfers = {}
+    for _, key in ipairs(dict:get_keys(0)) do
+        if key:sub(1, 7) == "active:" then
+            local value = dict:get(key)
+            if value then
+                local info = cjson.decode(value)
+                info.id = key:sub(8)
+                table.insert(transfers, info)
+            end
+        end
+    end
+    table.sort(transfers, function(a, b) return a.start < b.start end)
+    return transfers, math.max(dict:get("queued") or 0, 0)
+end
+
+return tpcqueue
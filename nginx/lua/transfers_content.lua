@@ -0,0 +1,18 @@
+local ngx = require("ngx")
+local cjson = require("cjson")
+local tpcqueue = require("tpcqueue")
+
+-- Running third party copies of this node, and how many pulls are queued
+local transfers, queued = tpcqueue.list()
+local now = ngx.now()
+for _, transfer in ipairs(transfers) do
+    transfer.elapsed = now - transfer.start
+    transfer.average_rate = transfer.elapsed > 0 and transfer.bytes / transfer.elapsed or 0
+end
+local message = cjson.encode({
+    active = setmetatable(transfers, cjson.array_mt),
+    queued = queued,
+})
+ngx.header["Content-Type"] = "application/json"
+ngx.header["Content-Length"] = #message
+ngx.print(message)
@@ -1,6 +1,12 @@
 local ngx = require("ngx")
-local openidc = require("resty.openidc")
 local config = require("config")
+local fileutil = require("fileutil")
+local cksumutil = require("cksumutil")
+local metrics = require("metrics")
+local tokenauth = require("tokenauth")
+
+-- Published as part of our load through gossip
+metrics.request_started()
 
 if not ngx.var.http_authorization then
     ngx.status = ngx.HTTP_UNAUTHORIZED
@@ -9,49 +15,60 @@ if not ngx.var.http_authorization then
     return ngx.exit(ngx.OK)
 end
 
-local opts = {
-    public_key = config.data.openidc_pubkey,
-    token_signing_alg_values_expected = { "RS256" }
-}
--- call bearer_jwt_verify for OAuth 2.0 JWT validation
-local res, err = openidc.bearer_jwt_verify(opts)
-
-if err or not res then
+local token, err = tokenauth.verify()
+if not token then
     ngx.status = ngx.HTTP_UNAUTHORIZED
-    ngx.say(err and err or "no access token provided")
+    ngx.say(err)
     return ngx.exit(ngx.OK)
 end
 
 -- Set the oidc_user, for use in access log
-ngx.var.oidc_user = res.sub
+ngx.var.oidc_user = token.sub
+
+-- Path of the resource relative to the webdav root, e.g. /webdav_read/a/b -> /a/b
+local path = ngx.var.uri:match("^/[^/]*(/.*)$") or "/"
+local method = ngx.var.request_method
 
 -- From https://github.com/WLCG-AuthZ-WG/common-jwt-profile/blob/master/profile.md#capability-based-authorization-scope
 
 -- storage.read: Read data. Only applies to “online” resources such as disk (as opposed to “nearline” such as tape where the stage authorization should be used in addition).
-local is_read = ngx.var.request_method == "GET" or ngx.var.request_method == "HEAD"
-if string.find(res.scope, "storage.read:/") == nil and is_read then
+-- A third party push only reads the local file.
+local is_read = method == "GET" or method == "HEAD" or method == "PROPFIND"
+    or (method == "COPY" and ngx.var.http_source == nil and ngx.var.http_destination ~= nil)
+if is_read and not tokenauth.allows(token.capabilities, "read", path) then
     ngx.status = ngx.HTTP_FORBIDDEN
     ngx.say("no permission to read this resource")
     return ngx.exit(ngx.OK)
 end
 
 -- storage.create: Upload data. This includes renaming files if the destination file does not already exist. This capability includes the creation of directories and subdirectories at the specified path, and the creation of any non-existent directories required to create the path itself. This authorization does not permit overwriting or deletion of stored data. The driving use case for a separate storage.create scope is to enable the stage-out of data from jobs on a worker node.
-local is_create = ngx.var.request_method == "PUT" or ngx.var.request_method == "COPY" or ngx.var.request_method == "MKCOL"
--- FIXME: using read permission for testing
-if string.find(res.scope, "storage.read:/") == nil and is_create then
+local is_create = not is_read and (method == "PUT" or method == "COPY" or method == "MKCOL")
+-- storage.modify: Change data. This includes renaming files, creating new files, and writing data. This permission includes overwriting or replacing stored data in addition to deleting or truncating data. This is a strict superset of storage.create.
+local is_modify = method == "DELETE" or method == "MOVE"
+if is_create and not tokenauth.allows(token.capabilities, "create", path) then
     ngx.status = ngx.HTTP_FORBIDDEN
     ngx.say("no permission to create this resource")
     return ngx.exit(ngx.OK)
 end
-
--- storage.modify: Change data. This includes renaming files, creating new files, and writing data. This permission includes overwriting or replacing stored data in addition to deleting or truncating data. This is a strict superset of storage.create.
-local is_modify = ngx.var.request_method == "DELETE" or ngx.var.request_method == "MOVE"
--- FIXME: using read permission for testing
-if string.find(res.scope, "storage.read:/") == nil and is_modify then
+if is_create and config.data.wlcg_strict_scopes and ngx.var.uri:find("^/webdav_")
+    and not tokenauth.allows(token.capabilities, "modify", path) then
+    -- Overwriting needs storage.modify, so look at the disk when the token
+    -- could create but not modify. /redirect leaves this to the peer.
+    is_modify = fileutil.get_metadata(config.data.local_path .. path, false).exists
+end
+if is_modify and not tokenauth.allows(token.capabilities, "modify", path) then
     ngx.status = ngx.HTTP_FORBIDDEN
     ngx.say("no permission to modify this resource")
     return ngx.exit(ngx.OK)
 end
 
--- storage.stage: Read the data, potentially causing data to be staged from a nearline resource to an online resource. This is a superset of storage.read.
--- TODO: implement this
+-- Look up any digest requested from /webdav_read now, as this phase can wait
+-- on the checksum thread pool and webdav_read_header_filter cannot
+local wanted_digests = cksumutil.parse_want_digest(ngx.var.http_want_digest)
+if is_read and ngx.var.uri:find("^/webdav_read/") and #wanted_digests > 0 then
+    local path = fileutil.get_request_local_path()
+    local stat = fileutil.get_metadata(path, false)
+    if stat.exists and not stat.is_directory then
+        ngx.ctx.digest = cksumutil.format_digest(cksumutil.get_digests(path, wanted_digests), wanted_digests)
+    end
+end
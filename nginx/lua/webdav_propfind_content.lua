@@ -0,0 +1,135 @@
+local ngx = require("ngx")
+local dirent = require("posix.dirent")
+local sys_stat = require("posix.sys.stat")
+local config = require("config")
+local cksumutil = require("cksumutil")
+local fileutil = require("fileutil")
+
+-- PROPFIND (RFC 4918) with Depth 0 or 1, answering the size, modification
+-- time and stored adler32 of the files, whatever properties were asked for.
+-- The multistatus response is streamed as the directory is read, in batches
+-- of config propfind_batch_size entries, so that the memory used does not
+-- grow with the size of the directory. Missing checksums are not computed.
+
+local DAV_CHECKSUMS = "http://www.dcache.org/2013/webdav"
+
+local XML_ESCAPES = {["&"] = "&amp;", ["<"] = "&lt;", [">"] = "&gt;", ['"'] = "&quot;"}
+
+ngx.req.discard_body()
+
+local file_path = fileutil.get_request_local_path():gsub("%?.*$", "")
+local uri = ngx.var.request_uri:gsub("%?.*$", "")
+
+local depth = ngx.var.http_depth or "1"
+if depth ~= "0" and depth ~= "1" then
+    ngx.status = ngx.HTTP_FORBIDDEN
+    ngx.header["Content-Type"] = 'application/xml; charset="utf-8"'
+    ngx.print('<?xml version="1.0" encoding="utf-8"?>\n'
+        .. '<d:error xmlns:d="DAV:"><d:propfind-finite-depth/></d:error>\n')
+    return ngx.exit(ngx.OK)
+end
+
+-- The upload and staging area is never listed
+local stat = nil
+if not ("/" .. file_path:sub(#config.data.local_path + 1) .. "/"):find("/.upload/", 1, true) then
+    stat = sys_stat.stat(file_path)
+end
+if not stat then
+    ngx.status = ngx.HTTP_NOT_FOUND
+    ngx.say("file not found")
+    return ngx.exit(ngx.OK)
+end
+
+---@type function
+---@param href string
+---@param entry table stat of the entry
+---@param adler32 string "" if unknown
+---@return string response
+local function format_response(href, entry, adler32)
+    local is_directory = sys_stat.S_ISDIR(entry.st_mode) ~= 0
+    local props = {
+        "<d:href>", (href:gsub('[&<>"]', XML_ESCAPES)), "</d:href><d:propstat><d:prop>",
+        "<d:getlastmodified>", ngx.http_time(entry.st_mtime), "</d:getlastmodified>",
+    }
+    if is_directory then
+        table.insert(props, "<d:resourcetype><d:collection/></d:resourcetype>")
+    else
+        table.insert(props, "<d:resourcetype/><d:getcontentlength>" .. entry.st_size .. "</d:getcontentlength>")
+        if adler32 ~= "" then
+            table.insert(props, "<ns:Checksums>adler32=" .. adler32 .. "</ns:Checksums>")
+        end
+    end
+    table.insert(props, "</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat>")
+    return "<d:response>" .. table.concat(props) .. "</d:response>\n"
+end
+
+---@type function
+---@param batch {href: string, path: string, stat: table}[]
+---@return boolean ok False if the client went away
+local function send(batch)
+    local paths = {}
+    for i, item in ipairs(batch) do
+        paths[i] = sys_stat.S_ISDIR(item.stat.st_mode) ~= 0 and "" or item.path
+    end
+    local err, checksums = cksumutil.check_adler32_many(paths)
+    if err then
+        ngx.log(ngx.WARN, "Failed to read checksums: ", err)
+    end
+    local out = {}
+    for i, item in ipairs(batch) do
+        out[i] = format_response(item.href, item.stat, checksums and checksums[i] or "")
+    end
+    ngx.print(out)
+    local ok
+    ok, err = ngx.flush(true)
+    if not ok then
+        ngx.log(ngx.INFO, "PROPFIND of ", uri, " aborted: ", err)
+        return false
+    end
+    return true
+end
+
+ngx.status = 207
+ngx.header["Content-Type"] = 'application/xml; charset="utf-8"'
+ngx.print('<?xml version="1.0" encoding="utf-8"?>\n<d:multistatus xmlns:d="DAV:" xmlns:ns="'
+    .. DAV_CHECKSUMS .. '">\n')
+
+local is_directory = sys_stat.S_ISDIR(stat.st_mode) ~= 0
+if is_directory and uri:sub(-1) ~= "/" then
+    uri = uri .. "/"
+end
+local batch = {{href = uri, path = file_path, stat = stat}}
+local ok = true
+if is_directory and depth == "1" then
+    local directory = file_path:gsub("/$", "")
+    local iter_ok, iter, state = pcall(dirent.files, directory)
+    if not iter_ok then
+        ngx.log(ngx.ERR, "Failed to list ", directory, ": ", iter)
+        iter, state = function() return nil end, nil
+    end
+    for name in iter, state do
+        if name ~= "." and name ~= ".." and name ~= ".upload" then
+            local path = directory .. "/" .. name
+            local entry = sys_stat.stat(path)
+            if entry then
+                local href = uri .. ngx.escape_uri(name)
+                if sys_stat.S_ISDIR(entry.st_mode) ~= 0 then
+                    href = href .. "/"
+                end
+                table.insert(batch, {href = href, path = path, stat = entry})
+                if #batch >= config.data.propfind_batch_size then
+                    ok = send(batch)
+                    if not ok then
+                        break
+                    end
+                    batch = {}
+                end
+            end
+        end
+    end
+end
+if ok then
+    send(batch)
+    ngx.print("</d:multistatus>\n")
+end
+return ngx.exit(ngx.OK)
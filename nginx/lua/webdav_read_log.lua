@@ -0,0 +1,11 @@
+local ngx = require("ngx")
+local fileutil = require("fileutil")
+local nsfilter = require("nsfilter")
+local accessindex = require("accessindex")
+local metrics = require("metrics")
+
+-- Recently read files are the last to be deleted (see diskgc)
+if ngx.status == ngx.HTTP_OK or ngx.status == ngx.HTTP_PARTIAL_CONTENT then
+    accessindex.touch(nsfilter.key(fileutil.get_request_local_path()))
+end
+metrics.log()
@@ -1,6 +1,213 @@
 local http = require("resty.http")
 local config = require("config")
 local fileutil = require("fileutil")
+local cksumutil = require("cksumutil")
+local peerclient = require("peerclient")
+local metrics = require("metrics")
+local tpcqueue = require("tpcqueue")
+
+---@type function
+---@return integer stripes
+---Number of parallel streams requested for this transfer
+local function requested_stripes()
+    -- X-Number-Of-Streams is the header XRootD and FTS use for this
+    local stripes = tonumber(ngx.var.http_x_number_of_streams or "") or config.data.tpc_stripes
+    return math.max(1, math.min(math.floor(stripes), config.data.tpc_max_stripes))
+end
+
+---@type function
+---@param source_uri string
+---@param headers table<string, string>
+---@param redirects integer?
+---@return {uri: string, size: integer?, accept_ranges: string?, digest: string?}? info, string? err
+---Send a HEAD request to the source to find out whether it can be fetched in stripes
+local function probe_source(source_uri, headers, redirects)
+    local httpc = http.new()
+    httpc:set_timeouts(config.data.tpc_connect_timeout, config.data.tpc_send_timeout, config.data.tpc_read_timeout)
+    local res, err = httpc:request_uri(source_uri, {
+        method = "HEAD",
+        headers = headers,
+        ssl_verify = true,
+    })
+    if not res then
+        return nil, err
+    end
+    local is_redirect = res.status == 301 or res.status == 302 or res.status == 303 or res.status == 307 or res.status == 308
+    redirects = redirects or 0
+    if is_redirect and redirects < config.data.tpc_redirect_limit then
+        return probe_source(res.headers["Location"], headers, redirects + 1)
+    end
+    if res.status ~= 200 then
+        return nil, "HEAD returned status " .. res.status
+    end
+    return {
+        uri = source_uri,
+        size = tonumber(res.headers["Content-Length"] or ""),
+        accept_ranges = res.headers["Accept-Ranges"],
+        digest = res.headers["Digest"],
+    }
+end
+
+---@type function
+---@param source_uri string
+---@param headers table<string, string>
+---@param destination_localpath string
+---@param first integer First byte of the stripe
+---@param last integer Last byte of the stripe (inclusive)
+---@param progress RangeProgress
+---@return string? err, integer? adler32, integer? length
+---Fetch one byte range of the source into the destination file
+local function pull_stripe(source_uri, headers, destination_localpath, first, last, progress)
+    local httpc = http.new()
+    httpc:set_timeouts(config.data.tpc_connect_timeout, config.data.tpc_send_timeout, config.data.tpc_read_timeout)
+    local parsed_uri, err = httpc:parse_uri(source_uri)
+    if not parsed_uri then
+        return "failed to parse URI: " .. err
+    end
+    local params = {
+        ssl_verify = true,
+    }
+    params.scheme, params.host, params.port, params.path, params.query = table.unpack(parsed_uri)
+    params.ssl_server_name = params.host
+    local ok
+    ok, err = httpc:connect(params)
+    if not ok then
+        return "connection to " .. params.host .. ":" .. params.port .. " failed: " .. err
+    end
+    params.headers = {}
+    for k, v in pairs(headers) do
+        params.headers[k] = v
+    end
+    params.headers["Want-Digest"] = nil
+    params.headers["Range"] = "bytes=" .. first .. "-" .. last
+    local res
+    res, err = httpc:request(params)
+    if not res then
+        httpc:close()
+        return "request for bytes " .. first .. "-" .. last .. " failed: " .. err
+    end
+    if res.status ~= ngx.HTTP_PARTIAL_CONTENT then
+        httpc:close()
+        return "rejected GET for bytes " .. first .. "-" .. last .. ": " .. res.status
+    end
+    local adler32, length
+    err, adler32, length = fileutil.sink_range(destination_localpath, first, fileutil.pulled_reader(res.body_reader), progress)
+    if err then
+        httpc:close()
+        return err
+    end
+    if length ~= last - first + 1 then
+        httpc:close()
+        return "received " .. length .. " bytes for bytes " .. first .. "-" .. last
+    end
+    httpc:set_keepalive()
+    return nil, adler32, length
+end
+
+---@type function
+---@param progress RangeProgress[]
+---Periodically send a perf marker for each stripe, until killed
+local function report_stripes(progress)
+    while true do
+        ngx.sleep(config.data.performance_marker_timeout)
+        local now = ngx.now()
+        for i, stripe in ipairs(progress) do
+            fileutil.write_perfmarker(stripe.bytes, stripe.start_time, stripe.last_transferred, now, i - 1, #progress)
+        end
+    end
+end
+
+---@type function
+---@param source {uri: string, size: integer, digest: string?}
+---@param headers table<string, string>
+---@param destination_localpath string
+---@param nstripes integer
+---@param verify_checksum boolean
+---@return nil
+---Pull the source in parallel byte ranges, each written at its offset in the
+---staging file, which is moved into place once all of them are complete
+local function striped_pull(source, headers, destination_localpath, nstripes, verify_checksum)
+    local staging_path = fileutil.staging_path(destination_localpath, true)
+    local err = fileutil.create_sized(staging_path, source.size)
+    if err then
+        ngx.say("failure: ", err)
+        return ngx.exit(ngx.OK)
+    end
+
+    local stripe_size = math.ceil(source.size / nstripes)
+    nstripes = math.ceil(source.size / stripe_size)
+    local start_time = ngx.now()
+    ---@type RangeProgress[]
+    local progress = {}
+    local threads = {}
+    for i = 1, nstripes do
+        local first = (i - 1) * stripe_size
+        local last = math.min(first + stripe_size, source.size) - 1
+        progress[i] = {bytes = 0, start_time = start_time, last_transferred = start_time}
+        local co, spawn_err = ngx.thread.spawn(pull_stripe, source.uri, headers, staging_path, first, last, progress[i])
+        if not co then
+            err = "failed to spawn stripe: " .. spawn_err
+            break
+        end
+        threads[i] = co
+    end
+    local reporter = ngx.thread.spawn(report_stripes, progress)
+
+    local adler32 = nil
+    for i, co in ipairs(threads) do
+        local ok, stripe_err, stripe_adler32, length = ngx.thread.wait(co)
+        if not ok then
+            stripe_err = stripe_err or "thread error"
+        end
+        if stripe_err then
+            err = err or ("stripe " .. (i - 1) .. ": " .. stripe_err)
+        elseif not err then
+            if adler32 then
+                adler32 = cksumutil.adler32_combine(adler32, stripe_adler32, length)
+            else
+                adler32 = stripe_adler32
+            end
+        end
+        if err then
+            -- Killing the other stripes would leak their open files and any
+            -- writes they have in flight, so have them stop and wait for them
+            for j = i + 1, #threads do
+                progress[j].aborted = true
+            end
+            for j = i + 1, #threads do
+                ngx.thread.wait(threads[j])
+            end
+            break
+        end
+    end
+    if reporter then
+        ngx.thread.kill(reporter)
+    end
+
+    local adler32_string = nil
+    if not err then
+        adler32_string = cksumutil.adler32_format(adler32)
+        cksumutil.set_digests(staging_path, {adler32 = adler32_string})
+        err = fileutil.commit_staging(destination_localpath, staging_path, adler32_string)
+    end
+    if err then
+        os.remove(staging_path)
+        ngx.say("failure: error while receiving data: ", err)
+        return ngx.exit(ngx.OK)
+    end
+    ngx.log(ngx.NOTICE, source.size, " total bytes written to ", destination_localpath, " in ", nstripes,
+        " stripes with adler32 ", adler32_string)
+
+    if verify_checksum then
+        local source_adler32 = (source.digest or "adler32=(missing)"):sub(9)
+        if source_adler32 ~= adler32_string then
+            ngx.say("failure: adler32 checksum mismatch: source ", source_adler32, " desination ", adler32_string)
+            return ngx.exit(ngx.OK)
+        end
+    end
+
+    ngx.say("success: Created")
+end
 
 ---@type function
 ---@param source_uri string
@@ -28,8 +235,36 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
 
     -- At this point we have accepted the request and will report
     -- errors according to the text/perf-marker-stream format
-    ngx.status = ngx.HTTP_ACCEPTED
-    ngx.header["Content-Type"] = "text/perf-marker-stream"
+    -- (unless it was queued, and the headers are already sent)
+    if not ngx.headers_sent then
+        ngx.status = ngx.HTTP_ACCEPTED
+        ngx.header["Content-Type"] = "text/perf-marker-stream"
+    end
+
+    local headers = {
+        ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
+    }
+    if verify_checksum then
+        headers["Want-Digest"] = "adler32"
+    end
+    if ngx.var.http_transferheaderauthorization then
+        headers["Authorization"] = ngx.var.http_transferheaderauthorization
+    end
+
+    -- Striped mode is opt-in, and needs a source that supports byte ranges
+    local nstripes = requested_stripes()
+    if not redirects and nstripes > 1 then
+        local source, probe_err = probe_source(source_uri, headers)
+        if source and source.size and source.accept_ranges == "bytes" then
+            nstripes = math.min(nstripes, math.ceil(source.size / config.data.tpc_stripe_min_size))
+            if nstripes > 1 then
+                ---@cast source {uri: string, size: integer, digest: string?}
+                return striped_pull(source, headers, destination_localpath, nstripes, verify_checksum)
+            end
+        elseif not source then
+            ngx.log(ngx.INFO, "Not using stripes, failed to probe ", source_uri, ": ", probe_err)
+        end
+    end
 
     -- First establish a connection
     local parsed_uri, err = httpc:parse_uri(source_uri)
@@ -48,15 +283,6 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
         return ngx.exit(ngx.OK)
     end
 
-    local headers = {
-        ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
-    }
-    if verify_checksum then
-        headers["Want-Digest"] = "adler32"
-    end
-    if ngx.var.http_transferheaderauthorization then
-        headers["Authorization"] = ngx.var.http_transferheaderauthorization
-    end
     params.headers = headers
     local res = nil
     res, err = httpc:request(params)
@@ -72,7 +298,9 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
     end
 
     if res.status ~= 200 then
-        ngx.status = res.status
+        if not ngx.headers_sent then
+            ngx.status = res.status
+        end
         ngx.say("failure: rejected GET: ", res.reason)
         -- read the body so we can re-use the connection
         res:read_body()
@@ -81,7 +309,9 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
     end
 
     local adler32 = nil
-    err, adler32 = fileutil.sink_to_file(destination_localpath, res.body_reader, true)
+    err, adler32 = fileutil.sink_to_file(
+        destination_localpath, fileutil.pulled_reader(res.body_reader), true, nil, tonumber(res.headers["Content-Length"])
+    )
 
     if not adler32 then
         ngx.say("failure: error while receiving data: ", err)
@@ -106,21 +336,164 @@ local function third_party_pull(source_uri, destination_localpath, redirects)
     end
 end
 
+---@type function
+---@param source_localpath string
+---@param destination_uri string
+---@param redirects integer?
+---@return nil
+local function third_party_push(source_localpath, destination_uri, redirects)
+    -- See third_party_pull for the meaning of these headers
+    local verify_checksum = true
+    if ngx.var.http_requirechecksumverification == "false" then
+        verify_checksum = false
+    end
+
+    local metadata = fileutil.get_metadata(source_localpath, false)
+    if not metadata.exists or metadata.is_directory then
+        if not ngx.headers_sent then
+            ngx.status = ngx.HTTP_NOT_FOUND
+        end
+        ngx.say("source file not found")
+        return ngx.exit(ngx.OK)
+    end
+
+    -- At this point we have accepted the request and will report
+    -- errors according to the text/perf-marker-stream format
+    -- (unless it was queued or redirected, and the headers are already sent)
+    if not ngx.headers_sent then
+        ngx.status = ngx.HTTP_ACCEPTED
+        ngx.header["Content-Type"] = "text/perf-marker-stream"
+    end
+
+    local bytes_sent = 0
+    local start_time = ngx.now()
+    local last_perfmarker = start_time
+    local last_transferred = start_time
+    local adler_state = cksumutil.adler32_initialize()
+    local read_err = nil
+    ---@type function
+    ---@return string? chunk
+    ---Read the source in the checksum thread pool, so a slow disk does not stall the worker
+    local function body_reader()
+        local ferr, data = cksumutil.read_range(source_localpath, bytes_sent, config.data.tpc_push_buffer_size)
+        if not data then
+            read_err = ferr
+            return nil
+        end
+        local now = ngx.now()
+        bytes_sent = bytes_sent + #data
+        ngx.ctx.body_bytes_sent = bytes_sent
+        last_transferred = now
+        cksumutil.adler32_increment(adler_state, data)
+        if last_perfmarker + config.data.performance_marker_timeout <= now then
+            fileutil.write_perfmarker(bytes_sent, start_time, last_transferred, now)
+            last_perfmarker = now
+        end
+        return data
+    end
+
+    local headers = {
+        ["User-Agent"] = "nginx-webdav/" .. config.data.server_version,
+        ["Content-Length"] = metadata.size,
+    }
+    if verify_checksum then
+        headers["Want-Digest"] = "adler32"
+    end
+    if ngx.var.http_transferheaderauthorization then
+        headers["Authorization"] = ngx.var.http_transferheaderauthorization
+    end
+    local res, err = peerclient.request_uri(destination_uri, {
+        method = "PUT",
+        body = body_reader,
+        headers = headers,
+    }, {config.data.tpc_connect_timeout, config.data.tpc_send_timeout, config.data.tpc_read_timeout})
+    if not res then
+        ngx.say("failure: PUT to ", destination_uri, " failed: ", err)
+        return ngx.exit(ngx.OK)
+    end
+
+    local is_redirect = res.status == 307 or res.status == 308
+    redirects = redirects or 0
+    if is_redirect and redirects < config.data.tpc_redirect_limit then
+        -- The body has to be sent again from the start
+        return third_party_push(source_localpath, res.headers["Location"], redirects + 1)
+    end
+
+    if res.status ~= ngx.HTTP_OK and res.status ~= ngx.HTTP_CREATED and res.status ~= ngx.HTTP_NO_CONTENT then
+        ngx.say("failure: rejected PUT: ", res.status, " ", res.reason or "")
+        return ngx.exit(ngx.OK)
+    end
+    if read_err or bytes_sent ~= metadata.size then
+        ngx.say("failure: error while reading source file: ", read_err or ("read " .. bytes_sent .. " of " .. metadata.size .. " bytes"))
+        return ngx.exit(ngx.OK)
+    end
+
+    local adler32 = cksumutil.adler32_to_string(adler_state)
+    ngx.log(ngx.NOTICE, bytes_sent, " total bytes sent from ", source_localpath, " with adler32 ", adler32)
+    if verify_checksum then
+        local destination_adler32 = (res.headers["Digest"] or ""):lower():match("adler32=(%x+)") or "(missing)"
+        if destination_adler32 ~= adler32 then
+            ngx.say("failure: adler32 checksum mismatch: source ", adler32, " destination ", destination_adler32)
+            return ngx.exit(ngx.OK)
+        end
+    end
+
+    ngx.say("success: Created")
+end
+
 
 if ngx.var.request_method == "COPY" then
     -- The COPY method is supported by ngx_http_dav_module but only for files on the same server.
-    -- We intercept the method here to support third-party push copy.
+    -- We intercept the method here to support third-party pull and push copy.
+    if ngx.var.http_source and ngx.var.http_destination then
+        ngx.status = ngx.HTTP_BAD_REQUEST
+        ngx.say("only one of source and destination can be provided")
+        return ngx.exit(ngx.OK)
+    end
+
+    if ngx.var.http_destination then
+        local source_localpath = fileutil.get_request_local_path()
+        metrics.transfer_started("tpc_push")
+        tpcqueue.enter("push", source_localpath, ngx.var.http_destination)
+        third_party_push(source_localpath, ngx.var.http_destination)
+        return tpcqueue.finish()
+    end
+
     if not ngx.var.http_source then
         ngx.status = ngx.HTTP_BAD_REQUEST
         ngx.say("no source provided")
         return ngx.exit(ngx.OK)
     end
 
-    if ngx.var.http_destination then
-        ngx.status = ngx.HTTP_NOT_ALLOWED
-        ngx.say("third-party push copy not implemented")
+    -- Wait for a slot in the transfer limits (see tpcqueue)
+    local destination_localpath = fileutil.get_request_local_path()
+    local state, err = tpcqueue.enter("pull", ngx.var.http_source, destination_localpath)
+    if not state then
+        ngx.status = ngx.HTTP_SERVICE_UNAVAILABLE
+        ngx.header["Retry-After"] = config.data.tpc_retry_after
+        ngx.say(err)
         return ngx.exit(ngx.OK)
     end
+    if state == "queued" then
+        ngx.status = ngx.HTTP_ACCEPTED
+        ngx.header["Content-Type"] = "text/perf-marker-stream"
+        local last_perfmarker = 0
+        local ok
+        ok, err = tpcqueue.wait(function(position)
+            local now = ngx.now()
+            if last_perfmarker + config.data.performance_marker_timeout > now then
+                return true
+            end
+            last_perfmarker = now
+            return fileutil.write_queued_perfmarker(position, now)
+        end)
+        if not ok then
+            ngx.say("failure: ", err)
+            return ngx.exit(ngx.OK)
+        end
+    end
 
-    third_party_pull(ngx.var.http_source, fileutil.get_request_local_path())
+    metrics.transfer_started("tpc_pull")
+    third_party_pull(ngx.var.http_source, destination_localpath)
+    tpcqueue.finish()
 end
\ No newline at end of file
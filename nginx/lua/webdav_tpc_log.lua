@@ -0,0 +1,6 @@
+local metrics = require("metrics")
+local tpcqueue = require("tpcqueue")
+
+-- Release the transfer slot of a request that ended early (with ngx.exit)
+tpcqueue.finish()
+metrics.log()
@@ -2,12 +2,23 @@ local ngx = require("ngx")
 local config = require("config")
 local http = require("resty.http")
 local fileutil = require("fileutil")
+local cksumutil = require("cksumutil")
+local nsfilter = require("nsfilter")
+local metrics = require("metrics")
+local accessindex = require("accessindex")
+local metaindex = require("metaindex")
 
 local file_path = fileutil.get_request_local_path()
 local metadata = fileutil.get_metadata(file_path, false)
 
 if ngx.var.request_method == "DELETE" then
-    if not metadata.exists then
+    -- Deleting also abandons any upload in progress
+    local discarded = fileutil.discard_staging(file_path)
+    if not metadata.exists and discarded then
+        ngx.status = ngx.HTTP_NO_CONTENT
+        ngx.say("upload discarded")
+        return ngx.exit(ngx.OK)
+    elseif not metadata.exists then
         ngx.status = ngx.HTTP_NOT_FOUND
         ngx.say("file not found")
         return ngx.exit(ngx.OK)
@@ -18,6 +29,11 @@ if ngx.var.request_method == "DELETE" then
         ngx.say("failed to delete file: ", err)
         return ngx.exit(ngx.OK)
     end
+    if not metadata.is_directory then
+        nsfilter.record_remove(nsfilter.key(file_path))
+        accessindex.remove(nsfilter.key(file_path))
+        metaindex.remove(file_path)
+    end
     ngx.status = ngx.HTTP_NO_CONTENT
     ngx.say("file deleted")
     return ngx.exit(ngx.OK)
@@ -34,34 +50,170 @@ if metadata.is_directory then
     return ngx.exit(ngx.OK)
 end
 
--- After acquiring the raw socket, we cannot update the status
--- So set it to OK
-ngx.status = 200
+-- Resumable uploads: a PUT with Content-Range writes that part of the file
+-- into its staging file, and the file is moved into place once its last byte
+-- has been written. Ranges must be sent in order, so each one has to start
+-- where the staged data ends. "Content-Range: bytes */<size>" without a body
+-- asks how much has been staged.
+local range = nil
+local staged = 0
+-- Held by a range upload from checking the staged data until it is written
+local staging_lock = nil
+if ngx.var.http_content_range then
+    local first, last, total = ngx.var.http_content_range:match("^bytes%s+(%d+)-(%d+)/(%d+)$")
+    if not first then
+        if ngx.var.http_content_range:match("^bytes%s+%*/%d+$") then
+            staged = fileutil.staged_size(file_path) or 0
+            if staged > 0 then
+                ngx.header["Range"] = string.format("bytes=0-%d", staged - 1)
+            end
+            ngx.status = ngx.HTTP_ACCEPTED
+            ngx.say(staged, " bytes staged")
+            return ngx.exit(ngx.OK)
+        end
+        ngx.status = ngx.HTTP_BAD_REQUEST
+        ngx.say("invalid Content-Range")
+        return ngx.exit(ngx.OK)
+    end
+    range = {first = tonumber(first), last = tonumber(last), total = tonumber(total)}
+    if range.last < range.first or range.last >= range.total then
+        ngx.status = ngx.HTTP_BAD_REQUEST
+        ngx.say("invalid Content-Range")
+        return ngx.exit(ngx.OK)
+    end
+    local lock_err
+    staging_lock, lock_err = fileutil.lock_staging(file_path)
+    if not staging_lock then
+        if lock_err == "timeout" then
+            ngx.status = ngx.HTTP_CONFLICT
+            ngx.say("another upload to this file is in progress")
+        else
+            ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
+            ngx.say("failed to lock the staged data: ", lock_err)
+        end
+        return ngx.exit(ngx.OK)
+    end
+    staged = fileutil.staged_size(file_path) or 0
+    if staged > 0 then
+        ngx.header["Range"] = string.format("bytes=0-%d", staged - 1)
+    end
+    if range.first ~= staged then
+        staging_lock:unlock()
+        ngx.status = 416
+        ngx.say("the upload has ", staged, " bytes staged, continue from there")
+        return ngx.exit(ngx.OK)
+    end
+end
 
-local sock, err = ngx.req.socket(true)
-if not sock then
-    ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
-    ngx.say("failed to get the request socket: " .. err)
-    return ngx.exit(ngx.OK)
+---@type function
+---@return function? reader, string? err
+---Have nginx read the whole request body, decoding a chunked body and
+---buffering it in memory or in client_body_temp_path, and read it from there
+local function buffered_body_reader()
+    ngx.req.read_body()
+    local data = ngx.req.get_body_data()
+    if data then
+        return function()
+            local buffer = data
+            data = nil
+            return buffer
+        end
+    end
+    local body_path = ngx.req.get_body_file()
+    if not body_path then
+        -- Empty body
+        return function() return nil end
+    end
+    -- Read in the checksum thread pool, so a slow disk does not stall the worker
+    local offset = 0
+    return function(size)
+        local err, buffer = cksumutil.read_range(body_path, offset, size or config.data.receive_buffer_size)
+        if err then
+            return nil, err
+        end
+        if buffer then
+            offset = offset + #buffer
+        end
+        return buffer
+    end
 end
 
--- From this point on, we are in charge of sending the http response to the client
--- this is the price we pay for raw socket since the wrapped socket does not support
--- chunked body encoding
+-- Unless we take the raw socket, nginx sends the response and can keep the
+-- connection alive for the next request. Its request socket only supports
+-- bodies with a Content-Length though, so a chunked body is either buffered
+-- by nginx first, or read from the raw socket (see upload_buffer_chunked).
+-- In both cases nginx also answers "Expect: 100-continue".
+local chunked = (ngx.var.http_transfer_encoding or ""):lower():find("chunked") ~= nil
+local raw = chunked and not config.data.upload_buffer_chunked
+local sock = nil
+local err
+
+if raw then
+    -- After acquiring the raw socket, we cannot update the status
+    -- So set it to OK
+    ngx.status = 200
+
+    sock, err = ngx.req.socket(true)
+    if not sock then
+        if staging_lock then
+            staging_lock:unlock()
+        end
+        ngx.status = ngx.HTTP_INTERNAL_SERVER_ERROR
+        ngx.say("failed to get the request socket: " .. err)
+        return ngx.exit(ngx.OK)
+    end
 
--- This allows clients to be sure the body will be accepted before committing to sending it
-if ngx.var.http_expect == "100-continue" then
-    sock:send("HTTP/1.1 100 Continue\r\n\r\n")
+    -- From this point on, we are in charge of sending the http response to the client
+    -- this is the price we pay for raw socket since the wrapped socket does not support
+    -- chunked body encoding
+
+    -- This allows clients to be sure the body will be accepted before committing to sending it
+    if ngx.var.http_expect == "100-continue" then
+        sock:send("HTTP/1.1 100 Continue\r\n\r\n")
+    end
 end
 
 ---@type function
 ---@param status integer
 ---@param message string?
----@param digest string?
-local function exit(status, message, digest)
+---@param headers table<string, string>?
+local function exit(status, message, headers)
+    ngx.ctx.response_status = status
+    if staging_lock then
+        staging_lock:unlock()
+    end
+    if status == 204 then
+        -- No Content should not have a body
+        message = nil
+    end
+    if not raw then
+        ngx.status = status
+        -- Only meant for the responses sent before reading the body
+        ngx.header["Range"] = nil
+        for name, value in pairs(headers or {}) do
+            ngx.header[name] = value
+        end
+        if message then
+            message = message .. "\n"
+            -- Not chunked, so that the body is complete without a last chunk
+            ngx.header["Content-Type"] = "text/plain"
+            ngx.header["Content-Length"] = #message
+            ngx.print(message)
+        end
+        if status >= 400 then
+            -- The body may not have been read to the end, so it cannot be
+            -- told apart from the next request: close the connection once
+            -- the response is out
+            ngx.flush(true)
+            ngx.eof()
+            return ngx.exit(ngx.HTTP_CLOSE)
+        end
+        return ngx.exit(ngx.OK)
+    end
     local status_strings = {
         [200] = "OK",
         [201] = "Created",
+        [202] = "Accepted",
         [204] = "No Content",
         [400] = "Bad Request",
         [500] = "Internal Server Error",
@@ -70,12 +222,8 @@ local function exit(status, message, digest)
         string.format("HTTP/1.1 %d %s\r\n", status, status_strings[status]),
         "Connection: close\r\n",
     }
-    if status == 204 then
-        -- No Content should not have a body
-        message = nil
-    end
-    if digest then
-        table.insert(response, string.format("Digest: %s\r\n", digest))
+    for name, value in pairs(headers or {}) do
+        table.insert(response, string.format("%s: %s\r\n", name, value))
     end
     if message then
         message = message .. "\n"
@@ -89,25 +237,43 @@ local function exit(status, message, digest)
     sock:send(response)
 end
 
-local reader = http.get_client_body_reader(nil, nil, sock)
+metrics.transfer_started("write")
+local reader
+if raw then
+    reader = http.get_client_body_reader(nil, nil, sock)
+elseif chunked then
+    reader, err = buffered_body_reader()
+elseif tonumber(ngx.var.http_content_length) == 0 then
+    reader = function() return nil end
+else
+    sock, err = ngx.req.socket()
+    if sock then
+        reader = http.get_client_body_reader(nil, nil, sock)
+    end
+end
 if not reader then
-    return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, "failed to get the request body reader")
+    return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, "failed to get the request body reader" .. (err and ": " .. err or ""))
 end
 
-local adler32 = nil
-err, adler32 = fileutil.sink_to_file(file_path, reader)
+local digests = nil
+err, _, digests = fileutil.sink_to_file(file_path, reader, false, range, tonumber(ngx.var.http_content_length))
 if err then
     -- TODO: choose more appropriate status code based on error
     return exit(ngx.HTTP_INTERNAL_SERVER_ERROR, err)
 end
 
-local digest = nil
-if string.lower(ngx.var.http_want_digest or "") == "adler32" then
-    digest = string.format("adler32=%s", adler32)
+if not digests then
+    -- More ranges to come
+    ---@cast range ContentRange
+    return exit(ngx.HTTP_ACCEPTED, (range.last + 1) .. " bytes staged", {Range = string.format("bytes=0-%d", range.last)})
 end
 
+local headers = {
+    Digest = cksumutil.format_digest(digests, cksumutil.parse_want_digest(ngx.var.http_want_digest)),
+}
+
 if metadata.exists then
-    return exit(ngx.HTTP_NO_CONTENT)
+    return exit(ngx.HTTP_NO_CONTENT, nil, headers)
 end
 
-return exit(ngx.HTTP_CREATED, "file created", digest)
+return exit(ngx.HTTP_CREATED, "file created", headers)
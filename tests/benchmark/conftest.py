@@ -0,0 +1,59 @@
+import json
+from typing import Callable, Iterator
+
+import pytest
+
+from .util import WorkloadResult, compare, format_summary
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(request: pytest.FixtureRequest) -> Iterator[dict[str, dict]]:
+    """Summaries of the workloads run in this session, by name
+
+    They are written to --benchmark-json at the end of the session.
+    """
+    results: dict[str, dict] = {}
+    yield results
+
+    path = request.config.getoption("--benchmark-json")
+    if path and results:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+@pytest.fixture(scope="session")
+def benchmark_baseline(request: pytest.FixtureRequest) -> dict[str, dict]:
+    path = request.config.getoption("--benchmark-baseline")
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="session")
+def benchmark_concurrency(request: pytest.FixtureRequest) -> int:
+    return request.config.getoption("--benchmark-concurrency")
+
+
+@pytest.fixture()
+def benchmark_report(
+    request: pytest.FixtureRequest,
+    benchmark_results: dict[str, dict],
+    benchmark_baseline: dict[str, dict],
+) -> Callable[[WorkloadResult], None]:
+    """Record the result of a workload, and check it against the baseline"""
+    threshold = request.config.getoption("--benchmark-threshold")
+
+    def report(result: WorkloadResult) -> None:
+        summary = result.summary()
+        print("\n" + format_summary(result.name, summary))
+        benchmark_results[result.name] = summary
+        if result.name in benchmark_baseline:
+            regressions = compare(
+                summary, benchmark_baseline[result.name], threshold
+            )
+            assert not regressions, f"{result.name} regressed: " + ", ".join(
+                regressions
+            )
+
+    return report
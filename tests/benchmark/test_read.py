@@ -0,0 +1,111 @@
+"""Concurrent mixed-size GETs, for each read mode of /webdav_read
+
+See nginx/lua/readconf.lua for the read modes. Run with:
+    pytest --benchmark -s tests/benchmark/test_read.py
+The files are served from a tmpfs, where directio has no page cache to
+bypass. Set BENCHMARK_DATA_DIR to a directory on a real disk to serve them
+from there instead.
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+from typing import Callable
+
+import httpx
+import pytest
+
+from ..conftest import MockIdP, run_server
+from ..util import assert_status
+from .util import WorkloadResult, latency_summary
+
+SMALL_SIZE = 64 * 1024
+SMALL_FILES = 64
+LARGE_SIZE = 16 * 1024 * 1024
+LARGE_FILES = 4
+# Fraction of the requests that are for a large file
+LARGE_FRACTION = 0.1
+REQUESTS = 400
+CONCURRENCY = 32
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+@pytest.mark.parametrize("read_mode", ["buffered", "sendfile", "auto"])
+async def test_read_mixed(
+    build_container: None,
+    oidc_mock_idp: MockIdP,
+    wlcg_create_header: dict[str, str],
+    read_mode: str,
+    benchmark_report: Callable[[WorkloadResult], None],
+):
+    data_dir = None
+    if "BENCHMARK_DATA_DIR" in os.environ:
+        data_dir = tempfile.mkdtemp(dir=os.environ["BENCHMARK_DATA_DIR"])
+    extra_config = {
+        "read_mode": read_mode,
+        # The large files are read with directio in the auto mode
+        "read_directio_min_size": 1024 * 1024,
+        "receive_buffer_size": 1024 * 1024,
+    }
+    with run_server(
+        oidc_mock_idp,
+        name=f"nginx-bench-read-{read_mode}",
+        extra_config=extra_config,
+        data_dir=data_dir,
+        tmpfs_size="200M",
+    ) as server:
+        rng = random.Random(42)
+        files = {f"/bench/small_{i}.bin": SMALL_SIZE for i in range(SMALL_FILES)}
+        files.update({f"/bench/large_{i}.bin": LARGE_SIZE for i in range(LARGE_FILES)})
+        for path, size in files.items():
+            response = httpx.put(
+                server.hosturl + path,
+                headers=wlcg_create_header,
+                content=rng.randbytes(size),
+                timeout=60,
+            )
+            assert_status(response, httpx.codes.CREATED)
+
+        small = [p for p, s in files.items() if s == SMALL_SIZE]
+        large = [p for p, s in files.items() if s == LARGE_SIZE]
+        plan = [
+            rng.choice(large) if rng.random() < LARGE_FRACTION else rng.choice(small)
+            for _ in range(REQUESTS)
+        ]
+
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        async with httpx.AsyncClient(
+            base_url=server.hosturl, headers=wlcg_create_header, timeout=60
+        ) as client:
+
+            async def get(path: str) -> tuple[str, float, int]:
+                async with semaphore:
+                    tic = time.perf_counter()
+                    response = await client.get(path)
+                    elapsed = time.perf_counter() - tic
+                assert_status(response, httpx.codes.OK)
+                assert len(response.content) == files[path]
+                return path, elapsed, len(response.content)
+
+            tic = time.perf_counter()
+            results = await asyncio.gather(*map(get, plan))
+            wall = time.perf_counter() - tic
+
+    result = WorkloadResult(
+        name=f"read_mixed[{read_mode}]",
+        concurrency=CONCURRENCY,
+        wall=wall,
+        latencies=[t for _, t, _ in results],
+        nbytes=sum(nbytes for _, _, nbytes in results),
+    )
+    print(f"\nread_mode={read_mode}: {len(results)} GETs, {CONCURRENCY} concurrent")
+    for kind, size in (("small", SMALL_SIZE), ("large", LARGE_SIZE)):
+        summary = latency_summary([t for p, t, _ in results if files[p] == size])
+        print(
+            f"  {kind:5s} ({size // 1024} KiB): {summary['count']} requests,"
+            f" p50 {summary['p50_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms"
+        )
+    benchmark_report(result)
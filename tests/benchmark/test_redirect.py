@@ -0,0 +1,80 @@
+"""Latency of /redirect lookups across a cluster
+
+Files are uploaded to the other servers of the cluster, and looked up on the
+first one, first once each (the peers are queried) and then repeatedly (the
+answers come from the location cache). Run with:
+    pytest --benchmark -s tests/benchmark/test_redirect.py
+"""
+
+import asyncio
+import uuid
+from typing import Callable
+
+import httpx
+import pytest
+
+from ..conftest import ServerInstance
+from ..util import assert_status
+from .util import WorkloadResult, run_workload
+
+FILES_PER_PEER = 50
+CACHED_ROUNDS = 10
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_redirect(
+    setup_cluster: list[ServerInstance],
+    wlcg_create_header: dict[str, str],
+    wlcg_read_header: dict[str, str],
+    benchmark_concurrency: int,
+    benchmark_report: Callable[[WorkloadResult], None],
+):
+    server, *peers = setup_cluster
+    prefix = f"bench_{uuid.uuid4().hex[:8]}"
+    paths = []
+    for i, peer in enumerate(peers):
+        for j in range(FILES_PER_PEER):
+            path = f"{prefix}/peer{i}_{j}.txt"
+            response = httpx.put(
+                f"{peer.hosturl}webdav/{path}",
+                headers=wlcg_create_header,
+                content=b"Hello, world!",
+            )
+            assert_status(response, httpx.codes.CREATED)
+            paths.append(path)
+
+    # Files only become visible once the namespace summaries are gossiped.
+    # The last file of each peer is not benchmarked, as looking it up here
+    # caches its location.
+    for i, _ in enumerate(peers):
+        last = f"{prefix}/peer{i}_{FILES_PER_PEER - 1}.txt"
+        paths.remove(last)
+        for _ in range(30):
+            response = httpx.get(
+                f"{server.hosturl}redirect/{last}", headers=wlcg_read_header
+            )
+            if response.status_code != httpx.codes.NOT_FOUND:
+                break
+            await asyncio.sleep(1)
+        assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+
+    async with httpx.AsyncClient(
+        base_url=server.hosturl, headers=wlcg_read_header, timeout=60
+    ) as client:
+
+        async def lookup(path: str) -> int:
+            response = await client.get(f"redirect/{path}")
+            assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+            assert response.headers["Location"].endswith(f"webdav/{path}")
+            return 0
+
+        result = await run_workload(
+            "redirect_uncached", lookup, paths, benchmark_concurrency
+        )
+        benchmark_report(result)
+
+        result = await run_workload(
+            "redirect_cached", lookup, paths * CACHED_ROUNDS, benchmark_concurrency
+        )
+        benchmark_report(result)
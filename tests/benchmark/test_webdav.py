@@ -0,0 +1,170 @@
+"""Throughput and latency of concurrent PUT, GET, HEAD and TPC pull requests
+
+Run with:
+    pytest --benchmark -s tests/benchmark/test_webdav.py \
+        --benchmark-json results.json [--benchmark-baseline baseline.json]
+"""
+
+import random
+from http.server import ThreadingHTTPServer
+from threading import Thread
+from typing import Callable, Iterator
+
+import httpx
+import pytest
+
+from ..conftest import MockIdP, ServerInstance, run_server
+from ..test_tpc import RequestHandler
+from ..util import assert_status
+from .util import WorkloadResult, run_workload
+
+FILE_SIZE = 1024 * 1024
+FILES = 64
+# Served by the peer server, see tests/test_tpc.py
+TPC_SOURCE = "/bigdata.bin.adler32"
+TPC_SIZE = 130_000
+
+
+@pytest.fixture(scope="module")
+def bench_server(
+    build_container: None, oidc_mock_idp: MockIdP
+) -> Iterator[ServerInstance]:
+    extra_config = {"receive_buffer_size": 1024 * 1024}
+    with run_server(
+        oidc_mock_idp,
+        name="nginx-bench-webdav",
+        extra_config=extra_config,
+        tmpfs_size="400M",
+    ) as server:
+        yield server
+
+
+@pytest.fixture(scope="module")
+def bench_files(
+    bench_server: ServerInstance, wlcg_create_header: dict[str, str]
+) -> list[str]:
+    """Files uploaded for the read benchmarks"""
+    rng = random.Random(42)
+    paths = [f"/bench/read_{i}.bin" for i in range(FILES)]
+    for path in paths:
+        response = httpx.put(
+            bench_server.hosturl + path,
+            headers=wlcg_create_header,
+            content=rng.randbytes(FILE_SIZE),
+            timeout=60,
+        )
+        assert_status(response, httpx.codes.CREATED)
+    return paths
+
+
+@pytest.fixture(scope="module")
+def threaded_peer_server() -> Iterator[str]:
+    """The peer server of tests/test_tpc.py, serving requests concurrently"""
+    httpd = ThreadingHTTPServer(("", 8082), RequestHandler)
+    thread = Thread(target=httpd.serve_forever)
+    thread.start()
+
+    yield "http://host.docker.internal:8082"
+
+    httpd.shutdown()
+    thread.join()
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_put(
+    bench_server: ServerInstance,
+    wlcg_create_header: dict[str, str],
+    benchmark_concurrency: int,
+    benchmark_report: Callable[[WorkloadResult], None],
+):
+    data = random.Random(42).randbytes(FILE_SIZE)
+    async with httpx.AsyncClient(
+        base_url=bench_server.hosturl, headers=wlcg_create_header, timeout=60
+    ) as client:
+
+        async def put(i: int) -> int:
+            response = await client.put(f"/bench/put_{i}.bin", content=data)
+            assert_status(response, httpx.codes.CREATED)
+            return len(data)
+
+        result = await run_workload("put", put, range(FILES), benchmark_concurrency)
+    benchmark_report(result)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_get(
+    bench_server: ServerInstance,
+    bench_files: list[str],
+    wlcg_read_header: dict[str, str],
+    benchmark_concurrency: int,
+    benchmark_report: Callable[[WorkloadResult], None],
+):
+    async with httpx.AsyncClient(
+        base_url=bench_server.hosturl, headers=wlcg_read_header, timeout=60
+    ) as client:
+
+        async def get(path: str) -> int:
+            response = await client.get(path)
+            assert_status(response, httpx.codes.OK)
+            assert len(response.content) == FILE_SIZE
+            return len(response.content)
+
+        result = await run_workload("get", get, bench_files * 4, benchmark_concurrency)
+    benchmark_report(result)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_head_want_digest(
+    bench_server: ServerInstance,
+    bench_files: list[str],
+    wlcg_read_header: dict[str, str],
+    benchmark_concurrency: int,
+    benchmark_report: Callable[[WorkloadResult], None],
+):
+    headers = dict(wlcg_read_header)
+    headers["Want-Digest"] = "adler32,crc32c;q=0.5,md5;q=0.1"
+    async with httpx.AsyncClient(
+        base_url=bench_server.hosturl, headers=headers, timeout=60
+    ) as client:
+
+        async def head(path: str) -> int:
+            response = await client.head(path)
+            assert_status(response, httpx.codes.OK)
+            assert response.headers["Digest"].startswith("adler32=")
+            return 0
+
+        result = await run_workload(
+            "head_want_digest", head, bench_files * 16, benchmark_concurrency
+        )
+    benchmark_report(result)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_tpc_pull(
+    bench_server: ServerInstance,
+    threaded_peer_server: str,
+    wlcg_create_header: dict[str, str],
+    benchmark_concurrency: int,
+    benchmark_report: Callable[[WorkloadResult], None],
+):
+    headers = dict(wlcg_create_header)
+    headers["Source"] = threaded_peer_server + TPC_SOURCE
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+    async with httpx.AsyncClient(
+        base_url=bench_server.hosturl, headers=headers, timeout=60
+    ) as client:
+
+        async def pull(i: int) -> int:
+            response = await client.request("COPY", f"/bench/tpc_{i}.bin")
+            assert_status(response, httpx.codes.ACCEPTED)
+            assert response.text.splitlines()[-1] == "success: Created"
+            return TPC_SIZE
+
+        result = await run_workload(
+            "tpc_pull", pull, range(FILES * 4), benchmark_concurrency
+        )
+    benchmark_report(result)
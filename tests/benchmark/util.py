@@ -0,0 +1,106 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterable, TypeVar
+
+import numpy
+
+T = TypeVar("T")
+
+# Summary values compared against the baseline, and whether higher is better
+COMPARED = {
+    "mb_per_s": True,
+    "requests_per_s": True,
+    "p50_ms": False,
+}
+
+
+def latency_summary(latencies: list[float]) -> dict[str, float]:
+    """Percentiles (in milliseconds) of a list of latencies in seconds"""
+    values = numpy.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "p50_ms": float(numpy.percentile(values, 50)),
+        "p90_ms": float(numpy.percentile(values, 90)),
+        "p99_ms": float(numpy.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+@dataclass
+class WorkloadResult:
+    """Latencies and bytes transferred by the requests of a workload"""
+
+    name: str
+    concurrency: int
+    wall: float = 0.0
+    "Seconds from the first request to the end of the last one"
+    latencies: list[float] = field(default_factory=list)
+    nbytes: int = 0
+    "Payload bytes sent or received"
+
+    def summary(self) -> dict[str, float]:
+        summary = latency_summary(self.latencies)
+        summary["concurrency"] = self.concurrency
+        summary["seconds"] = self.wall
+        summary["requests_per_s"] = len(self.latencies) / self.wall
+        summary["mb_per_s"] = self.nbytes / self.wall / 1e6
+        return summary
+
+
+async def run_workload(
+    name: str,
+    request: Callable[[T], Awaitable[int]],
+    items: Iterable[T],
+    concurrency: int,
+) -> WorkloadResult:
+    """Call request on each item, at most concurrency at a time
+
+    request returns the number of payload bytes it transferred, and should
+    check the response itself.
+    """
+    result = WorkloadResult(name=name, concurrency=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(item: T) -> None:
+        async with semaphore:
+            tic = time.perf_counter()
+            nbytes = await request(item)
+            result.latencies.append(time.perf_counter() - tic)
+        result.nbytes += nbytes
+
+    tic = time.perf_counter()
+    await asyncio.gather(*map(timed, items))
+    result.wall = time.perf_counter() - tic
+    return result
+
+
+def compare(
+    summary: dict[str, float], baseline: dict[str, float], threshold: float
+) -> list[str]:
+    """Describe the values of summary that regressed by more than threshold
+
+    threshold is a fraction of the baseline value, e.g. 0.2 for 20%.
+    """
+    regressions = []
+    for key, higher_is_better in COMPARED.items():
+        if key not in baseline or not baseline[key]:
+            continue
+        change = summary[key] / baseline[key] - 1
+        if (higher_is_better and change < -threshold) or (
+            not higher_is_better and change > threshold
+        ):
+            regressions.append(
+                f"{key} {summary[key]:.2f} vs baseline {baseline[key]:.2f}"
+                f" ({change:+.0%})"
+            )
+    return regressions
+
+
+def format_summary(name: str, summary: dict[str, float]) -> str:
+    return (
+        f"{name}: {summary['count']} requests, {summary['concurrency']} concurrent,"
+        f" {summary['mb_per_s']:.1f} MB/s, {summary['requests_per_s']:.1f} requests/s,"
+        f" p50 {summary['p50_ms']:.1f} ms, p90 {summary['p90_ms']:.1f} ms,"
+        f" p99 {summary['p99_ms']:.1f} ms"
+    )
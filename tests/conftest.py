@@ -1,4 +1,5 @@
 import base64
+import contextlib
 import datetime
 import json
 import logging
@@ -11,7 +12,7 @@ import uuid
 from dataclasses import dataclass
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
-from typing import Iterator
+from typing import Iterator, Optional
 from urllib.parse import parse_qs
 
 import httpx
@@ -24,6 +25,49 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 logger = logging.getLogger()
 
 
+def pytest_addoption(parser: pytest.Parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="run the benchmarks in tests/benchmark (skipped otherwise)",
+    )
+    parser.addoption(
+        "--benchmark-concurrency",
+        type=int,
+        default=16,
+        help="concurrent requests of the benchmark workloads",
+    )
+    parser.addoption(
+        "--benchmark-json",
+        metavar="PATH",
+        help="write the benchmark results to PATH",
+    )
+    parser.addoption(
+        "--benchmark-baseline",
+        metavar="PATH",
+        help="fail benchmarks that regressed from the results in PATH",
+    )
+    parser.addoption(
+        "--benchmark-threshold",
+        type=float,
+        default=0.2,
+        help="fraction by which a benchmark may regress from the baseline",
+    )
+
+
+def pytest_configure(config: pytest.Config):
+    config.addinivalue_line("markers", "benchmark: a benchmark, run with --benchmark")
+
+
+def pytest_collection_modifyitems(config: pytest.Config, items: list[pytest.Item]):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
 @dataclass
 class MockIdP:
     public_key_pem: str
@@ -251,17 +295,34 @@ class ServerInstance:
     "URL with hostname (or IP) resolvable from the host (pytest) network"
 
 
-@pytest.fixture(scope="session")
-def setup_server(build_container: None, oidc_mock_idp: MockIdP):
-    """A running nginx-webdav server for testing"""
-    # Find an available port.
-    open_port = 8280
-    for port in range(open_port, open_port + 100):
+def find_open_port(start: int) -> int:
+    """Find a port on which nothing listens, starting from start"""
+    for port in range(start, start + 100):
         try:
-            socketserver.TCPServer(("", port), None)
+            with socketserver.TCPServer(("", port), None):
+                return port
         except IOError:
-            open_port = port
-            break
+            continue
+    raise RuntimeError(f"No open port in {start}-{start + 99}")
+
+
+@contextlib.contextmanager
+def run_server(
+    oidc_mock_idp: MockIdP,
+    name: str = "nginx-unit-test-container",
+    extra_config: Optional[dict] = None,
+    data_dir: Optional[str] = None,
+    tmpfs_size: str = "100M",
+    network: Optional[str] = None,
+) -> Iterator[ServerInstance]:
+    """Run an nginx-webdav server container
+
+    extra_config overrides the test configuration below. The data is served
+    from a tmpfs of tmpfs_size, unless data_dir names a host directory to
+    mount instead. With network, the server joins that podman network under
+    its name, e.g. to reach the test cluster.
+    """
+    open_port = find_open_port(8280)
 
     # Configure the server (see nginx/lua/config.lua for schema)
     config = {
@@ -276,8 +337,18 @@ def setup_server(build_container: None, oidc_mock_idp: MockIdP):
         # same one we're connecting to
         "health_check_id": random.randint(0, 1024 * 1024 * 1024),
         "performance_marker_timeout": 2,
+        # Small enough that the test transfers can be striped
+        "tpc_stripe_min_size": 16 * 1024,
+        # Small enough that the test files are checksummed in parallel
+        "checksum_parallel_min_size": 64 * 1024,
+        "upload_digests": ["adler32", "crc32c", "md5"],
+        # Exercise the O_DIRECT and sync paths of the file writer
+        "write_direct_min_size": 64 * 1024,
+        "write_sync": "fdatasync",
     }
-    with open("nginx/lua/config.json", "w") as f:
+    config.update(extra_config or {})
+    config_path = f"nginx/lua/{name}.json"
+    with open(config_path, "w") as f:
         json.dump(config, f)
 
     # Start podman container
@@ -288,15 +359,21 @@ def setup_server(build_container: None, oidc_mock_idp: MockIdP):
         "-p",
         f"{open_port}:8080",
         "-v",
-        "./nginx/lua/config.json:/etc/nginx/lua/config.json:ro",
-        "--tmpfs",
-        "/var/www/webdav:rw,size=100M,mode=1777",
+        f"./{config_path}:/etc/nginx/lua/config.json:ro",
+    ]
+    if data_dir:
+        podman_cmd += ["-v", f"{data_dir}:/var/www/webdav:rw"]
+    else:
+        podman_cmd += ["--tmpfs", f"/var/www/webdav:rw,size={tmpfs_size},mode=1777"]
+    if network:
+        podman_cmd += ["--network", network, "-e", f"SERVER_NAME={name}"]
+    podman_cmd += [
         "-e",
         "DEBUG=true",
         # Set the name of the container so it will fail early if the old
         # container wasn't cleaned up
         "--name",
-        "nginx-unit-test-container",
+        name,
     ]
     podman_cmd.append("nginx-webdav")
     container_id = subprocess.check_output(podman_cmd).decode().strip()
@@ -338,7 +415,7 @@ def setup_server(build_container: None, oidc_mock_idp: MockIdP):
         yield ServerInstance(
             port=open_port,
             container_id=container_id,
-            podurl="http://nginx-unit-test-container:8080/webdav",
+            podurl=f"http://{name}:8080/webdav",
             hosturl=f"http://localhost:{open_port}/webdav",
         )
     finally:
@@ -348,7 +425,14 @@ def setup_server(build_container: None, oidc_mock_idp: MockIdP):
         )
         subprocess.check_call(["podman", "rm", container_id], stdout=subprocess.DEVNULL)
         # Clean up
-        os.remove("nginx/lua/config.json")
+        os.remove(config_path)
+
+
+@pytest.fixture(scope="session")
+def setup_server(build_container: None, oidc_mock_idp: MockIdP):
+    """A running nginx-webdav server for testing"""
+    with run_server(oidc_mock_idp) as server:
+        yield server
 
 
 @pytest.fixture(scope="session")
@@ -3,6 +3,7 @@ import time
 
 import httpx
 
+from tests.conftest import MockIdP, run_server
 from tests.util import assert_status
 
 
@@ -30,13 +31,88 @@ def test_cluster_gossip(nginx_cluster, hepcdn_access_header):
         for item in items:
             assert item.keys() == {"name", "data"}
             assert item["data"]["status"] == "alive"
-            assert set(item["data"].keys()) == {
+            keys = set(item["data"].keys())
+            assert {
                 "status",
                 "epoch",
                 "timestamp",
                 "server_version",
                 "failures",
+            } <= keys <= {
+                "status",
+                "epoch",
+                "timestamp",
+                "server_version",
+                "failures",
+                "summary",
+                "load",
             }
+            if "load" in keys:
+                assert item["data"]["load"].keys() == {
+                    "disk_free",
+                    "disk_total",
+                    "requests",
+                    "throughput",
+                }
+            if "summary" in keys:
+                assert item["data"]["summary"].keys() == {
+                    "version",
+                    "bits",
+                    "hashes",
+                    "filter",
+                }
+
+
+def test_cluster_gossip_delta(nginx_cluster, hepcdn_access_header):
+    """
+    Test the delta gossip exchange, which only returns what the sender is missing.
+    """
+    server = nginx_cluster[0]
+    message = {"format": "delta", "digest": {}, "updates": []}
+    response = httpx.post(
+        f"{server.hosturl}gossip", headers=hepcdn_access_header, json=message
+    )
+    assert_status(response, httpx.codes.OK)
+    data = response.json()
+    assert data["format"] == "delta"
+    assert server.podurl in data["digest"]
+    full = {item["name"] for item in data["updates"]}
+    assert full == set(data["digest"])
+
+    # Sending back the digest we received, we only get what changed since then
+    message["digest"] = data["digest"]
+    response = httpx.post(
+        f"{server.hosturl}gossip", headers=hepcdn_access_header, json=message
+    )
+    assert_status(response, httpx.codes.OK)
+    data = response.json()
+    updates = {item["name"]: item["data"] for item in data["updates"]}
+    # our own entry is refreshed on every exchange
+    assert server.podurl in updates
+    assert len(updates) <= len(full)
+
+
+def test_cluster_gossip_full_fallback(nginx_cluster, hepcdn_access_header):
+    """
+    A peer that sends its full view (e.g. an older version) gets a full reply,
+    unless it offers to take a delta in reply.
+    """
+    server = nginx_cluster[0]
+    response = httpx.post(
+        f"{server.hosturl}gossip", headers=hepcdn_access_header, json=[]
+    )
+    assert_status(response, httpx.codes.OK)
+    data = response.json()
+    assert isinstance(data, list)
+    assert server.podurl in {item["name"] for item in data}
+
+    headers = dict(hepcdn_access_header)
+    headers["X-Gossip-Protocol"] = "delta"
+    response = httpx.post(f"{server.hosturl}gossip", headers=headers, json=[])
+    assert_status(response, httpx.codes.OK)
+    data = response.json()
+    assert data["format"] == "delta"
+    assert {item["name"] for item in data["updates"]} == set(data["digest"])
 
 
 def test_cluster_tpc(nginx_cluster, wlcg_create_header):
@@ -87,6 +163,122 @@ def test_cluster_redirect(nginx_cluster, wlcg_create_header, wlcg_read_header):
                 )
 
 
+def test_cluster_redirect_replicas(
+    nginx_cluster, wlcg_create_header, wlcg_read_header
+):
+    server, *peers = nginx_cluster
+    for i, peer in enumerate(peers):
+        response = httpx.put(
+            f"{peer.hosturl}webdav/replicated.txt",
+            headers=wlcg_create_header,
+            content=b"Hello, world!",
+        )
+        assert_status(response, httpx.codes.CREATED)
+        # Written after the replica, so once the marker is visible so is the replica
+        response = httpx.put(
+            f"{peer.hosturl}webdav/replica_marker{i}.txt",
+            headers=wlcg_create_header,
+            content=b"Hello, world!",
+        )
+        assert_status(response, httpx.codes.CREATED)
+
+    for i, _ in enumerate(peers):
+        for _ in range(30):
+            response = httpx.get(
+                f"{server.hosturl}redirect/replica_marker{i}.txt",
+                headers=wlcg_read_header,
+            )
+            if response.status_code != httpx.codes.NOT_FOUND:
+                break
+            time.sleep(1)
+        assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+
+    # Every lookup picks one of the replicas at random, weighted by load
+    locations = set()
+    for _ in range(30):
+        response = httpx.get(
+            f"{server.hosturl}redirect/replicated.txt", headers=wlcg_read_header
+        )
+        assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+        locations.add(response.headers["Location"])
+    assert locations == {f"{peer.podurl}webdav/replicated.txt" for peer in peers}
+
+
+def test_cluster_redirect_put(
+    nginx_cluster, wlcg_create_header, hepcdn_access_header
+):
+    # All servers must know each other to agree on the owners
+    test_cluster_gossip(nginx_cluster, hepcdn_access_header)
+
+    hosturls = {server.podurl: server.hosturl for server in nginx_cluster}
+    owners = set()
+    for i in range(20):
+        locations = set()
+        for server in nginx_cluster:
+            response = httpx.put(
+                f"{server.hosturl}redirect/placed{i}.txt",
+                headers=wlcg_create_header,
+                content=b"Hello, world!",
+            )
+            assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+            locations.add(response.headers["Location"])
+        # Every server sends the upload to the same owner
+        assert len(locations) == 1
+        location = locations.pop()
+        owner = location.removesuffix(f"webdav/placed{i}.txt")
+        assert owner in hosturls
+        owners.add(owner)
+
+        response = httpx.put(
+            f"{hosturls[owner]}webdav/placed{i}.txt",
+            headers=wlcg_create_header,
+            content=b"Hello, world!",
+        )
+        assert_status(response, httpx.codes.CREATED)
+
+    # The paths are spread over the cluster
+    assert len(owners) > 1
+
+
+def test_cluster_redirect_put_failed_peer(
+    nginx_cluster, wlcg_create_header, hepcdn_access_header
+):
+    test_cluster_gossip(nginx_cluster, hepcdn_access_header)
+
+    server, peer, *_ = nginx_cluster
+    subprocess.check_call(
+        ["podman", "stop", peer.container_id], stdout=subprocess.DEVNULL
+    )
+    try:
+        failed = False
+        for _ in range(30):
+            response = httpx.get(
+                f"{server.hosturl}gossip", headers=hepcdn_access_header
+            )
+            peerlist = {item["name"]: item for item in response.json()}
+            # It may also have been dropped already
+            item = peerlist.get(peer.podurl, {"data": {"status": "failed"}})
+            if item["data"]["status"].startswith("failed"):
+                failed = True
+                break
+            time.sleep(1)
+        assert failed, "Peer was not marked as failed"
+
+        # No upload is placed on the failed peer
+        for i in range(20):
+            response = httpx.put(
+                f"{server.hosturl}redirect/placed_failed{i}.txt",
+                headers=wlcg_create_header,
+                content=b"Hello, world!",
+            )
+            assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+            assert not response.headers["Location"].startswith(peer.podurl)
+    finally:
+        subprocess.check_call(
+            ["podman", "start", peer.container_id], stdout=subprocess.DEVNULL
+        )
+
+
 def test_cluster_drop_peer(nginx_cluster, hepcdn_access_header):
     """
     Test dropping a peer from the cluster.
@@ -129,3 +321,79 @@ def test_cluster_drop_peer(nginx_cluster, hepcdn_access_header):
         time.sleep(1)
 
     assert not dropped, "Peer was not re-added to the cluster after restart"
+
+
+def test_cluster_redirect_cache(
+    nginx_cluster, oidc_mock_idp: MockIdP, wlcg_create_header, wlcg_read_header
+):
+    server, *_ = nginx_cluster
+    data = b"Hello, world!" * 10_000
+    response = httpx.put(
+        f"{server.hosturl}webdav/cached.txt", headers=wlcg_create_header, content=data
+    )
+    assert_status(response, httpx.codes.CREATED)
+
+    with run_server(
+        oidc_mock_idp,
+        name="nginx-webdav-cache-test",
+        extra_config={
+            "seed_peers": server.podurl,
+            "gossip_delay": 1,
+            "gossip_fraction": 0.5,
+            "cache_enabled": True,
+            "gc_interval": 1,
+            "cache_quota": 2 * len(data),
+        },
+        network="nginx-webdav-test",
+    ) as cache:
+        cacheurl = cache.hosturl.removesuffix("webdav")
+
+        def read_through(name: str):
+            # The first read is redirected to the peer while the file is
+            # copied here, and the next ones to the local copy
+            for _ in range(30):
+                response = httpx.get(
+                    f"{cacheurl}redirect/{name}", headers=wlcg_read_header
+                )
+                if response.status_code != httpx.codes.NOT_FOUND:
+                    break
+                time.sleep(1)
+            assert_status(response, httpx.codes.TEMPORARY_REDIRECT)
+            assert response.headers["Location"] in {
+                f"{server.podurl}webdav/{name}",
+                f"/webdav/{name}",
+            }
+            for _ in range(30):
+                response = httpx.get(
+                    f"{cacheurl}redirect/{name}", headers=wlcg_read_header
+                )
+                if response.headers["Location"] == f"/webdav/{name}":
+                    break
+                time.sleep(1)
+            assert response.headers["Location"] == f"/webdav/{name}"
+
+        read_through("cached.txt")
+        response = httpx.get(f"{cacheurl}webdav/cached.txt", headers=wlcg_read_header)
+        assert_status(response, httpx.codes.OK)
+        assert response.content == data
+
+        # Filling two more files goes over the quota, evicting the least
+        # recently read
+        for name in ["cached2.txt", "cached3.txt"]:
+            response = httpx.put(
+                f"{server.hosturl}webdav/{name}",
+                headers=wlcg_create_header,
+                content=data,
+            )
+            assert_status(response, httpx.codes.CREATED)
+            read_through(name)
+        # Eviction is left to the garbage collection timer
+        time.sleep(3)
+
+        response = httpx.head(f"{cacheurl}webdav/cached.txt", headers=wlcg_read_header)
+        assert_status(response, httpx.codes.NOT_FOUND)
+        response = httpx.head(f"{cacheurl}webdav/cached3.txt", headers=wlcg_read_header)
+        assert_status(response, httpx.codes.OK)
+
+        response = httpx.get(f"{cacheurl}metrics")
+        assert f"nginx_webdav_cache_usage_bytes {2 * len(data)}" in response.text
@@ -1,7 +1,13 @@
+import base64
+import hashlib
+import http.client
+import urllib.parse
 import zlib
 
 import httpx
+import pytest
 
+from .conftest import MockIdP, ServerInstance, run_server
 from .util import assert_status
 
 
@@ -83,6 +89,79 @@ def test_put_chunks(
     assert response.read() == unit * n
 
 
+def test_put_keepalive(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    url = urllib.parse.urlsplit(nginx_server)
+    conn = http.client.HTTPConnection(url.netloc)
+    data = b"Hello, world!" * 100
+
+    def put(name: str, body, headers: dict[str, str]) -> int:
+        conn.request(
+            "PUT",
+            f"{url.path}/test_keepalive/{name}",
+            body=body,
+            headers={**wlcg_create_header, **headers},
+        )
+        response = conn.getresponse()
+        response.read()
+        # The next request is sent on the same connection
+        assert not response.will_close
+        return response.status
+
+    assert put("length.txt", data, {}) == httpx.codes.CREATED
+    assert put("length.txt", data, {}) == httpx.codes.NO_CONTENT
+    assert put("empty.txt", b"", {}) == httpx.codes.CREATED
+    assert (
+        put("continue.txt", data, {"Expect": "100-continue"}) == httpx.codes.CREATED
+    )
+    # http.client sends an iterable body with Transfer-Encoding: chunked
+    assert put("chunked.txt", iter([data, data]), {}) == httpx.codes.CREATED
+    conn.close()
+
+    response = httpx.get(
+        f"{nginx_server}/test_keepalive/chunked.txt", headers=wlcg_create_header
+    )
+    assert_status(response, httpx.codes.OK)
+    assert response.content == data * 2
+
+
+def test_put_error_keepalive(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    url = urllib.parse.urlsplit(nginx_server)
+    conn = http.client.HTTPConnection(url.netloc)
+    data = b"Hello, world!" * 100
+
+    conn.request(
+        "PUT",
+        f"{url.path}/test_error_keepalive/file.txt",
+        body=data,
+        headers=wlcg_create_header,
+    )
+    response = conn.getresponse()
+    response.read()
+    assert response.status == httpx.codes.CREATED
+    assert not response.will_close
+
+    # On the kept-alive connection, the whole error body arrives
+    conn.request(
+        "PUT",
+        f"{url.path}/test_error_keepalive/file.txt/more.txt",
+        body=data,
+        headers=wlcg_create_header,
+    )
+    response = conn.getresponse()
+    assert response.status == httpx.codes.INTERNAL_SERVER_ERROR
+    assert response.read() == (
+        b"failed to open file: /var/www/webdav/test_error_keepalive/file.txt/more.txt:"
+        b" Not a directory\n"
+    )
+    conn.close()
+
+
 def test_put_wantdigest(
     nginx_server: str,
     wlcg_create_header: dict[str, str],
@@ -102,6 +181,107 @@ def test_put_wantdigest(
     assert response.headers["Digest"] == f"adler32={expected_adler32:08x}"
 
 
+def crc32c(data: bytes) -> int:
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+    return crc ^ 0xFFFFFFFF
+
+
+def test_put_wantdigest_multiple(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    path = f"{nginx_server}/test_digest_multiple.txt"
+    data = b"Hello, world!" * 1000
+    expected_md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+    expected_crc32c = f"{crc32c(data):08x}"
+
+    headers = dict(wlcg_create_header)
+    headers["Want-Digest"] = "md5;q=0.5, crc32c, adler32;q=0, sha;q=1"
+    response = httpx.put(path, headers=headers, content=data)
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == f"crc32c={expected_crc32c},md5={expected_md5}"
+
+    # Read back from the xattrs
+    response = httpx.head(path, headers=headers)
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"crc32c={expected_crc32c},md5={expected_md5}"
+
+    headers["Want-Digest"] = "adler32;q=0.1,MD5;q=0.9"
+    response = httpx.get(path, headers=headers)
+    assert_status(response, httpx.codes.OK)
+    assert (
+        response.headers["Digest"]
+        == f"md5={expected_md5},adler32={zlib.adler32(data):08x}"
+    )
+
+    # Overwriting drops the stale digests of the previous content
+    data = b"Goodbye, world!"
+    response = httpx.put(path, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.NO_CONTENT)
+    response = httpx.head(path, headers=headers)
+    assert_status(response, httpx.codes.OK)
+    expected_md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+    assert (
+        response.headers["Digest"]
+        == f"md5={expected_md5},adler32={zlib.adler32(data):08x}"
+    )
+
+
+def test_put_resume(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    path = f"{nginx_server}/test_resume/data.bin"
+    data = bytes(range(256)) * 1000
+    size = len(data)
+
+    headers = dict(wlcg_create_header)
+    headers["Content-Range"] = f"bytes 0-99999/{size}"
+    response = httpx.put(path, headers=headers, content=data[:100000])
+    assert_status(response, httpx.codes.ACCEPTED)
+    assert response.headers["Range"] == "bytes=0-99999"
+
+    # Not visible until complete
+    response = httpx.get(path, headers=wlcg_create_header)
+    assert_status(response, httpx.codes.NOT_FOUND)
+    # Nor in the staging area
+    for upload_path in [".upload", ".upload/", ".upload/staging/"]:
+        response = httpx.get(f"{nginx_server}/{upload_path}", headers=wlcg_create_header)
+        assert_status(response, httpx.codes.NOT_FOUND)
+
+    # Ask how much is staged
+    headers["Content-Range"] = f"bytes */{size}"
+    response = httpx.put(path, headers=headers, content=b"")
+    assert_status(response, httpx.codes.ACCEPTED)
+    assert response.headers["Range"] == "bytes=0-99999"
+
+    # Ranges have to continue where the staged data ends
+    headers["Content-Range"] = f"bytes 50000-99999/{size}"
+    response = httpx.put(path, headers=headers, content=data[50000:100000])
+    assert_status(response, httpx.codes.REQUESTED_RANGE_NOT_SATISFIABLE)
+    assert response.headers["Range"] == "bytes=0-99999"
+
+    headers["Content-Range"] = f"bytes 100000-{size - 1}/{size}"
+    headers["Want-Digest"] = "adler32"
+    response = httpx.put(path, headers=headers, content=data[100000:])
+    assert_status(response, httpx.codes.CREATED)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x}"
+
+    response = httpx.get(path, headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == data
+
+    # Nothing is left staged
+    headers["Content-Range"] = f"bytes */{size}"
+    response = httpx.put(path, headers=headers, content=b"")
+    assert_status(response, httpx.codes.ACCEPTED)
+    assert "Range" not in response.headers
+
+
 def test_put_mkdir(
     nginx_server: str,
     wlcg_create_header: dict[str, str],
@@ -118,4 +298,67 @@ def test_put_mkdir(
 
     response = httpx.put(path, headers=wlcg_create_header, content=data)
     assert_status(response, httpx.codes.INTERNAL_SERVER_ERROR)
-    assert response.text == "failed to open file: /var/www/webdav/test_mkdir/blah.txt/more.txt: Not a directory\n"
\ No newline at end of file
+    assert response.text == "failed to open file: /var/www/webdav/test_mkdir/blah.txt/more.txt: Not a directory\n"
+
+
+def test_create_only_scope(nginx_server: str, oidc_mock_idp: MockIdP):
+    """Without wlcg_strict_scopes, storage.read is needed for everything"""
+    token = oidc_mock_idp.make_wlcg_token("storage.create:/ storage.modify:/jobs")
+    headers = {"Authorization": f"Bearer {token}"}
+    path = f"{nginx_server}/jobs/create_only.txt"
+
+    response = httpx.put(path, headers=headers, content=b"Hello, world!")
+    assert_status(response, httpx.codes.FORBIDDEN)
+    response = httpx.get(path, headers=headers)
+    assert_status(response, httpx.codes.FORBIDDEN)
+    response = httpx.delete(path, headers=headers)
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+
+@pytest.fixture(scope="module")
+def strict_server(build_container: None, oidc_mock_idp: MockIdP):
+    """A server enforcing storage.create and storage.modify"""
+    extra_config = {"wlcg_strict_scopes": True}
+    with run_server(
+        oidc_mock_idp, name="nginx-strict-test", extra_config=extra_config
+    ) as server:
+        yield server
+
+
+def test_strict_scopes(strict_server: ServerInstance, oidc_mock_idp: MockIdP):
+    def header(scope: str) -> dict[str, str]:
+        return {"Authorization": f"Bearer {oidc_mock_idp.make_wlcg_token(scope)}"}
+
+    reader = header("storage.read:/")
+    creator = header("storage.read:/ storage.create:/jobs")
+    modifier = header("storage.read:/ storage.modify:/jobs/mine")
+    path = f"{strict_server.hosturl}/jobs/mine/output.txt"
+
+    response = httpx.put(path, headers=reader, content=b"Hello, world!")
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    # Only under the path of the scope, not its siblings
+    response = httpx.put(
+        f"{strict_server.hosturl}/jobsx/output.txt",
+        headers=creator,
+        content=b"Hello, world!",
+    )
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    response = httpx.put(path, headers=creator, content=b"Hello, world!")
+    assert_status(response, httpx.codes.CREATED)
+
+    # Overwriting and deleting need storage.modify
+    response = httpx.put(path, headers=creator, content=b"Goodbye, world!")
+    assert_status(response, httpx.codes.FORBIDDEN)
+    response = httpx.delete(path, headers=creator)
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    response = httpx.put(path, headers=modifier, content=b"Goodbye, world!")
+    assert_status(response, httpx.codes.NO_CONTENT)
+    response = httpx.get(path, headers=reader)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == b"Goodbye, world!"
+
+    response = httpx.delete(path, headers=modifier)
+    assert_status(response, httpx.codes.NO_CONTENT)
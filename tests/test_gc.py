@@ -0,0 +1,73 @@
+import time
+from typing import Iterator
+
+import httpx
+import pytest
+
+from .conftest import MockIdP, ServerInstance, run_server
+from .util import assert_status
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def gc_server(build_container: None, oidc_mock_idp: MockIdP) -> Iterator[ServerInstance]:
+    """A server on a 10 MB disk, collected between half and a third full"""
+    extra_config = {
+        "gc_enabled": True,
+        "gc_high_watermark": 0.5,
+        "gc_low_watermark": 0.3,
+        "gc_interval": 1,
+        "gc_pinned_prefixes": ["/pinned/"],
+    }
+    with run_server(
+        oidc_mock_idp,
+        name="nginx-gc-test",
+        extra_config=extra_config,
+        tmpfs_size="10M",
+    ) as server:
+        yield server
+
+
+def test_gc_watermarks(
+    gc_server: ServerInstance,
+    wlcg_create_header: dict[str, str],
+    wlcg_read_header: dict[str, str],
+):
+    data = b"x" * (3 * MB // 2)
+
+    def put(name: str):
+        response = httpx.put(
+            f"{gc_server.hosturl}/{name}", headers=wlcg_create_header, content=data
+        )
+        assert_status(response, httpx.codes.CREATED)
+
+    def exists(name: str) -> bool:
+        response = httpx.head(f"{gc_server.hosturl}/{name}", headers=wlcg_read_header)
+        return response.status_code == httpx.codes.OK
+
+    # 45% full, under the high watermark
+    put("pinned/gc0.bin")
+    put("gc1.bin")
+    put("gc2.bin")
+    time.sleep(2)
+    assert all(exists(name) for name in ["pinned/gc0.bin", "gc1.bin", "gc2.bin"])
+
+    # Reading gc1 makes gc2 the least recently read
+    response = httpx.get(f"{gc_server.hosturl}/gc1.bin", headers=wlcg_read_header)
+    assert_status(response, httpx.codes.OK)
+
+    # 60% full, so 3 MB have to go, but not the pinned file
+    put("gc3.bin")
+    for _ in range(10):
+        if not exists("gc2.bin"):
+            break
+        time.sleep(1)
+    assert not exists("gc2.bin")
+    assert not exists("gc1.bin")
+    assert exists("pinned/gc0.bin")
+    assert exists("gc3.bin")
+
+    response = httpx.get(gc_server.hosturl.removesuffix("webdav") + "metrics")
+    assert 'nginx_webdav_gc_reclaimed_bytes_total{reason="watermark"}' in response.text
+    assert "nginx_webdav_disk_used_bytes" in response.text
@@ -1,7 +1,12 @@
+import random
+import subprocess
+import time
 import zlib
 
 import httpx
+import pytest
 
+from .conftest import MockIdP, ServerInstance, run_server
 from .util import assert_status
 
 
@@ -45,4 +50,86 @@ def test_head_adler32(nginx_server: str, wlcg_read_header: dict[str, str]):
 
     response = httpx.head(f"{nginx_server}/nonexistent.txt", headers=headers)
     assert_status(response, httpx.codes.NOT_FOUND)
-    assert "Digest" not in response.headers
\ No newline at end of file
+    assert "Digest" not in response.headers
+
+
+def test_head_adler32_parallel(
+    setup_server: ServerInstance, wlcg_read_header: dict[str, str]
+):
+    # Written behind the server's back, so there is no stored checksum
+    data = random.Random(42).randbytes(1_000_003)
+    subprocess.run(
+        [
+            "podman",
+            "exec",
+            "-i",
+            setup_server.container_id,
+            "dd",
+            "of=/var/www/webdav/parallel_adler32.bin",
+        ],
+        input=data,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+    headers = dict(wlcg_read_header)
+    headers["Want-Digest"] = "adler32"
+    response = httpx.head(
+        f"{setup_server.hosturl}/parallel_adler32.bin", headers=headers
+    )
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x}"
+
+
+@pytest.fixture(scope="module")
+def indexed_server(build_container: None, oidc_mock_idp: MockIdP):
+    """A server that looks up metadata in its index, reconciled every second"""
+    extra_config = {
+        "metaindex_enabled": True,
+        "metaindex_reconcile_interval": 1,
+    }
+    with run_server(
+        oidc_mock_idp, name="nginx-metaindex-test", extra_config=extra_config
+    ) as server:
+        yield server
+
+
+def test_head_adler32_indexed(
+    indexed_server: ServerInstance,
+    wlcg_create_header: dict[str, str],
+    wlcg_read_header: dict[str, str],
+):
+    headers = dict(wlcg_read_header)
+    headers["Want-Digest"] = "adler32"
+    path = f"{indexed_server.hosturl}/indexed.txt"
+
+    response = httpx.put(path, headers=wlcg_create_header, content=b"Hello, world!")
+    assert_status(response, httpx.codes.CREATED)
+    response = httpx.head(path, headers=headers)
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(b'Hello, world!'):08x}"
+
+    # Replaced behind the server's back, which the index picks up when it is
+    # reconciled with the disk
+    subprocess.run(
+        [
+            "podman",
+            "exec",
+            "-i",
+            indexed_server.container_id,
+            "sh",
+            "-c",
+            "rm /var/www/webdav/indexed.txt && cat > /var/www/webdav/indexed.txt",
+        ],
+        input=b"Goodbye, world!",
+        check=True,
+    )
+    time.sleep(3)
+    response = httpx.head(path, headers=headers)
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Digest"] == f"adler32={zlib.adler32(b'Goodbye, world!'):08x}"
+
+    response = httpx.delete(path, headers=wlcg_create_header)
+    assert_status(response, httpx.codes.NO_CONTENT)
+    response = httpx.head(path, headers=headers)
+    assert_status(response, httpx.codes.NOT_FOUND)
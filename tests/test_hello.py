@@ -37,3 +37,16 @@ def test_hello(nginx_server: str, wlcg_read_header: dict[str, str]):
 def test_list(nginx_server: str, wlcg_read_header: dict[str, str]):
     response = httpx.get(f"{nginx_server}", headers=wlcg_read_header)
     assert_status(response, httpx.codes.OK)
+
+
+def test_metrics(nginx_server: str, wlcg_read_header: dict[str, str]):
+    response = httpx.get(f"{nginx_server}/hello.txt", headers=wlcg_read_header)
+    assert_status(response, httpx.codes.OK)
+
+    bare = nginx_server.removesuffix("webdav")
+    response = httpx.get(f"{bare}/metrics")
+    assert_status(response, httpx.codes.OK)
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert "# TYPE nginx_webdav_requests_total counter" in response.text
+    assert 'nginx_webdav_requests_total{operation="read",status="200"}' in response.text
+    assert 'nginx_webdav_request_duration_seconds_bucket{operation="read",le="+Inf"}' in response.text
@@ -1,4 +1,5 @@
 import asyncio
+import zlib
 
 import httpx
 import numpy
@@ -30,3 +31,34 @@ async def test_parallel_write(
             assert_status(response, httpx.codes.CREATED)
 
         await asyncio.gather(*map(run, range(32)))
+
+
+@pytest.mark.asyncio
+async def test_parallel_write_same_path(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+):
+    async def data_generator(fill: bytes, num_chunks: int):
+        for _ in range(num_chunks):
+            yield fill * (64 * 1024)
+            await asyncio.sleep(0.01)
+
+    path = "/test_same_path.bin"
+    async with httpx.AsyncClient(
+        base_url=nginx_server, headers=wlcg_create_header
+    ) as client:
+
+        async def run(i: int):
+            response = await client.put(
+                path, content=data_generator(bytes([i]), 32)
+            )
+            assert response.status_code in (httpx.codes.CREATED, httpx.codes.NO_CONTENT)
+
+        await asyncio.gather(*map(run, range(8)))
+
+        # The file is one of the uploads as a whole, with its own checksum
+        response = await client.get(path, headers={"Want-Digest": "adler32"})
+        assert_status(response, httpx.codes.OK)
+        data = response.content
+        assert data == data[:1] * (32 * 64 * 1024)
+        assert response.headers["Digest"] == f"adler32={zlib.adler32(data):08x}"
@@ -0,0 +1,101 @@
+import xml.etree.ElementTree as ET
+import zlib
+
+import httpx
+
+from .util import assert_status
+
+NS = {"d": "DAV:", "ns": "http://www.dcache.org/2013/webdav"}
+
+
+def propfind(url: str, headers: dict[str, str], depth: str) -> httpx.Response:
+    return httpx.request("PROPFIND", url, headers=headers | {"Depth": depth})
+
+
+def parse(response: httpx.Response) -> dict[str, ET.Element]:
+    root = ET.fromstring(response.content)
+    return {
+        item.findtext("d:href", namespaces=NS): item.find("d:propstat/d:prop", NS)
+        for item in root.findall("d:response", NS)
+    }
+
+
+def test_propfind(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+    wlcg_read_header: dict[str, str],
+):
+    files = {f"file{i}.txt": b"Hello, world!" * (i + 1) for i in range(300)}
+    for name, data in files.items():
+        response = httpx.put(
+            f"{nginx_server}/test_propfind/{name}",
+            headers=wlcg_create_header,
+            content=data,
+        )
+        assert_status(response, httpx.codes.CREATED)
+    response = httpx.put(
+        f"{nginx_server}/test_propfind/sub/file.txt",
+        headers=wlcg_create_header,
+        content=b"Hello, world!",
+    )
+    assert_status(response, httpx.codes.CREATED)
+
+    response = propfind(f"{nginx_server}/test_propfind/", {}, "1")
+    assert_status(response, httpx.codes.UNAUTHORIZED)
+
+    # More entries than a batch, so the listing comes in several chunks
+    response = propfind(f"{nginx_server}/test_propfind", wlcg_read_header, "1")
+    assert_status(response, httpx.codes.MULTI_STATUS)
+    entries = parse(response)
+    assert len(entries) == len(files) + 2
+    assert entries["/webdav/test_propfind/"].find("d:resourcetype/d:collection", NS) is not None
+    assert entries["/webdav/test_propfind/sub/"].find("d:resourcetype/d:collection", NS) is not None
+    for name, data in files.items():
+        prop = entries[f"/webdav/test_propfind/{name}"]
+        assert prop.findtext("d:getcontentlength", namespaces=NS) == str(len(data))
+        assert prop.findtext("d:getlastmodified", namespaces=NS)
+        adler32 = f"{zlib.adler32(data):08x}"
+        assert prop.findtext("ns:Checksums", namespaces=NS) == f"adler32={adler32}"
+
+    response = propfind(
+        f"{nginx_server}/test_propfind/file0.txt", wlcg_read_header, "0"
+    )
+    assert_status(response, httpx.codes.MULTI_STATUS)
+    assert list(parse(response)) == ["/webdav/test_propfind/file0.txt"]
+
+    response = propfind(f"{nginx_server}/test_propfind/", wlcg_read_header, "0")
+    assert_status(response, httpx.codes.MULTI_STATUS)
+    assert list(parse(response)) == ["/webdav/test_propfind/"]
+
+    response = propfind(f"{nginx_server}/test_propfind/", wlcg_read_header, "infinity")
+    assert_status(response, httpx.codes.FORBIDDEN)
+
+    response = propfind(f"{nginx_server}/nonexistent/", wlcg_read_header, "1")
+    assert_status(response, httpx.codes.NOT_FOUND)
+
+
+def test_propfind_escaping(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+    wlcg_read_header: dict[str, str],
+):
+    response = httpx.put(
+        f"{nginx_server}/test_propfind_a&b/file.txt",
+        headers=wlcg_create_header,
+        content=b"Hello, world!",
+    )
+    assert_status(response, httpx.codes.CREATED)
+
+    response = propfind(f"{nginx_server}/test_propfind_a&b/", wlcg_read_header, "1")
+    assert_status(response, httpx.codes.MULTI_STATUS)
+    assert set(parse(response)) == {
+        "/webdav/test_propfind_a&b/",
+        "/webdav/test_propfind_a&b/file.txt",
+    }
+
+    # The upload and staging area is not listed
+    response = propfind(f"{nginx_server}/", wlcg_read_header, "1")
+    assert_status(response, httpx.codes.MULTI_STATUS)
+    assert "/webdav/.upload/" not in parse(response)
+    response = propfind(f"{nginx_server}/.upload/", wlcg_read_header, "1")
+    assert_status(response, httpx.codes.NOT_FOUND)
@@ -1,5 +1,7 @@
 import logging
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
 from typing import Iterable, Iterator
@@ -7,10 +9,14 @@ from typing import Iterable, Iterator
 import httpx
 import pytest
 
+from .conftest import MockIdP, ServerInstance, run_server
 from .util import assert_status
 
 logger = logging.getLogger("RequestHandler")
 
+# Files received by the peer server through PUT, by path
+received: dict[str, bytes] = {}
+
 
 class RequestHandler(BaseHTTPRequestHandler):
     def _auth(self):
@@ -26,11 +32,56 @@ class RequestHandler(BaseHTTPRequestHandler):
             return False
         return True
 
+    def _ranged(self, head: bool):
+        """Serve /ranged/bigdata.bin with support for HEAD and byte ranges"""
+        data = b"Hello, world!" * 10_000
+        adler32 = 0x37F631F0
+        if "Range" in self.headers:
+            first, last = self.headers["Range"].removeprefix("bytes=").split("-")
+            first, last = int(first), min(int(last), len(data) - 1)
+            self.send_response(httpx.codes.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+            data = data[first : last + 1]
+        else:
+            self.send_response(httpx.codes.OK)
+            self.send_header("Digest", f"adler32={adler32:08x}")
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Content-length", str(len(data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def do_PUT(self):
+        if not self._auth():
+            return
+
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        received[self.path] = data
+        self.send_response(httpx.codes.CREATED)
+        if self.headers.get("Want-Digest") == "adler32":
+            self.send_header("Digest", f"adler32={zlib.adler32(data):08x}")
+        self.send_header("Content-length", "0")
+        self.end_headers()
+        logger.info(f"PUT {self.path} {httpx.codes.CREATED}")
+
+    def do_HEAD(self):
+        if not self._auth():
+            return
+
+        if self.path == "/ranged/bigdata.bin":
+            self._ranged(head=True)
+        else:
+            self.send_response(httpx.codes.NOT_FOUND)
+            self.end_headers()
+
     def do_GET(self):
         if not self._auth():
             return
 
-        if self.path == "/hello.txt":
+        if self.path == "/ranged/bigdata.bin":
+            self._ranged(head=False)
+        elif self.path == "/hello.txt":
             code = httpx.codes.OK
             data = b"Hello, world!"
             nbytes = len(data)
@@ -222,3 +273,126 @@ def test_tpc_pull_perfmarkers(
             markers.append(data)
     assert len(markers) >= 2
     assert "success" in markers[-1]
+
+
+def test_tpc_pull_striped(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+    peer_server: str,
+    caplog,
+):
+    caplog.set_level(logging.INFO)
+
+    src = f"{peer_server}/ranged/bigdata.bin"
+    dst = f"{nginx_server}/bigdata_tpc_pull_striped.bin"
+
+    headers = dict(wlcg_create_header)
+    headers["Source"] = src
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+    headers["X-Number-Of-Streams"] = "4"
+
+    response = httpx.request("COPY", dst, headers=headers)
+    assert response.status_code == httpx.codes.ACCEPTED
+    assert response.text.strip() == "success: Created"
+
+    response = httpx.get(dst, headers=wlcg_create_header)
+    assert_status(response, httpx.codes.OK)
+    assert response.content == b"Hello, world!" * 10_000
+
+
+def test_tpc_push(
+    nginx_server: str,
+    wlcg_create_header: dict[str, str],
+    peer_server: str,
+    caplog,
+):
+    caplog.set_level(logging.INFO)
+
+    data = b"Hello, world!" * 10_000
+    src = f"{nginx_server}/bigdata_tpc_push.bin"
+    response = httpx.put(src, headers=wlcg_create_header, content=data)
+    assert_status(response, httpx.codes.CREATED)
+
+    headers = dict(wlcg_create_header)
+    headers["Destination"] = f"{peer_server}/pushed.bin"
+    response = httpx.request("COPY", src, headers=headers)
+    assert_status(response, httpx.codes.ACCEPTED)
+    # the peer may reject the PUT before or after reading the body
+    assert response.text.strip().startswith("failure:")
+
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+    response = httpx.request("COPY", src, headers=headers)
+    assert_status(response, httpx.codes.ACCEPTED)
+    assert response.text.strip() == "success: Created"
+    assert received["/pushed.bin"] == data
+
+    headers["Destination"] = f"{peer_server}/pushed_nonexistent.bin"
+    response = httpx.request(
+        "COPY", f"{nginx_server}/nonexistent_tpc_push.bin", headers=headers
+    )
+    assert_status(response, httpx.codes.NOT_FOUND)
+
+
+@pytest.fixture(scope="module")
+def limited_server(build_container: None, oidc_mock_idp: MockIdP):
+    """A server that runs one pull per source host, and queues one more"""
+    extra_config = {
+        "tpc_max_active_per_host": 1,
+        "tpc_max_queued": 1,
+        "tpc_queue_poll_interval": 0.1,
+    }
+    with run_server(
+        oidc_mock_idp, name="nginx-tpc-limit-test", extra_config=extra_config
+    ) as server:
+        yield server
+
+
+def test_tpc_pull_limits(
+    limited_server: ServerInstance,
+    wlcg_create_header: dict[str, str],
+    hepcdn_access_header: dict[str, str],
+    peer_server: str,
+):
+    headers = dict(wlcg_create_header)
+    headers["TransferHeaderAuthorization"] = "Bearer opensesame"
+
+    def pull(source: str, name: str) -> httpx.Response:
+        return httpx.request(
+            "COPY",
+            f"{limited_server.hosturl}/{name}",
+            headers=headers | {"Source": f"{peer_server}/{source}"},
+            timeout=60,
+        )
+
+    with ThreadPoolExecutor() as executor:
+        # Takes about 10 seconds
+        slow = executor.submit(pull, "bigdata.bin.adler32.slow", "limit_slow.bin")
+        time.sleep(2)
+
+        response = httpx.get(
+            limited_server.hosturl.removesuffix("webdav") + "transfers",
+            headers=hepcdn_access_header,
+        )
+        assert_status(response, httpx.codes.OK)
+        data = response.json()
+        assert data["queued"] == 0
+        assert len(data["active"]) == 1
+        assert data["active"][0]["kind"] == "pull"
+        assert data["active"][0]["host"] == "host.docker.internal:8081"
+
+        queued = executor.submit(pull, "bigdata.bin.adler32", "limit_queued.bin")
+        time.sleep(1)
+
+        # Neither a slot nor a place in the queue is left
+        response = pull("bigdata.bin.adler32", "limit_rejected.bin")
+        assert_status(response, httpx.codes.SERVICE_UNAVAILABLE)
+        assert "Retry-After" in response.headers
+
+        response = slow.result()
+        assert_status(response, httpx.codes.ACCEPTED)
+        assert response.text.splitlines()[-1] == "success: Created"
+
+        response = queued.result()
+        assert_status(response, httpx.codes.ACCEPTED)
+        assert "State: Queued" in response.text
+        assert response.text.splitlines()[-1] == "success: Created"